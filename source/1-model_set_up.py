@@ -47,12 +47,12 @@ act_name="market for electricity, high voltage, aluminium industry"
 utils_bw.utils_bw.create_act_new_location(bw_db_name,act_name,new_location='GLO',cut_off_occurence=1,copy_multiple_same_inputs='n',keep_location_multiple_inputs='n',copy_from_glo='n')
 
 #Check 
-act_list = [act for act in bw_db if act_name in act['name'] and 'GLO' in act['location']]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name,location_contains='GLO')
 new_act = act_list[0]
 [exc for exc in new_act.technosphere()]
 
 #3) For all 'electricity high voltage' activities, ensure that all energy sources are linked in input. Otherwise, create the acvitity in input and link it with existing ones.
-act_list=[act for act in bw_db if act_name in act['name']]
+act_list=utils_bw.find_activities(bw_db_name,name_contains=act_name)
 #For each activity. Ensure all electricity sources are inputs and have exchanges.
 for market_act in act_list:
     location = market_act['location']
@@ -62,7 +62,7 @@ for market_act in act_list:
     if len(diff_set) != 0:
         for input_name in list(diff_set):
             #If the input does not exist. Create it and link it with existing proxies
-            if len([act for act in bw_db if input_name in act['name'] and location in act['location']])==0:
+            if len(utils_bw.find_activities(bw_db_name,name_contains=input_name,location_contains=location))==0:
                 new_act=bw_db.new_activity(input_name)
                 new_act['name']=input_name
                 new_act['code']=input_name+location
@@ -72,10 +72,11 @@ for market_act in act_list:
                 new_act['unit']='kilowatt hour'
                 new_act['production amount']=1
                 new_act.save()
+                utils_bw.update_activity_index(new_act)
                 #Activity as dictionary
                 #new_act.as_dict()
             else:
-                new_act=[act for act in bw_db if input_name in act['name'] and location in act['location']][0]
+                new_act=utils_bw.find_activities(bw_db_name,name_contains=input_name,location_contains=location)[0]
             #Check the list of exchanges in this input. If null, then link it to existing proxies
             if len([exc for exc in new_act.technosphere()])==0:
                 new_exc_source_name=input_name.replace(", aluminium industry","").replace("electricity production,","")
@@ -94,19 +95,21 @@ for market_act in act_list:
                     median_act_dic = utils_bw.get_median_act(bw_db_name=bw_db_name,name_to_include=name_to_include,name_to_exclude=name_to_exclude,unit=unit,ia_method=('IPCC 2013', 'climate change', 'GWP 100a'),location_keywords=None)
                     print('No inputs have been found in the location keywords for market '+location+' and source '+new_exc_source_name)
                 #Create the exchange
-                new_exc_input = [act for act in bw_db if act['code']==median_act_dic['Median']][0]
+                new_exc_input = utils_bw.find_activities(bw_db_name,code=median_act_dic['Median'])[0]
                 new_exc = new_act.new_exchange(input=new_exc_input, amount=1, type='technosphere')
                 new_exc.save()
                 print(new_exc)
                 new_act.save()
+                utils_bw.update_activity_index(new_act)
             #Check exchange is in the activity
             #[exc for exc in new_act.technosphere()]
             #Add the input (newly created or not to the market activity)
             new_exc_market = market_act.new_exchange(input=new_act, amount=0, type='technosphere')
             new_exc_market.save()
+            utils_bw.set_database_modified(bw_db_name)
 ''' If issue with GLO activity. Delete all 
 act_name="market for electricity, high voltage, aluminium industry"
-act = [act for act in bw_db if act_name in act['name'] and 'GLO' in act['location']][0]
+act = utils_bw.find_activities(bw_db_name,name_contains=act_name,location_contains='GLO')[0]
 elec_act_exc_list = [exc for exc in act.technosphere() if 'electricity production' in exc.input['name']]
 for exc in elec_act_exc_list:
     exc.input.delete()
@@ -115,7 +118,7 @@ for exc in elec_act_exc_list:
 '''
 #Check the LCA score are equivalent for all locations
 act_name="market for electricity, high voltage, aluminium industry"
-act_list = [act for act in bw_db if act_name in act['name']]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name)
 fu_list = [{act:1} for act in act_list]
 method = ('IPCC 2013', 'climate change', 'GWP 100a')
 bw.calculation_setups['aluminium_elec_high_ipcc'] = {'inv':fu_list, 'ia':[method]}
@@ -126,7 +129,7 @@ pd.DataFrame(index=[list(fu.keys())[0]['location'] for fu in fu_list], columns=[
 #2) Create 'electricity medium voltage' for GLO without any exchange.
 
 act_name = "market for electricity, medium voltage, aluminium industry"
-act_list = [act for act in bw_db if act_name in act['name']]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name)
 #Check all locations exist
 diff_set=set(iai_reg_l).difference(set([act['location'] for act in act_list]))
 #If GLO does not exist. Create the activity WITHOUT EXCHANGES
@@ -140,6 +143,7 @@ if 'GLO' in diff_set:
     new_act['unit']=act_list[0]['unit']
     new_act['production amount']=1
     new_act.save()
+    utils_bw.update_activity_index(new_act)
 #Check [act for act in bw_db if act_name in act['name']]
     
 #3) Create 'electricity voltage transformation' for GLO without any exchange.
@@ -148,7 +152,7 @@ act_name="electricity voltage transformation from high to medium voltage, alumin
 utils_bw.create_act_new_location(bw_db_name,act_name,new_location='GLO',cut_off_occurence=0.9,copy_multiple_same_inputs='y',keep_location_multiple_inputs='n',copy_from_glo='n')
 
 #Check 
-act = [act for act in bw_db if act_name in act['name'] and 'GLO' in act['location']][0]
+act = utils_bw.find_activities(bw_db_name,name_contains=act_name,location_contains='GLO')[0]
 [exc for exc in act.technosphere()]
 
 #4) Create the exchanges in 'electricity medium voltage' for GLO
@@ -156,7 +160,7 @@ act = [act for act in bw_db if act_name in act['name'] and 'GLO' in act['locatio
 act_name="market for electricity, medium voltage, aluminium industry"
 utils_bw.create_act_new_location(bw_db_name,act_name,new_location='GLO',cut_off_occurence=0.9,copy_multiple_same_inputs='y',keep_location_multiple_inputs='n',copy_from_glo='n')
 #Check 
-act = [act for act in bw_db if act_name in act['name'] and 'GLO' in act['location']][0]
+act = utils_bw.find_activities(bw_db_name,name_contains=act_name,location_contains='GLO')[0]
 [exc for exc in act.technosphere()]
 
 '''
@@ -171,7 +175,7 @@ country_correspondence=pd.read_csv('inputs/country_correspondence.csv').fillna(0
 prod_ds = pd.read_csv('inputs/bauxite_production_data.csv').fillna(0)
 producing_country_list = prod_ds.Country.unique().tolist()
 act_name = 'bauxite mine operation'
-act_ref = [act for act in bw_db if act_name in act['name'] and 'GLO' in act['location']][0]
+act_ref = utils_bw.find_activities(bw_db_name,name_contains=act_name,location_contains='GLO')[0]
 for country in producing_country_list:
     ei_country = country_correspondence.loc[country_correspondence['cty Name English']==country,'ecoinvent_country'].values[0]
     if ei_country==0:
@@ -183,7 +187,7 @@ for country in producing_country_list:
         print("elapsed time (seconds): %f" % (end_ts - beg_ts))
 
 #Check the LCA score are equivalent for all locations
-act_list = [act for act in bw_db if act_name in act['name']]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name)
 fu_list = [{act:1} for act in act_list]
 method = ('IPCC 2013', 'climate change', 'GWP 100a')
 bw.calculation_setups['bauxite_production_ipcc'] = {'inv':fu_list, 'ia':[method]}
@@ -192,9 +196,9 @@ pd.DataFrame(index=[list(fu.keys())[0]['location'] for fu in fu_list], columns=[
 
 #2) Create the transportation activities for all producing countries. Assumption: We assume only transoceanic ship
 act_name = 'market for transport, freight, sea, transoceanic ship'
-transport_act = [act for act in bw_db if act_name == act['name']][0]
+transport_act = utils_bw.find_activities(bw_db_name,name=act_name)[0]
 #This activity has only one input. We duplicate it by producing region (origin)
-baux_loc_list = [act['location'] for act in bw_db if 'bauxite mine operation' in act['name'] and 'kilogram' in act['unit'] and 'GLO' not in act['location']]
+baux_loc_list = [act['location'] for act in utils_bw.find_activities(bw_db_name,name_contains='bauxite mine operation',unit_contains='kilogram',location_not_contains='GLO')]
 for loc in baux_loc_list:
     beg_ts = time.time()
     new_act,duplicated_act,non_duplicated_act = utils_bw.duplicate_act_new_location(bw_db_name=bw_db_name,act_key=transport_act.key,new_location=loc,prod_system_depth=1)
@@ -204,10 +208,10 @@ for loc in baux_loc_list:
 #3) Create market for consumption of bauxite for all alumina producing countries
     
 #Create activity for GLO
-act_ref = [act for act in bw_db if 'bauxite mine operation' in act['name'] and 'GLO' in act['location']][0]
+act_ref = utils_bw.find_activities(bw_db_name,name_contains='bauxite mine operation',location_contains='GLO')[0]
 #list(act_ref.technosphere())
 act_name = 'market for consumption of bauxite'
-if len([act for act in bw_db if act_name==act['name'] and 'GLO'==act['location']])==0:
+if len(utils_bw.find_activities(bw_db_name,name=act_name,location='GLO'))==0:
     glo_act = bw_db.new_activity(act_name)
     glo_act['name'] = act_name
     glo_act['code'] = act_name+'GLO'
@@ -217,14 +221,15 @@ if len([act for act in bw_db if act_name==act['name'] and 'GLO'==act['location']
     glo_act['unit'] = act_ref['unit']
     glo_act['production amount'] = 1
     glo_act.save()
+    utils_bw.update_activity_index(glo_act)
 else:
-    glo_act = [act for act in bw_db if act_name==act['name'] and 'GLO'==act['location']][0]
+    glo_act = utils_bw.find_activities(bw_db_name,name=act_name,location='GLO')[0]
 #glo_act.as_dict()
 list(glo_act.technosphere())
     
 #Create exchanges of all bauxite producing countries and transportation acitivities
-baux_act_list = [act for act in bw_db if 'bauxite mine operation' in act['name'] and 'kilogram' in act['unit']]
-mar_tran_act_list = [act for act in bw_db if 'market for transport, freight, sea, transoceanic ship' == act['name']]
+baux_act_list = utils_bw.find_activities(bw_db_name,name_contains='bauxite mine operation',unit_contains='kilogram')
+mar_tran_act_list = utils_bw.find_activities(bw_db_name,name='market for transport, freight, sea, transoceanic ship')
 baux_loc_list = [act['location'] for act in baux_act_list]
 for loc in baux_loc_list:
     if loc not in [exc.input['location'] for exc in glo_act.technosphere() if 'bauxite mine operation' == exc.input['name']]:
@@ -233,11 +238,13 @@ for loc in baux_loc_list:
         new_exc = glo_act.new_exchange(amount=1/len(baux_loc_list),input=baux_in_act,type="technosphere")
         new_exc.save()
         glo_act.save()
+        utils_bw.update_activity_index(glo_act)
         #Create the transport market activity
         trans_in_act = [act for act in mar_tran_act_list if loc in act['location']][0]
         new_exc = glo_act.new_exchange(amount=0,input=trans_in_act,type="technosphere")
         new_exc.save()
         glo_act.save()
+        utils_bw.update_activity_index(glo_act)
 list(glo_act.technosphere())
 
 #Update the exchanges to only account for GLO inputs in GLO market.
@@ -248,15 +255,16 @@ for exc in [exc for exc in glo_act.technosphere() if 'bauxite mine operation'==e
         exc['amount'] = 0
     exc.save()
     glo_act.save()
+    utils_bw.update_activity_index(glo_act)
 #list(glo_act.technosphere())
 
 #Copy activity for all alumina producing countries
 country_correspondence=pd.read_csv('inputs/country_correspondence.csv').fillna(0)
 prod_ds = pd.read_csv('inputs/alumina_production_data.csv').fillna(0)
 producing_country_list = prod_ds.Country.unique().tolist()
-act_list = [act for act in bw_db if act_name==act['name']]
+act_list = utils_bw.find_activities(bw_db_name,name=act_name)
 for country in producing_country_list:
-    act_list = [act for act in bw_db if 'market for consumption of bauxite'==act['name']]
+    act_list = utils_bw.find_activities(bw_db_name,name='market for consumption of bauxite')
     ei_country = country_correspondence.loc[country_correspondence['cty Name English']==country,'ecoinvent_country'].values[0]
     print(ei_country)
     if ei_country==0:
@@ -265,6 +273,7 @@ for country in producing_country_list:
         new_loc_act = glo_act.copy()
         new_loc_act['location'] = ei_country
         new_loc_act.save()
+        utils_bw.update_activity_index(new_loc_act)
         print('Activity for '+ei_country+' created')
 #list(new_loc_act.technosphere())
         
@@ -273,7 +282,8 @@ loc_to_delete = list(set([act['location'] for act in act_list if [act['location'
 for loc in loc_to_delete:
     act = [act for act in act_list if act['location']==loc][0]
     act.delete()
-act_list = [act for act in bw_db if 'market for consumption of bauxite' in act['name']]
+    utils_bw.invalidate_activity_index(bw_db_name)
+act_list = utils_bw.find_activities(bw_db_name,name_contains='market for consumption of bauxite')
 [act['location'] for act in act_list if [act['location'] for act in act_list].count(act['location']) > 1]
 
 '''
@@ -282,13 +292,14 @@ Create alumina process that aggregate aluminium oxide and aluminium hydroxide pr
 
 #1) Create the alumina production activity GLO if non-existing
 
-orig_alumina_act=[act for act in bw_db if "aluminium oxide production" in act['name'] and "GLO" in act['location'] and 'kilogram' in act['unit']][0]
-search_list=[act for act in bw_db if "alumina production" in act['name'] and "GLO" in act['location'] and 'kilogram' in act['unit']]
+orig_alumina_act=utils_bw.find_activities(bw_db_name,name_contains="aluminium oxide production",location_contains="GLO",unit_contains='kilogram')[0]
+search_list=utils_bw.find_activities(bw_db_name,name_contains="alumina production",location_contains="GLO",unit_contains='kilogram')
 if  len(search_list)==0:
     alumina_act=orig_alumina_act.copy()
     alumina_act['name']='alumina production'
     alumina_act['comment']='from aluminium oxide production, GLO process. Aggregates inputs of aluminium hydroxide production adjusted to the ouput/input of aluminium hydroxide in aluminium oxide'
     alumina_act.save()
+    utils_bw.update_activity_index(alumina_act)
 elif len(search_list)==1:
     alumina_act=search_list[0]
 alumina_act.as_dict()
@@ -305,7 +316,7 @@ else:
     alu_hydro_input=alu_hydro_exc.amount
 
 #3) Copy and adapt all inputs and outputs (except production of aluminium hydroxide production activity into alumina production activity
-al_hydroxide_act=[act for act in bw_db if 'aluminium hydroxide production' in act['name'] and "GLO" in act['location'] and 'kilogram' in act['unit']][0]
+al_hydroxide_act=utils_bw.find_activities(bw_db_name,name_contains='aluminium hydroxide production',location_contains="GLO",unit_contains='kilogram')[0]
 exc_list=[exc for exc in al_hydroxide_act.exchanges() if exc['type']!='production']
 for old_exc in exc_list:
     #Check if exchange does not already exist
@@ -320,6 +331,7 @@ len([exc for exc in alumina_act.exchanges()])
 
 alu_hydro_exc.delete()
 alumina_act.save()
+utils_bw.update_activity_index(alumina_act)
 
 #5) Check if duplicate inputs
 
@@ -340,6 +352,7 @@ if len(duplicate_input_key)>0:
         for exc_to_del in exc_to_del_list:
             exc_to_del.delete()
     alumina_act.save()
+    utils_bw.update_activity_index(alumina_act)
 else:
     print("No duplicate inputs in exchanges")
     
@@ -358,8 +371,8 @@ delta_lca_calc.score
 #7) Unlink the market of bauxite, without water. And link the new market for consumption of bauxite for GLO
 
 act_name = 'alumina production'
-alumina_act = [act for act in bw_db if act['name']==act_name and 'GLO'==act['location']][0]
-mar_baux_act = [act for act in bw_db if 'market for consumption of bauxite' == act['name'] and 'GLO'==act['location']][0]
+alumina_act = utils_bw.find_activities(bw_db_name,name=act_name,location='GLO')[0]
+mar_baux_act = utils_bw.find_activities(bw_db_name,name='market for consumption of bauxite',location='GLO')[0]
 
 #print(str(sum([exc.amount for exc in alumina_act.technosphere() if 'bauxite mine operation' in exc.input['name']])))
 alumina_exc_list = [exc for exc in alumina_act.technosphere()]
@@ -371,6 +384,7 @@ if any('market for bauxite, without water' in exc.input['name'] for exc in alumi
     #Delete the exchange
     baux_exc.delete()
     alumina_act.save()
+    utils_bw.update_activity_index(alumina_act)
     #check [exc for exc in alumina_act.technosphere() if 'market for bauxite, without water'==exc.input['name']]
 else:
     baux_input = 2.8764
@@ -379,6 +393,7 @@ if 'GLO' not in [exc.input['location'] for exc in alumina_act.technosphere() if
     new_exc = alumina_act.new_exchange(amount=baux_input,input=mar_baux_act,type="technosphere")
     new_exc.save()
     alumina_act.save()
+    utils_bw.update_activity_index(alumina_act)
 #Check list(alumina_act.technosphere())
 
 '''
@@ -391,7 +406,7 @@ country_correspondence=pd.read_csv('inputs/country_correspondence.csv').fillna(0
 prod_ds = pd.read_csv('inputs/alumina_production_data.csv').fillna(0)
 producing_country_list = prod_ds.Country.unique().tolist()
 act_name = 'alumina production'
-act_ref = [act for act in bw_db if act_name in act['name'] and 'GLO' in act['location']][0]
+act_ref = utils_bw.find_activities(bw_db_name,name_contains=act_name,location_contains='GLO')[0]
 for country in producing_country_list:
     ei_country = country_correspondence.loc[country_correspondence['cty Name English']==country,'ecoinvent_country'].values[0]
     print(ei_country)
@@ -408,7 +423,7 @@ country_correspondence = pd.read_csv('inputs/country_correspondence.csv').fillna
 list_ei_country = country_correspondence.ecoinvent_country.unique().tolist()
 list_ei_country.append('GLO') #We add GLO in the list
 act_name = 'alumina production'
-act_list = [act for act in bw_db if act_name in act['name'] and act['location'] in list_ei_country]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name,location_in=list_ei_country)
 for act in act_list:
     search_list = [exc for exc in act.technosphere() if 'market for consumption of bauxite' in exc.input['name']]
     assert len(search_list)==1
@@ -416,7 +431,7 @@ for act in act_list:
 
 #Check the LCA score are equivalent for all locations
 act_name = 'alumina production'
-act_list = [act for act in bw_db if act_name in act['name']]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name)
 fu_list = [{act:1} for act in act_list]
 method = ('IPCC 2013', 'climate change', 'GWP 100a')
 bw.calculation_setups['alumina_production_ipcc'] = {'inv':fu_list, 'ia':[method]}
@@ -425,9 +440,9 @@ pd.DataFrame(index=[list(fu.keys())[0]['location'] for fu in fu_list], columns=[
 
 #9) Create the transportation activities for all producing countries. Assumption: We assume only transoceanic ship
 act_name = 'market for transport, freight, sea, transoceanic ship'
-transport_act = [act for act in bw_db if act_name == act['name'] and 'GLO' == act['location']][0]
+transport_act = utils_bw.find_activities(bw_db_name,name=act_name,location='GLO')[0]
 #This activity has only one input. We duplicate it by producing region (origin)
-alumina_loc_list = [act['location'] for act in bw_db if 'alumina production' in act['name'] and 'kilogram' in act['unit'] and 'GLO' not in act['location']]
+alumina_loc_list = [act['location'] for act in utils_bw.find_activities(bw_db_name,name_contains='alumina production',unit_contains='kilogram',location_not_contains='GLO')]
 for loc in alumina_loc_list:
     beg_ts = time.time()
     new_act,duplicated_act,non_duplicated_act = utils_bw.duplicate_act_new_location(bw_db_name=bw_db_name,act_key=transport_act.key,new_location=loc,prod_system_depth=1)
@@ -437,9 +452,9 @@ for loc in alumina_loc_list:
 #2) Create the market for consumption of alumina for primary aluminium liquid countries
     
 #Create activity for GLO
-act_ref = [act for act in bw_db if 'alumina production' in act['name'] and 'GLO' in act['location']][0]
+act_ref = utils_bw.find_activities(bw_db_name,name_contains='alumina production',location_contains='GLO')[0]
 act_name = 'market for consumption of alumina'
-if len([act for act in bw_db if act_name==act['name'] and 'GLO'==act['location']])==0:
+if len(utils_bw.find_activities(bw_db_name,name=act_name,location='GLO'))==0:
     glo_act = bw_db.new_activity(act_name)
     glo_act['name'] = act_name
     glo_act['code'] = act_name+'GLO'
@@ -449,14 +464,15 @@ if len([act for act in bw_db if act_name==act['name'] and 'GLO'==act['location']
     glo_act['unit'] = act_ref['unit']
     glo_act['production amount'] = 1
     glo_act.save()
+    utils_bw.update_activity_index(glo_act)
 else:
-    glo_act = [act for act in bw_db if act_name==act['name'] and 'GLO'==act['location']][0]
+    glo_act = utils_bw.find_activities(bw_db_name,name=act_name,location='GLO')[0]
 #glo_act.as_dict()
 list(glo_act.technosphere())
 
 #Create exchanges of all alumina producing countries and transportation activities. Include GLO activity
-alumina_act_list = [act for act in bw_db if 'alumina production' in act['name'] and 'kilogram' in act['unit']]
-mar_tran_act_list = [act for act in bw_db if 'market for transport, freight, sea, transoceanic ship' == act['name']]
+alumina_act_list = utils_bw.find_activities(bw_db_name,name_contains='alumina production',unit_contains='kilogram')
+mar_tran_act_list = utils_bw.find_activities(bw_db_name,name='market for transport, freight, sea, transoceanic ship')
 alumina_loc_list = [act['location'] for act in alumina_act_list]
 for loc in alumina_loc_list:
     if loc not in [exc.input['location'] for exc in glo_act.technosphere() if 'alumina production' == exc.input['name']]:
@@ -465,11 +481,13 @@ for loc in alumina_loc_list:
         new_exc = glo_act.new_exchange(amount=1/len(alumina_act_list),input=alumina_in_act,type="technosphere")
         new_exc.save()
         glo_act.save()
+        utils_bw.update_activity_index(glo_act)
         #Create the transport market activity
         trans_in_act = [act for act in mar_tran_act_list if loc in act['location']][0]
         new_exc = glo_act.new_exchange(amount=0,input=trans_in_act,type="technosphere")
         new_exc.save()
         glo_act.save()
+        utils_bw.update_activity_index(glo_act)
 #list(glo_act.technosphere())
 
 #Update the exchanges to only account for GLO inputs in GLO market.
@@ -480,6 +498,7 @@ for exc in [exc for exc in glo_act.technosphere() if 'alumina production'==exc.i
         exc['amount'] = 0
     exc.save()
     glo_act.save()
+    utils_bw.update_activity_index(glo_act)
 #list(glo_act.technosphere())
 
 #3) Copy activity for all primary aluminium liquid producing countries
@@ -487,7 +506,7 @@ country_correspondence=pd.read_csv('inputs/country_correspondence.csv').fillna(0
 prod_ds = pd.read_csv('inputs/aluminium_production_data.csv').fillna(0)
 producing_country_list = prod_ds.Country.unique().tolist()
 for country in producing_country_list:
-    act_list = [act for act in bw_db if 'market for consumption of alumina' in act['name']]
+    act_list = utils_bw.find_activities(bw_db_name,name_contains='market for consumption of alumina')
     ei_country = country_correspondence.loc[country_correspondence['cty Name English']==country,'ecoinvent_country'].values[0]
     print(ei_country)
     if ei_country==0:
@@ -496,6 +515,7 @@ for country in producing_country_list:
         new_loc_act = glo_act.copy()
         new_loc_act['location'] = ei_country
         new_loc_act.save()
+        utils_bw.update_activity_index(new_loc_act)
         
 #list(new_loc_act.technosphere())
 #Check no duplicated location
@@ -503,7 +523,8 @@ loc_to_delete = list(set([act['location'] for act in act_list if [act['location'
 for loc in loc_to_delete:
     act = [act for act in act_list if act['location']==loc][0]
     act.delete()
-act_list = [act for act in bw_db if 'market for consumption of alumina' in act['name']]
+    utils_bw.invalidate_activity_index(bw_db_name)
+act_list = utils_bw.find_activities(bw_db_name,name_contains='market for consumption of alumina')
 [act['location'] for act in act_list if [act['location'] for act in act_list].count(act['location']) > 1]
   
 
@@ -512,8 +533,8 @@ Update the alumina exchange in the primary aluminium liquid production of existi
 '''
 #1)Link market for consumption of alumina GLO in primary liquid activities
 
-act_list = [act for act in bw_db if 'aluminium production' in act['name'] and 'primary, liquid' in act['name']]
-act_ref = [act for act in bw_db if 'market for consumption of alumina' in act['name'] and 'GLO' in act['location']][0]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=['aluminium production','primary, liquid'])
+act_ref = utils_bw.find_activities(bw_db_name,name_contains='market for consumption of alumina',location_contains='GLO')[0]
 for liq_alu_act in act_list:
     search_list = [exc for exc in liq_alu_act.technosphere() if  'market for aluminium oxide' in exc.input['name']]
     if len(search_list)==1:
@@ -521,6 +542,7 @@ for liq_alu_act in act_list:
         input_to_alu_liquid = exc_to_update['amount']
         exc_to_update.delete()
         liq_alu_act.save()
+        utils_bw.update_activity_index(liq_alu_act)
     else:
         input_to_alu_liquid = 1.93538
     search_list=[exc for exc in liq_alu_act.technosphere() if  act_ref.key == exc.input.key]
@@ -528,6 +550,7 @@ for liq_alu_act in act_list:
         new_exc = liq_alu_act.new_exchange(amount=input_to_alu_liquid,input=act_ref,type="technosphere")
         new_exc.save()
         liq_alu_act.save()
+        utils_bw.update_activity_index(liq_alu_act)
 
 #2) Create the primary aluminium liquid production activities for GLO
 for liquid_type in ['Söderberg','prebake']:
@@ -535,14 +558,14 @@ for liquid_type in ['Söderberg','prebake']:
     #Create the GLO activity WITHOUT ALUMINA EXCHANGE
     utils_bw.create_act_new_location(bw_db_name=bw_db_name,act_name=act_name,new_location='GLO',cut_off_occurence=0.9,copy_multiple_same_inputs='y',keep_location_multiple_inputs='y',copy_from_glo='n')
 
-act_list = [act for act in bw_db if 'aluminium production' in act['name'] and 'primary, liquid' in act['name'] and 'GLO' in act['location']]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=['aluminium production','primary, liquid'],location_contains='GLO')
 for act in act_list:
     print(list(act.technosphere()))
 
 
 #Check LCA scores for all regions
 act_name = 'aluminium production, primary, liquid'
-act_list = [act for act in bw_db if act_name in act['name']]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name)
 fu_list = [{act:1} for act in act_list]
 method = ('IPCC 2013', 'climate change', 'GWP 100a')
 bw.calculation_setups['primary_alu_liquid_iai_ipcc'] = {'inv':fu_list, 'ia':[method]}
@@ -552,7 +575,7 @@ pd.DataFrame(index=[list(fu.keys())[0]['location'] for fu in fu_list], columns=[
 #3) Create the primary aluminum ingot activities for GLO, and check it is linked with primary aluminium liquid activitiy GLO
 act_name = 'aluminium production, primary, ingot'
 utils_bw.create_act_new_location(bw_db_name=bw_db_name,act_name=act_name,new_location='GLO',cut_off_occurence=0.2,copy_multiple_same_inputs='y',keep_location_multiple_inputs='n',copy_from_glo='n')
-new_act = [act for act in bw_db if act_name in act['name'] and 'kilogram' in act['unit'] and 'GLO' in act['location']][0]
+new_act = utils_bw.find_activities(bw_db_name,name_contains=act_name,unit_contains='kilogram',location_contains='GLO')[0]
 exc_list = [exc for exc in new_act.technosphere()]
 #Update inputs of soderberg and prebake. Only consider prebake at 1
 sod_exc = [exc for exc in exc_list if 'Söderberg' in exc.input['name']][0]
@@ -561,6 +584,7 @@ sod_exc.save()
 preb_exc = [exc for exc in exc_list if 'prebake' in exc.input['name']][0]
 preb_exc['amount'] = 1
 preb_exc.save()
+utils_bw.set_database_modified(bw_db_name)
 [exc for exc in new_act.technosphere()]
 '''
 Duplicate the primary aluminium liquid production and and primary ingot production activities by country (from regional activities) 
@@ -571,7 +595,7 @@ country_correspondence=pd.read_csv('inputs/country_correspondence.csv').fillna(0
 prod_ds = pd.read_csv('inputs/aluminium_production_data.csv').fillna(0)
 producing_country_list = prod_ds.Country.unique().tolist()
 for country in producing_country_list:
-    act_list = [act for act in bw_db if 'aluminium production' in act['name'] and 'primary, liquid' in act['name']]
+    act_list = utils_bw.find_activities(bw_db_name,name_contains=['aluminium production','primary, liquid'])
     ei_country = country_correspondence.loc[country_correspondence['cty Name English']==country,'ecoinvent_country'].values[0]
     print(ei_country)
     assert ei_country!=0, country+' has no equivalency'
@@ -588,7 +612,7 @@ for country in producing_country_list:
 country_correspondence = pd.read_csv('inputs/country_correspondence.csv').fillna(0)
 list_ei_country = country_correspondence.ecoinvent_country.unique().tolist()
 list_ei_country.append('GLO') #We add GLO in the list
-act_list = [act for act in bw_db if 'aluminium production' in act['name'] and 'primary, liquid' in act['name'] and act['location'] in list_ei_country]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=['aluminium production','primary, liquid'],location_in=list_ei_country)
 for act in act_list:
     search_list = [exc for exc in act.technosphere() if 'market for consumption of alumina' in exc.input['name']]
     assert len(search_list)==1
@@ -597,7 +621,7 @@ for act in act_list:
     
 #Check
 act_name = 'aluminium production, primary, liquid'
-act_list = [act for act in bw_db if act_name in act['name']]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name)
 fu_list = [{act:1} for act in act_list]
 method = ('IPCC 2013', 'climate change', 'GWP 100a')
 bw.calculation_setups['primary_alu_liquid_all_ipcc'] = {'inv':fu_list, 'ia':[method]}
@@ -610,7 +634,7 @@ country_correspondence = pd.read_csv('inputs/country_correspondence.csv').fillna
 prod_ds = pd.read_csv('inputs/aluminium_production_data.csv').fillna(0)
 producing_country_list = prod_ds.Country.unique().tolist()
 for country in producing_country_list:
-    act_list = [act for act in bw_db if 'aluminium production, primary, ingot' in act['name']]
+    act_list = utils_bw.find_activities(bw_db_name,name_contains='aluminium production, primary, ingot')
     ei_country = country_correspondence.loc[country_correspondence['cty Name English']==country,'ecoinvent_country'].values[0]
     print(ei_country)
     assert ei_country!=0, country+' has no equivalency'
@@ -628,7 +652,7 @@ for country in producing_country_list:
 country_correspondence = pd.read_csv('inputs/country_correspondence.csv').fillna(0)
 list_ei_country = country_correspondence.ecoinvent_country.unique().tolist()
 list_ei_country.append('GLO') #We add GLO in the list
-act_list = [act for act in bw_db if 'aluminium production, primary, ingot' in act['name'] and act['location'] in list_ei_country]
+act_list = utils_bw.find_activities(bw_db_name,name_contains='aluminium production, primary, ingot',location_in=list_ei_country)
 for act in act_list:
     search_list = [exc for exc in act.technosphere() if 'aluminium production' in exc.input['name'] and 'primary, liquid' in exc.input['name']]
     assert len(search_list)!=0
@@ -637,7 +661,7 @@ for act in act_list:
 act_name='market group for electricity, medium voltage'
 #Check LCA score
 act_name = 'aluminium production, primary, ingot'
-act_list = [act for act in bw_db if act_name in act['name']]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name)
 fu_list = [{act:1} for act in act_list]
 method = ('IPCC 2013', 'climate change', 'GWP 100a')
 bw.calculation_setups['primary_alu_ingot_all_ipcc'] = {'inv':fu_list, 'ia':[method]}
@@ -651,7 +675,7 @@ Fourth Step: Create consumption activity of primary aluminium ingot
 ##Create primary aluminum consumption activity
 #1) Create the new activity
 act_name = 'market for consumption of aluminium'
-search_list = [act for act in bw_db if act_name in act['name']]
+search_list = utils_bw.find_activities(bw_db_name,name_contains=act_name)
 if len(search_list)==0:
     new_act = bw_db.new_activity(act_name)
     new_act['name'] = act_name
@@ -662,6 +686,7 @@ if len(search_list)==0:
     new_act['unit'] = 'kilogram'
     new_act['production amount'] = 1
     new_act.save()
+    utils_bw.update_activity_index(new_act)
     alu_cons_act = new_act
 else:
     alu_cons_act = search_list[0]
@@ -672,13 +697,14 @@ country_correspondence = pd.read_csv('inputs/country_correspondence.csv').fillna
 list_ei_country = country_correspondence.ecoinvent_country.unique().tolist()
 list_ei_country.append('GLO') #We add GLO in the list
 act_name = 'aluminium production, primary, ingot'
-act_list = [act for act in bw_db if act_name in act['name'] and act['location'] in list_ei_country]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name,location_in=list_ei_country)
 for act in act_list:
     exc_input_list = [exc.input for exc in alu_cons_act.technosphere()] 
     if act not in exc_input_list:
         new_exc = alu_cons_act.new_exchange(amount=1/len(act_list),input=act,type="technosphere")
         new_exc.save()
         alu_cons_act.save()
+        utils_bw.update_activity_index(alu_cons_act)
     else:
         print('Aluminium ingot production inputs from '+act['location']+' already exists')
 #Check
@@ -692,62 +718,71 @@ alu_cons_act=bw_db.get('market for consumption of aluminium')
 alu_cons_act['tag'] = 'Aluminium consumption'
 alu_cons_act['location_tag'] = 'GLO'
 alu_cons_act.save()
+utils_bw.update_activity_index(alu_cons_act)
 
 #Tag aluminium ingot production
-aluminum_ingot_act_list = [act for act in bw_db if 'aluminium production, primary, ingot' in act['name'] and 'kilogram' in act['unit']]
+aluminum_ingot_act_list = utils_bw.find_activities(bw_db_name,name_contains='aluminium production, primary, ingot',unit_contains='kilogram')
 for act in aluminum_ingot_act_list:
     act['location_tag'] = act['location']
     act['tag'] = 'Primary Aluminium Ingot production'
     act.save()
+    utils_bw.update_activity_index(act)
 
 #Tag aluminium liquid production    
 act_name = 'aluminium production, primary, liquid'
-act_list = [act for act in bw_db if act_name in act['name'] and 'kilogram' in act['unit']]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name,unit_contains='kilogram')
 for act in act_list:
     act['location_tag'] = act['location']
     act['tag'] = 'Primary Aluminium Liquid production'
     act.save()
+    utils_bw.update_activity_index(act)
     
 #Tag aluminium liquid electricity market    
 act_name = 'market for electricity, medium voltage, aluminium industry'
-act_list = [act for act in bw_db if act_name in act['name']]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name)
 for act in act_list:
     act['location_tag'] = None
     act['tag'] = 'Primary Aluminium Liquid production'
     act.save()
+    utils_bw.update_activity_index(act)
     
 #Tag aluminium liquid electricity market   
 act_name='electricity voltage transformation from high to medium voltage, aluminium industry'
-act_list = [act for act in bw_db if act_name in act['name']]
+act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name)
 for act in act_list:
     act['location_tag'] = None
     act['tag'] = 'Primary Aluminium Liquid production'
     act.save()
+    utils_bw.update_activity_index(act)
     
 #Tag alumina consumption
-alumina_act_list=[act for act in bw_db if "market for consumption of alumina" in act['name'] and 'kilogram' in act['unit']]
+alumina_act_list=utils_bw.find_activities(bw_db_name,name_contains="market for consumption of alumina",unit_contains='kilogram')
 for act in alumina_act_list:
     act['location_tag'] = act['location']
     act['tag'] = 'Alumina consumption'
     act.save()
+    utils_bw.update_activity_index(act)
     
 #Tag alumina production
-alumina_act_list=[act for act in bw_db if "alumina production" in act['name'] and 'kilogram' in act['unit']]
+alumina_act_list=utils_bw.find_activities(bw_db_name,name_contains="alumina production",unit_contains='kilogram')
 for act in alumina_act_list:
     act['location_tag'] = act['location']
     act['tag'] = 'Alumina production'
     act.save()
+    utils_bw.update_activity_index(act)
 
 #Tag bauxite consumption
-act_list=[act for act in bw_db if "market for consumption of bauxite" in act['name'] and 'kilogram' in act['unit']]
+act_list=utils_bw.find_activities(bw_db_name,name_contains="market for consumption of bauxite",unit_contains='kilogram')
 for act in act_list:
     act['location_tag'] = act['location']
     act['tag'] = 'Bauxite consumption'
     act.save()
+    utils_bw.update_activity_index(act)
 
 #Tag bauxite production
-act_list=[act for act in bw_db if "bauxite mine operation" in act['name'] and 'kilogram' in act['unit']]
+act_list=utils_bw.find_activities(bw_db_name,name_contains="bauxite mine operation",unit_contains='kilogram')
 for act in act_list:
     act['location_tag'] = act['location']
     act['tag'] = 'Bauxite production'
-    act.save()
\ No newline at end of file
+    act.save()
+    utils_bw.update_activity_index(act)
\ No newline at end of file
@@ -14,6 +14,8 @@ import brightway2 as bw
 import source.utils_mfa as utils_mfa
 import source.utils_update as utils_update
 import source.utils_brightway as utils_bw
+#Keep the apparent consumption matrices across runs
+utils_mfa.configure_mat_cons_cache(cache_dir='inputs/internal/cache/mat_cons')
 
 # Upload database
 bw.projects.set_current('alu_project') #NOTE: change to the project name in Brightway2
@@ -37,7 +39,7 @@ calculation_setup_list = {'bauxite_production_recipe':'bauxite mine operation',
 
 for calculation_setup_name in calculation_setup_list.keys():
     act_name = calculation_setup_list[calculation_setup_name]
-    act_list = [act for act in bw_db if act_name in act['name'] and  act['location'] in list_ei_country]
+    act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name,location_in=list_ei_country)
     fu_list = [{act:1} for act in act_list]
     bw.calculation_setups[calculation_setup_name] = {'inv':fu_list, 'ia':mining_recipe_method}
 
@@ -50,9 +52,11 @@ list_cty_ein = country_correspondence.loc[:,'ecoinvent_country'].tolist()
 year_list = range(2000,2018)
 mineral_list=['aluminium','alumina','bauxite']
 dtf = pd.DataFrame()
+#Calculate the matrices of all minerals and years in one pass
+mat_cons_dict = utils_mfa.calculate_mat_cons_kastner_years(mineral=mineral_list,year_list=year_list,trade_data_type="reconciliated")
 for mineral in mineral_list:
     for year in year_list:
-        mat_cons =  utils_mfa.calculate_mat_cons_kastner(mineral=mineral,year=year,trade_data_type="reconciliated")
+        mat_cons =  mat_cons_dict[mineral][year]
         #Calculate the production mass by producing countries
         cty_index = np.nonzero(mat_cons.sum(axis=0))[1]
         tmp_dict = {'Country':[list_countries[index] for index in cty_index],
@@ -85,9 +89,10 @@ list_countries = country_correspondence.loc[:,'cty Name English'].tolist()
 list_cty_ein = country_correspondence.loc[:,'ecoinvent_country'].tolist()
 year_list = range(2000,2018)
 dtf = pd.DataFrame()
+mat_cons_dict = utils_mfa.calculate_mat_cons_kastner_years(mineral=['aluminium','alumina'],year_list=year_list,trade_data_type="reconciliated")
 for year in year_list:
     for mineral in ['aluminium','alumina']:
-        mat_cons =  utils_mfa.calculate_mat_cons_kastner(mineral=mineral,year=year,trade_data_type="reconciliated")
+        mat_cons =  mat_cons_dict[mineral][year]
         #Calculate the producing countries with the lowest independant ratio
         prod_cty_index = np.flatnonzero(mat_cons.diagonal()).tolist()
         tmp_dict = {'Country':[list_countries[index] for index in prod_cty_index],
@@ -108,7 +113,7 @@ Calculate impact factors for selected ReCiPe midpoints of alumina production and
 country_correspondence = pd.read_csv('inputs/country_correspondence.csv')
 list_countries = country_correspondence.loc[:,'cty Name English'].tolist()
 year=2017
-mat_cons =  utils_mfa.calculate_mat_cons_kastner(mineral='aluminium',year=year,trade_data_type="reconciliated")
+mat_cons =  utils_mfa.get_mat_cons(mineral='aluminium',year=year,trade_data_type="reconciliated")
 #Get the top list of consuming countries
 country_list = [country_correspondence.loc[country_correspondence['cty Name English']==list_countries[index],'ecoinvent_country'].values[0] for index in np.argsort(mat_cons.sum(axis=1).A1,axis=0)[-21:].tolist() if str(country_correspondence.loc[country_correspondence['cty Name English']==list_countries[index],'ecoinvent_country'].values[0])!='nan']
 
@@ -117,10 +122,7 @@ multilca_list = ['alumina_production_recipe','alumina_consumption_recipe','alumi
 #Output
 lca_df = pd.DataFrame()
 for year in year_list:
-    utils_update.dbUpdate_ElecAluLiq(bw_db_name=bw_db_name,year=year)
-    utils_update.dbUpdate_EnerAlumina(bw_db_name=bw_db_name,year=year)
-    utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='bauxite')
-    utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='alumina')
+    utils_update.dbUpdate_year(bw_db_name=bw_db_name,year=year,mineral_list=['bauxite','alumina'])
     for calculation_setup_name in multilca_list:
         MultiLCA = bw.MultiLCA(calculation_setup_name)
         temp_dt = utils_bw.get_multilca_to_dataframe(MultiLCA)
@@ -130,6 +132,7 @@ for year in year_list:
         alu_cons_act = bw_db.get('market for consumption of aluminium')
         alu_cons_act['location'] = country
         alu_cons_act.save()
+        utils_bw.update_activity_index(alu_cons_act)
         utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='aluminium')
         bw.calculation_setups['aluminium_consumption_recipe']['inv'] = [{alu_cons_act:1}]
         MultiLCA = bw.MultiLCA('aluminium_consumption_recipe')
@@ -148,31 +151,34 @@ Impact Factors: Errors caused by use of globalized or localized alumina processe
 '''
 year_list = range(2000,2018)
 lca_df = pd.DataFrame()
+#The scenarios are calculated in memory from the matrices of the database. Each scenario keeps the updates of the previous ones, as if they were saved in the database
+scenario_base = utils_bw.build_scenario_base('aluminium_ingot_production_recipe')
+scenario_list = []
+scenario_info_list = []
+exc_update_list = []
 for year in year_list:
     print(year)
-    utils_update.dbUpdate_ElecAluLiq(bw_db_name=bw_db_name,year=year)
-    utils_update.dbUpdate_EnerAlumina(bw_db_name=bw_db_name,year=year)
+    exc_update_list = exc_update_list + utils_update.get_year_updates(bw_db_name,year,mineral_list=[])
     #Calculate the impact factors in case of globalized alumina processes
-    utils_update.dbUpdate_globalize(bw_db_name=bw_db_name,stage_to_globalize=['alumina'])
-    MultiLCA = bw.MultiLCA('aluminium_ingot_production_recipe')
-    temp_dt = utils_bw.get_multilca_to_dataframe(MultiLCA)
-    temp_dt['Year'] = year
-    temp_dt['Type'] = 'globalized_for_alumina'
-    lca_df = lca_df.append(temp_dt,ignore_index=True)
+    exc_update_list = exc_update_list + utils_update.get_localize_updates(bw_db_name,mineral_list=['alumina'],localized_prod='GLO')
+    scenario_list.append(exc_update_list)
+    scenario_info_list.append((year,'globalized_for_alumina'))
     #Calculate the production-based IF with production-based alumina
-    utils_update.dbUpdate_localize(bw_db_name=bw_db_name)
-    MultiLCA = bw.MultiLCA('aluminium_ingot_production_recipe')
-    temp_dt = utils_bw.get_multilca_to_dataframe(MultiLCA)
-    temp_dt['Year'] = year
-    temp_dt['Type'] = 'localized_for_alumina'
-    lca_df = lca_df.append(temp_dt,ignore_index=True)
+    exc_update_list = exc_update_list + utils_update.get_localize_updates(bw_db_name)
+    scenario_list.append(exc_update_list)
+    scenario_info_list.append((year,'localized_for_alumina'))
     #Calculate the impact factors in regionalized case. First only alumina, then with aluminum
-    utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='bauxite')
-    utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='alumina')
-    MultiLCA = bw.MultiLCA('aluminium_ingot_production_recipe')
-    temp_dt = utils_bw.get_multilca_to_dataframe(MultiLCA)
+    exc_update_list = exc_update_list + utils_update.get_cons_mix_updates(bw_db_name,year,'bauxite')+utils_update.get_cons_mix_updates(bw_db_name,year,'alumina')
+    scenario_list.append(exc_update_list)
+    scenario_info_list.append((year,'default'))
+#The script has no __main__ guard, so the scenarios are calculated in the current process (worker processes would run the script again on Windows)
+results_list = utils_bw.calculate_scenario_lca(scenario_base,scenario_list,max_workers=1)
+#The scenarios are not saved in the database. Save the last one, so the following sections start from the same database as before.
+utils_bw.update_exchanges(bw_db_name,exc_update_list)
+for (year,scenario_type),results in zip(scenario_info_list,results_list):
+    temp_dt = utils_bw.get_lca_results_to_dataframe(scenario_base['func_units'],scenario_base['methods'],results)
     temp_dt['Year'] = year
-    temp_dt['Type'] = 'default'
+    temp_dt['Type'] = scenario_type
     lca_df = lca_df.append(temp_dt,ignore_index=True)
 lca_df.to_csv('outputs/if_with_errors_aluminium.csv',index=False)
 
@@ -183,22 +189,21 @@ Sensitivity analysis of trade data on impact factors of primary aluminum ingot
 country_correspondence = pd.read_csv('inputs/country_correspondence.csv')
 list_countries = country_correspondence.loc[:,'cty Name English'].tolist()
 year=2017
-mat_cons =  utils_mfa.calculate_mat_cons_kastner(mineral='aluminium',year=year,trade_data_type="reconciliated")
+mat_cons =  utils_mfa.get_mat_cons(mineral='aluminium',year=year,trade_data_type="reconciliated")
 #Get the top 20 consuming countries
 country_list = [country_correspondence.loc[country_correspondence['cty Name English']==list_countries[index],'ecoinvent_country'].values[0] for index in np.argsort(mat_cons.sum(axis=1).A1,axis=0)[-21:].tolist() if str(country_correspondence.loc[country_correspondence['cty Name English']==list_countries[index],'ecoinvent_country'].values[0])!='nan']
 year_list = [2000,2017]
 #Output
 lca_df = pd.DataFrame()
 for year in year_list:
-    utils_update.dbUpdate_ElecAluLiq(bw_db_name=bw_db_name,year=year)
-    utils_update.dbUpdate_EnerAlumina(bw_db_name=bw_db_name,year=year)
+    utils_update.dbUpdate_year(bw_db_name=bw_db_name,year=year,mineral_list=[])
     for trade_data_type in ["imports","exports","reconciliated"]:
-        utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='bauxite',trade_data_type=trade_data_type)
-        utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='alumina',trade_data_type=trade_data_type)
+        utils_update.dbUpdate_year(bw_db_name=bw_db_name,year=year,mineral_list=['bauxite','alumina'],trade_data_type=trade_data_type)
         for country in country_list:
             alu_cons_act = bw_db.get('market for consumption of aluminium')
             alu_cons_act['location'] = country
             alu_cons_act.save()
+            utils_bw.update_activity_index(alu_cons_act)
             utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='aluminium',trade_data_type=trade_data_type)
             bw.calculation_setups['aluminium_consumption_recipe']['inv'] = [{alu_cons_act:1}]
             MultiLCA = bw.MultiLCA('aluminium_consumption_recipe')
@@ -215,7 +220,7 @@ Sensitivity analysis of apparent consumption model on impact factors of primary
 country_correspondence = pd.read_csv('inputs/country_correspondence.csv')
 list_countries = country_correspondence.loc[:,'cty Name English'].tolist()
 year=2017
-mat_cons =  utils_mfa.calculate_mat_cons_kastner(mineral='aluminium',year=year,trade_data_type="reconciliated")
+mat_cons =  utils_mfa.get_mat_cons(mineral='aluminium',year=year,trade_data_type="reconciliated")
 #Get the top 20 consuming countries
 country_list = [country_correspondence.loc[country_correspondence['cty Name English']==list_countries[index],'ecoinvent_country'].values[0] for index in np.argsort(mat_cons.sum(axis=1).A1,axis=0)[-21:].tolist() if str(country_correspondence.loc[country_correspondence['cty Name English']==list_countries[index],'ecoinvent_country'].values[0])!='nan']
 
@@ -223,15 +228,14 @@ year_list = [2000,2017]
 #Output
 lca_df = pd.DataFrame()
 for year in year_list:
-    utils_update.dbUpdate_ElecAluLiq(bw_db_name=bw_db_name,year=year)
-    utils_update.dbUpdate_EnerAlumina(bw_db_name=bw_db_name,year=year)
+    utils_update.dbUpdate_year(bw_db_name=bw_db_name,year=year,mineral_list=[])
     for adj_model in ["kastner","no"]:
-        utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='bauxite',adjustment=adj_model)
-        utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='alumina',adjustment=adj_model)
+        utils_update.dbUpdate_year(bw_db_name=bw_db_name,year=year,mineral_list=['bauxite','alumina'],adjustment=adj_model)
         for country in country_list:
             alu_cons_act = bw_db.get('market for consumption of aluminium')
             alu_cons_act['location'] = country
             alu_cons_act.save()
+            utils_bw.update_activity_index(alu_cons_act)
             utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='aluminium',adjustment=adj_model)
             bw.calculation_setups['aluminium_consumption_recipe']['inv'] = [{alu_cons_act:1}]
             MultiLCA = bw.MultiLCA('aluminium_consumption_recipe')
@@ -253,10 +257,7 @@ product_system_depth=4
 contribution_df = pd.DataFrame()
 for year in year_list:
     print(year)
-    utils_update.dbUpdate_ElecAluLiq(bw_db_name=bw_db_name,year=year)
-    utils_update.dbUpdate_EnerAlumina(bw_db_name=bw_db_name,year=year)
-    utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='bauxite')
-    utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='alumina')
+    utils_update.dbUpdate_year(bw_db_name=bw_db_name,year=year,mineral_list=['bauxite','alumina'])
     for act in act_list:
         for method in mining_recipe_method:
             Method = bw.Method(method)
@@ -285,10 +286,7 @@ product_system_depth = 5
 contribution_df = pd.DataFrame()
 for year in year_list:
     print(year)
-    utils_update.dbUpdate_ElecAluLiq(bw_db_name=bw_db_name,year=year)
-    utils_update.dbUpdate_EnerAlumina(bw_db_name=bw_db_name,year=year)
-    utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='bauxite')
-    utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='alumina')
+    utils_update.dbUpdate_year(bw_db_name=bw_db_name,year=year,mineral_list=['bauxite','alumina'])
     utils_update.dbUpdate_aluminum_global_production(bw_db_name=bw_db_name,year=year)
     for method in mining_recipe_method:
         Method = bw.Method(method)
@@ -317,10 +315,7 @@ product_system_depth = 6
 contribution_df = pd.DataFrame()
 for year in year_list:
     print(year)
-    utils_update.dbUpdate_ElecAluLiq(bw_db_name=bw_db_name,year=year)
-    utils_update.dbUpdate_EnerAlumina(bw_db_name=bw_db_name,year=year)
-    utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='bauxite')
-    utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='alumina')
+    utils_update.dbUpdate_year(bw_db_name=bw_db_name,year=year,mineral_list=['bauxite','alumina'])
     utils_update.dbUpdate_aluminum_global_production(bw_db_name=bw_db_name,year=year)
     for method in mining_recipe_method:
         Method = bw.Method(method)
@@ -409,10 +404,7 @@ act_contribution_df = pd.DataFrame()
 emi_contribution_dt = pd.DataFrame()
 for year in year_list:
     print(year)
-    utils_update.dbUpdate_ElecAluLiq(bw_db_name=bw_db_name,year=year)
-    utils_update.dbUpdate_EnerAlumina(bw_db_name=bw_db_name,year=year)
-    utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='bauxite')
-    utils_update.dbUpdate_cons_mix(bw_db_name=bw_db_name,year=year,mineral='alumina')
+    utils_update.dbUpdate_year(bw_db_name=bw_db_name,year=year,mineral_list=['bauxite','alumina'])
     utils_update.dbUpdate_aluminum_global_production(bw_db_name=bw_db_name,year=year)
     for method in mining_recipe_method:
         Method = bw.Method(method)
@@ -460,7 +452,7 @@ dtf=pd.DataFrame()
 for year in year_list:
     for mineral in mineral_list:
         #Get matrix of apparent consumption
-        mat_cons =  utils_mfa.calculate_mat_cons_kastner(year=year,mineral=mineral,trade_data_type="reconciliated")
+        mat_cons =  utils_mfa.get_mat_cons(year=year,mineral=mineral,trade_data_type="reconciliated")
         rel_mat_cons = mat_cons/mat_cons.sum()
         for row in np.where(rel_mat_cons.sum(axis=1)!=0)[0]:
             for col in np.where((rel_mat_cons[row,]!=0).toarray()[0])[0]:
@@ -9,16 +9,280 @@ import brightway2 as bw
 from bw2data import get_activity
 from bw2data import Method
 from bw2calc import LCA
+from bw2data.backends.peewee import ActivityDataset, ExchangeDataset, sqlite3_lci_db
+from peewee import fn
 import pandas as pd
 from collections import defaultdict
+import collections
+import hashlib
 import numpy as np
+import concurrent.futures
+from scipy import sparse
+from scipy.sparse import linalg
+
+#Activity indexes by database name (see build_activity_index)
+_activity_index_dict = {}
+#Maximum number of activity codes per SQLite query (SQLite limits the number of variables of a query)
+_sqlite_batch_size = 500
+#Number of modifications of the databases registered in the session, by database name (see set_database_modified)
+_database_version_dict = defaultdict(int)
+#LU factorizations of technosphere matrices by checksum of the matrix (see get_technosphere_lu). The least recently used factorizations are evicted first.
+_technosphere_lu_cache = collections.OrderedDict()
+_technosphere_lu_cache_size = 4
+
+def set_database_modified(bw_db_name):
+    '''
+    Register a modification of a database (activities or exchanges saved or deleted). The scenarios in effect in the database are forgotten (see utils_update.get_applied_scenario).
+    Called by update_exchanges, update_activity_index and invalidate_activity_index. To call after exc.save() or exc.delete() when update_activity_index is not called afterwards.
+    '''
+    _database_version_dict[bw_db_name] += 1
+    return
+
+def get_database_version(bw_db_name):
+    '''
+    Return the number of modifications of a database registered in the session (see set_database_modified)
+    '''
+    return _database_version_dict[bw_db_name]
+
+def get_activity_index_signature(bw_db_name):
+    '''
+    Return the number of activities and the highest activity id of a database. The signature changes when activities are created or deleted, except when a deletion and a creation leave both unchanged (ids of deleted activities can be reused).
+    Activity deletions must therefore be registered with invalidate_activity_index.
+    '''
+    return tuple(ActivityDataset.select(fn.COUNT(ActivityDataset.id),fn.MAX(ActivityDataset.id)).where(ActivityDataset.database==bw_db_name).tuples().get())
+
+def build_activity_index(bw_db_name):
+    '''
+    Build the in-memory index of the activities of a Brightway database in one pass over the database
+    Attributes:
+        bw_db_name is the name of the Brightway database
+    Output:
+        activity_index is a dictionnary with
+            'data': {key:{'name','location','unit','code'}} in the order of the database
+            'position': {key:position in the database}
+            'name', 'location', 'name_location': {name:[keys]}, {location:[keys]}, {(name,location):[keys]}
+            'code': {code:key}
+            'signature': signature of the database when the index was built (see get_activity_index_signature)
+    '''
+    activity_index = {"data":{},
+                      "position":{},
+                      "name":defaultdict(list),
+                      "location":defaultdict(list),
+                      "name_location":defaultdict(list),
+                      "code":{},
+                      "signature":get_activity_index_signature(bw_db_name)}
+    for act in bw.Database(bw_db_name):
+        add_activity_index(activity_index,act)
+    _activity_index_dict[bw_db_name] = activity_index
+    return activity_index
+
+def add_activity_index(activity_index,act):
+    '''
+    Add an activity in an activity index (see build_activity_index)
+    '''
+    key = act.key
+    activity_index["data"][key] = {"name":act.get('name'),"location":act.get('location'),"unit":act.get('unit'),"code":act['code']}
+    activity_index["position"].setdefault(key,len(activity_index["position"]))
+    activity_index["name"][act.get('name')].append(key)
+    activity_index["location"][act.get('location')].append(key)
+    activity_index["name_location"][(act.get('name'),act.get('location'))].append(key)
+    activity_index["code"][act['code']] = key
+    return
+
+def remove_activity_index(activity_index,key):
+    '''
+    Remove an activity from an activity index (see build_activity_index). The position of the activity is kept.
+    '''
+    if key not in activity_index["data"]:
+        return
+    data = activity_index["data"].pop(key)
+    activity_index["name"][data["name"]].remove(key)
+    activity_index["location"][data["location"]].remove(key)
+    activity_index["name_location"][(data["name"],data["location"])].remove(key)
+    activity_index["code"].pop(data["code"],None)
+    return
+
+def get_activity_index(bw_db_name):
+    '''
+    Return the activity index of a database (see build_activity_index)
+    The index is built the first time, and built again when activities have been created or deleted since (see get_activity_index_signature).
+    All writes must be registered: update_activity_index after act.save(), invalidate_activity_index after act.delete().
+    '''
+    activity_index = _activity_index_dict.get(bw_db_name)
+    if activity_index==None or activity_index["signature"]!=get_activity_index_signature(bw_db_name):
+        activity_index = build_activity_index(bw_db_name)
+    return activity_index
+
+def update_activity_index(act):
+    '''
+    Update the activity index after the creation or the modification (name, location, unit) of an activity. To call after act.save().
+    The modification of the database is also registered (see set_database_modified).
+    '''
+    set_database_modified(act['database'])
+    activity_index = _activity_index_dict.get(act['database'])
+    if activity_index!=None:
+        remove_activity_index(activity_index,act.key)
+        add_activity_index(activity_index,act)
+        activity_index["signature"] = get_activity_index_signature(act['database'])
+    return
+
+def invalidate_activity_index(bw_db_name=None):
+    '''
+    Delete the activity index of a database (all databases if None). The index is built again at the next search. To call after act.delete().
+    The modification of the database is also registered (see set_database_modified).
+    '''
+    if bw_db_name==None:
+        _activity_index_dict.clear()
+    else:
+        set_database_modified(bw_db_name)
+        _activity_index_dict.pop(bw_db_name,None)
+    return
+
+def find_activities(bw_db_name,name=None,name_contains=None,name_not_contains=None,location=None,location_contains=None,location_not_contains=None,location_in=None,unit_contains=None,code=None,as_key=False):
+    '''
+    Return the activities of a database matching all the given criteria, in the order of the database, from the activity index (see get_activity_index)
+    Exact name, exact location and code are direct lookups. The other criteria filter the activities found.
+    Attributes:
+        bw_db_name is the name of the Brightway database
+        name is the exact name of the activities
+        name_contains is a string (or list of strings) contained in the name
+        name_not_contains is a string (or list of strings) not contained in the name
+        location is the exact location
+        location_contains is a string contained in the location (same as: location_contains in act['location'])
+        location_not_contains is a string not contained in the location
+        location_in is a list of locations
+        unit_contains is a string contained in the unit
+        code is the code of the activity
+        as_key specifies if the keys are returned instead of the activities
+    Output:
+        act_list is the list of activities (or keys)
+    '''
+    activity_index = get_activity_index(bw_db_name)
+    if isinstance(name_contains,str):
+        name_contains = [name_contains]
+    if isinstance(name_not_contains,str):
+        name_not_contains = [name_not_contains]
+    #Candidates from the direct lookups
+    if code!=None:
+        key_list = [activity_index["code"][code]] if code in activity_index["code"] else []
+    elif name!=None and location!=None:
+        key_list = activity_index["name_location"].get((name,location),[])
+    elif name!=None:
+        key_list = activity_index["name"].get(name,[])
+    elif location!=None:
+        key_list = activity_index["location"].get(location,[])
+    elif name_contains!=None:
+        key_list = [key for temp_name,temp_key_list in activity_index["name"].items() if temp_name!=None and all(keyword in temp_name for keyword in name_contains) for key in temp_key_list]
+    else:
+        key_list = list(activity_index["data"].keys())
+    #Filter the candidates
+    key_list = [key for key in key_list if match_activity_index(activity_index["data"][key],name,name_contains,name_not_contains,location,location_contains,location_not_contains,location_in,unit_contains)]
+    key_list = sorted(key_list,key=activity_index["position"].get)
+    if as_key:
+        return key_list
+    return [get_activity(key) for key in key_list]
+
+def match_activity_index(data,name,name_contains,name_not_contains,location,location_contains,location_not_contains,location_in,unit_contains):
+    '''
+    Check if the data of an activity index match the criteria of find_activities
+    '''
+    if name!=None and data["name"]!=name:
+        return False
+    if name_contains!=None and not all(keyword in (data["name"] or '') for keyword in name_contains):
+        return False
+    if name_not_contains!=None and any(keyword in (data["name"] or '') for keyword in name_not_contains):
+        return False
+    if location!=None and data["location"]!=location:
+        return False
+    if location_contains!=None and location_contains not in (data["location"] or ''):
+        return False
+    if location_not_contains!=None and location_not_contains in (data["location"] or ''):
+        return False
+    if location_in!=None and data["location"] not in location_in:
+        return False
+    if unit_contains!=None and unit_contains not in (data["unit"] or ''):
+        return False
+    return True
+
+def update_exchanges(bw_db_name,exc_update_list,process=True):
+    '''
+    Update the amount of exchanges of a database in one transaction, then process the database once.
+    Replaces one exc.save() per exchange, which writes and marks the database as modified each time.
+    Attributes:
+        bw_db_name is the name of the Brightway database to update
+        exc_update_list is a list of (output key, input key, amount) tuples. The output is the activity consuming the input.
+            All the technosphere exchanges between the output and the input are updated. Production and substitution exchanges are not modified. If a pair is given several times, the last amount is kept.
+        process specifies if the database is processed after the update. Otherwise, it is processed before the next calculation.
+    Output:
+        nb_exc is the number of exchanges which amount changed. Exchanges with the same amount are not written. If none changed, the database is not modified.
+    '''
+    amount_dict = {(tuple(output_key),tuple(input_key)):amount for output_key,input_key,amount in exc_update_list}
+    if len(amount_dict)==0:
+        return 0
+    if any(output_key[0]!=bw_db_name for output_key,input_key in amount_dict.keys()):
+        raise ValueError("Exchanges to update must be outputs of database {bw_db_name}".format(bw_db_name=bw_db_name))
+    output_code_list = sorted(set([output_key[1] for output_key,input_key in amount_dict.keys()]))
+    found_set = set()
+    nb_exc = 0
+    #Write all exchanges in one transaction. The transaction is cancelled if an exchange is missing
+    with sqlite3_lci_db.atomic():
+        for index in range(0,len(output_code_list),_sqlite_batch_size):
+            exc_query = ExchangeDataset.select().where((ExchangeDataset.output_database==bw_db_name) & (ExchangeDataset.output_code.in_(output_code_list[index:index+_sqlite_batch_size])) & (ExchangeDataset.type=='technosphere'))
+            for exc_row in exc_query:
+                exc_key = ((exc_row.output_database,exc_row.output_code),(exc_row.input_database,exc_row.input_code))
+                if exc_key in amount_dict:
+                    found_set.add(exc_key)
+                    #Only write the exchanges which amount changes
+                    if exc_row.data.get('amount')!=amount_dict[exc_key]:
+                        exc_row.data['amount'] = amount_dict[exc_key]
+                        exc_row.save()
+                        nb_exc = nb_exc+1
+        missing_list = [exc_key for exc_key in amount_dict.keys() if exc_key not in found_set]
+        if len(missing_list)>0:
+            raise KeyError("No technosphere exchange between output and input: {missing}".format(missing=missing_list[:10]))
+    #Nothing changed, the database stays as processed
+    if nb_exc==0:
+        return nb_exc
+    #Mark the database as modified once, and process it once
+    set_database_modified(bw_db_name)
+    bw.databases.set_dirty(bw_db_name)
+    if process:
+        bw.databases.clean()
+    return nb_exc
    
 def redo_lca_score(lca,new_fu):
         lca.redo_lcia(new_fu)
         return lca.score
 
+def get_technosphere_lu(mat_techno):
+    '''
+    Return the LU factorization (scipy.sparse.linalg.splu) of a technosphere matrix. The factorization is calculated once per technosphere matrix (see _technosphere_lu_cache).
+    '''
+    mat_techno = sparse.csc_matrix(mat_techno)
+    mat_techno.sort_indices()
+    lu_key = hashlib.sha1(mat_techno.indptr.tobytes()+mat_techno.indices.tobytes()+mat_techno.data.tobytes()).hexdigest()
+    if lu_key not in _technosphere_lu_cache:
+        _technosphere_lu_cache[lu_key] = linalg.splu(mat_techno)
+        while len(_technosphere_lu_cache)>_technosphere_lu_cache_size:
+            _technosphere_lu_cache.popitem(last=False)
+    _technosphere_lu_cache.move_to_end(lu_key)
+    return _technosphere_lu_cache[lu_key]
+
+def get_unit_scores(lca):
+    '''
+    Return the LCIA score of one unit of each product of an LCA already calculated (LCI and LCIA), from one solve of the transposed technosphere matrix
+    The factorization of the LCA is used if available (lca.lci(factorize=True)). Otherwise, the technosphere matrix is factorized once for all methods and functional units (see get_technosphere_lu).
+    The score of the demand {activity:amount} is amount*unit_score_array[lca.product_dict[activity.key]], same as redo_lca_score(lca,{activity:amount})
+    '''
+    cf_array = lca.biosphere_matrix.T.dot(lca.characterization_matrix.diagonal())
+    #The solver of bw2calc is the solve method of a SuperLU object when UMFPACK is not installed. It can solve the transposed system.
+    solver = getattr(lca,"solver",None)
+    if isinstance(getattr(solver,"__self__",None),linalg.SuperLU):
+        return solver(cf_array,trans="T")
+    return get_technosphere_lu(lca.technosphere_matrix).solve(cf_array,trans="T")
+
 #Copy from bw package. Adapted to make it work.
-def recurse_tagged_database(activity, amount, method_dict, lca, label, default_tag, secondary_tag=(None,None),product_system_depth=5):
+def recurse_tagged_database(activity, amount, method_dict, lca, label, default_tag, secondary_tag=(None,None),product_system_depth=5,unit_score_array=None):
     '''Traverse a foreground database and assess activities and biosphere flows by tags.
 
     Input arguments:
@@ -30,6 +294,7 @@ def recurse_tagged_database(activity, amount, method_dict, lca, label, default_t
         * ``label``: string
         * ``default_tag``: string
         * ``secondary_tag``: Tuple in the format (secondary_label, secondary_default_tag). Default is empty tuple.
+        * ``unit_score_array``: Scores of one unit of each product of ``lca`` (see get_unit_scores). If None, the score of each activity without label is calculated with redo_lca_score.
 
     Returns:
 
@@ -69,7 +334,7 @@ def recurse_tagged_database(activity, amount, method_dict, lca, label, default_t
                 'secondary_tag':exc.get(secondary_tag[0]) or activity.get(secondary_tag[0]) or secondary_tag[1]
             } for exc in activity.biosphere()],
             'technosphere': [recurse_tagged_database(exc.input, exc['amount'] * amount,
-                                                     method_dict, lca, label,exc.get(label) or activity.get(label) or default_tag, (secondary_tag[0],exc.get(secondary_tag[0]) or activity.get(secondary_tag[0]) or secondary_tag[1]),product_system_depth=product_system_depth-1)
+                                                     method_dict, lca, label,exc.get(label) or activity.get(label) or default_tag, (secondary_tag[0],exc.get(secondary_tag[0]) or activity.get(secondary_tag[0]) or secondary_tag[1]),product_system_depth=product_system_depth-1,unit_score_array=unit_score_array)
                              for exc in inputs]
         }
     else:
@@ -78,7 +343,7 @@ def recurse_tagged_database(activity, amount, method_dict, lca, label, default_t
             'amount': amount,
             'tag': activity.get(label) or default_tag,
             'secondary_tag':activity.get(secondary_tag[0]) or secondary_tag[1],
-            'impact': redo_lca_score(lca,{activity:amount}),
+            'impact': redo_lca_score(lca,{activity:amount}) if unit_score_array is None else amount*unit_score_array[lca.product_dict[activity.key]],
             'biosphere': [],
             'technosphere': []
         }
@@ -115,7 +380,109 @@ def aggregate_tagged_graph(graph):
         scores = recursor(obj, scores)
     return scores
 
-def traverse_tagged_databases_to_dataframe(functional_unit, method, label="tag",default_tag="other", secondary_tag=(None,None),product_system_depth=5):
+def get_tagged_foreground_matrices(functional_unit, method_dict, lca, label, default_tag, secondary_tag=(None,None), unit_score_array=None):
+    '''
+    Build the matrices of the tagged foreground of a functional unit, with the same tagging rules as recurse_tagged_database (see aggregate_tagged_foreground)
+    The foreground is explored once, breadth first. A state is a tagged activity with the tags it inherits from its supply chain when it has none: (activity key, inherited tag, inherited secondary tag).
+    Attributes:
+        functional_unit, method_dict, lca, label, default_tag, secondary_tag are the same as in recurse_tagged_database
+        unit_score_array are the scores of one unit of each product of lca (see get_unit_scores). Calculated if None.
+    Output:
+        mat_foreground is the matrix of inputs between states. mat_foreground(i,j) is the input of state i per unit of state j
+        vec_demand is the demand of the states by the functional unit
+        mat_contribution is the impact per unit of state by tag: biosphere flows of the tagged activity and scores of its untagged inputs. Rows are the tags, columns are the states
+        vec_direct is the impact of the untagged activities of the functional unit by tag
+        tag_list is the list of tags (tag, secondary tag), in order of appearance
+    '''
+    if unit_score_array is None:
+        unit_score_array = get_unit_scores(lca)
+    secondary_label,secondary_default_tag = secondary_tag
+    state_index_dict = {}
+    state_list = []
+    tag_index_dict = {}
+    demand_dict = defaultdict(float)
+    direct_dict = defaultdict(float)
+    foreground_list = []
+    contribution_list = []
+    def get_tag_index(tag,secondary):
+        if (tag,secondary) not in tag_index_dict:
+            tag_index_dict[(tag,secondary)] = len(tag_index_dict)
+        return tag_index_dict[(tag,secondary)]
+    def get_state_index(activity,inherited_tag,inherited_secondary_tag):
+        tag = activity.get(label) or inherited_tag
+        secondary = activity.get(secondary_label) or inherited_secondary_tag
+        #The inherited tags are only part of the state if the activity has no tag
+        state = (activity.key,None if activity.get(label) else inherited_tag,None if activity.get(secondary_label) else inherited_secondary_tag)
+        if state not in state_index_dict:
+            state_index_dict[state] = len(state_list)
+            state_list.append((activity,tag,secondary))
+            #Tagged activities appear in the tags, even without impact
+            contribution_list.append((get_tag_index(tag,secondary),state_index_dict[state],0))
+        return state_index_dict[state]
+    #Functional unit
+    for key,amount in functional_unit.items():
+        activity = get_activity(key) if isinstance(key, tuple) else key
+        if activity.get(label)!=None:
+            demand_dict[get_state_index(activity,default_tag,secondary_default_tag)] += amount
+        else:
+            tag_index = get_tag_index(activity.get(label) or default_tag,activity.get(secondary_label) or secondary_default_tag)
+            direct_dict[tag_index] += amount*unit_score_array[lca.product_dict[activity.key]]
+    #Explore the states breadth first. Each activity is read once per state.
+    state_index = 0
+    while state_index<len(state_list):
+        activity,tag,secondary = state_list[state_index]
+        for exc in activity.biosphere():
+            #Flows are aggregated by secondary tag only if the activity has a secondary tag (see aggregate_tagged_graph)
+            exc_secondary = (exc.get(secondary_label) or secondary) if secondary!=None else None
+            contribution_list.append((get_tag_index(exc.get(label) or tag,exc_secondary),state_index,exc['amount']*method_dict.get(exc['input'], 0)))
+        for exc in activity.technosphere():
+            input_activity = exc.input
+            input_tag = exc.get(label) or tag
+            input_secondary = exc.get(secondary_label) or secondary
+            if input_activity.get(label)!=None:
+                foreground_list.append((get_state_index(input_activity,input_tag,input_secondary),state_index,exc['amount']))
+            else:
+                tag_index = get_tag_index(input_tag,input_activity.get(secondary_label) or input_secondary)
+                contribution_list.append((tag_index,state_index,exc['amount']*unit_score_array[lca.product_dict[input_activity.key]]))
+        state_index = state_index+1
+    nb_state = len(state_list)
+    nb_tag = len(tag_index_dict)
+    mat_foreground = sparse.csc_matrix(([value for row,col,value in foreground_list],([row for row,col,value in foreground_list],[col for row,col,value in foreground_list])),shape=(nb_state,nb_state))
+    mat_contribution = sparse.csc_matrix(([value for row,col,value in contribution_list],([row for row,col,value in contribution_list],[col for row,col,value in contribution_list])),shape=(nb_tag,nb_state))
+    vec_demand = np.zeros(nb_state)
+    for index,amount in demand_dict.items():
+        vec_demand[index] = amount
+    vec_direct = np.zeros(nb_tag)
+    for index,impact in direct_dict.items():
+        vec_direct[index] = impact
+    tag_list = sorted(tag_index_dict.keys(),key=tag_index_dict.get)
+    return mat_foreground,vec_demand,mat_contribution,vec_direct,tag_list
+
+def aggregate_tagged_foreground(functional_unit, method_dict, lca, label, default_tag, secondary_tag=(None,None), unit_score_array=None):
+    '''
+    Aggregate the impacts of a functional unit by tags with sparse linear algebra, as an alternative to recurse_tagged_database and aggregate_tagged_graph
+    The supply of the tagged activities is the solution of (I-mat_foreground)*supply = vec_demand (see get_tagged_foreground_matrices), without limit of depth of the product system.
+    The impacts by tag are mat_contribution*supply + vec_direct.
+    Output:
+        scores is a dictionary of tags with the same format as aggregate_tagged_graph
+    '''
+    mat_foreground,vec_demand,mat_contribution,vec_direct,tag_list = get_tagged_foreground_matrices(functional_unit, method_dict, lca, label, default_tag, secondary_tag, unit_score_array)
+    if len(vec_demand)>0:
+        vec_supply = linalg.spsolve(sparse.identity(len(vec_demand),format='csc')-mat_foreground,vec_demand)
+        vec_impact = mat_contribution.dot(np.atleast_1d(vec_supply))+vec_direct
+    else:
+        vec_impact = vec_direct
+    scores = defaultdict(int)
+    for (tag,secondary),impact in zip(tag_list,vec_impact):
+        if secondary!=None:
+            if type(scores[tag]) is int:
+                scores[tag] = defaultdict(int)
+            scores[tag][secondary] += impact
+        else:
+            scores[tag] += impact
+    return scores
+
+def traverse_tagged_databases_to_dataframe(functional_unit, method, label="tag",default_tag="other", secondary_tag=(None,None),product_system_depth=5,mode="recursive"):
     """Traverse a functional unit throughout its foreground database(s), and
     group impacts by tag label.
     
@@ -125,6 +492,7 @@ def traverse_tagged_databases_to_dataframe(functional_unit, method, label="tag",
         * ``label``: The label of the tag classifier. Default is ``"tag"``
         * ``default_tag``: The tag classifier to use if none was given. Default is ``"other"``
         * ``secondary_tags``: List of tuples in the format (secondary_label, secondary_default_tag). Default is empty list.
+        * ``mode``: ``"recursive"`` (recurse_tagged_database, up to ``product_system_depth``) or ``"matrix"`` (aggregate_tagged_foreground, whole tagged foreground, ``product_system_depth`` is not used)
 
     Returns:
 
@@ -135,9 +503,16 @@ def traverse_tagged_databases_to_dataframe(functional_unit, method, label="tag",
     lca.lci(factorize=True)
     lca.lcia()
     method_dict = {o[0]: o[1] for o in Method(method).load()}
-    graph = [recurse_tagged_database(key, amount, method_dict, lca, label, default_tag, secondary_tag, product_system_depth)
-             for key, amount in functional_unit.items()]
-    agg_graph = aggregate_tagged_graph(graph)
+    #Scores of all the activities without label from one solve
+    unit_score_array = get_unit_scores(lca)
+    if mode=="recursive":
+        graph = [recurse_tagged_database(key, amount, method_dict, lca, label, default_tag, secondary_tag, product_system_depth, unit_score_array)
+                 for key, amount in functional_unit.items()]
+        agg_graph = aggregate_tagged_graph(graph)
+    elif mode=="matrix":
+        agg_graph = aggregate_tagged_foreground(functional_unit, method_dict, lca, label, default_tag, secondary_tag, unit_score_array)
+    else:
+        raise ValueError("Unknown mode: {mode}".format(mode=mode))
     if secondary_tag==(None,None):
         dtf = pd.Series(agg_graph,name='Score')
         dtf.index.name = label
@@ -161,24 +536,153 @@ def get_multilca_to_dataframe(MultiLCA):
     Input arguments:
         *``MultiLCA``: a MultiLCA object already calculated
     
+    Returns:
+        *Return a long dataframe. Columns: ('Database', 'Code', 'Name', 'Location', 'Unit', 'Amount_fu','Method_name','Midpoint','Midpoint_abb','Score')
+    '''
+    return get_lca_results_to_dataframe(MultiLCA.func_units,MultiLCA.methods,MultiLCA.results)
+
+def get_lca_results_to_dataframe(func_units,methods,results):
+    '''
+    Return a long dataframe with the LCA scores of functional units and methods (see get_multilca_to_dataframe).
+    
+    Input arguments:
+        *``func_units``: list of functional units, as in a calculation setup
+        *``methods``: list of methods, as in a calculation setup
+        *``results``: array of scores. Rows are the functional units, columns are the methods
+    
     Returns:
         *Return a long dataframe. Columns: ('Database', 'Code', 'Name', 'Location', 'Unit', 'Amount_fu','Method_name','Midpoint','Midpoint_abb','Score')
     '''
     as_activities = [
         (bw.get_activity(key), amount) 
-        for dct in MultiLCA.func_units 
+        for dct in func_units 
         for key, amount in dct.items()
     ]
-    scores = pd.DataFrame(data=MultiLCA.results, columns=[method[1] for method in MultiLCA.methods],index=[act[0]['code'] for act in as_activities])
+    scores = pd.DataFrame(data=results, columns=[method[1] for method in methods],index=[act[0]['code'] for act in as_activities])
     nicer_fu = pd.DataFrame(
         [
             (x['database'], x['code'], x['name'], x['location'], x['unit'], y, method[0], method[1], method[2],bw.Method(method).metadata['unit'], scores.loc[x['code'],method[1]]) 
             for x, y in as_activities
-            for method in MultiLCA.methods  
+            for method in methods  
         ], 
         columns=('Database', 'Code', 'Name', 'Location', 'Unit', 'Amount_fu','Method_name','Midpoint','Midpoint_abb','Midpoint_unit','Score')
     )
     return nicer_fu
+
+def build_scenario_base(calculation_setup_name):
+    '''
+    Build the matrices of a calculation setup once, to calculate scenarios in memory without writing in the database (see calculate_scenario_lca)
+    Attributes:
+        calculation_setup_name is the name of the calculation setup (see bw.calculation_setups)
+    Output:
+        scenario_base is a dictionnary with
+            'func_units', 'methods': functional units and methods of the calculation setup
+            'technosphere_matrix': technosphere matrix of the database as saved
+            'demand_array': demand of each functional unit. Rows are the products, columns are the functional units
+            'cf_matrix': characterized biosphere flows per unit of activity. Rows are the methods, columns are the activities
+            'product_dict', 'activity_dict': keys of the products and activities to rows and columns of the technosphere matrix
+            'exchange_dict': number and total amount of the technosphere exchanges of each (output key, input key) pair {(output key, input key):(count, amount)}
+    '''
+    func_units = bw.calculation_setups[calculation_setup_name]['inv']
+    methods = bw.calculation_setups[calculation_setup_name]['ia']
+    lca = LCA(func_units[0],methods[0])
+    lca.lci()
+    lca.lcia()
+    demand_array = np.zeros((len(lca.product_dict),len(func_units)))
+    for index,func_unit in enumerate(func_units):
+        for key,amount in func_unit.items():
+            demand_array[lca.product_dict[get_activity(key).key],index] = amount
+    cf_list = []
+    for method in methods:
+        lca.switch_method(method)
+        cf_list.append(lca.biosphere_matrix.T.dot(lca.characterization_matrix.diagonal()))
+    #Technosphere exchanges by pair. update_exchanges only updates the technosphere exchanges of a pair, the other exchanges of the pair (e.g. production) stay in the coefficient.
+    exchange_dict = defaultdict(lambda: [0,0.])
+    db_name_list = sorted(set([key[0] for key in lca.activity_dict.keys()]))
+    exc_query = ExchangeDataset.select(ExchangeDataset.output_database,ExchangeDataset.output_code,ExchangeDataset.input_database,ExchangeDataset.input_code,ExchangeDataset.data).where((ExchangeDataset.output_database.in_(db_name_list)) & (ExchangeDataset.type=='technosphere'))
+    for output_db,output_code,input_db,input_code,exc_data in exc_query.tuples():
+        exc_key = ((output_db,output_code),(input_db,input_code))
+        exchange_dict[exc_key][0] += 1
+        exchange_dict[exc_key][1] += exc_data['amount']
+    scenario_base = {"func_units":func_units,
+                     "methods":methods,
+                     "technosphere_matrix":lca.technosphere_matrix.tocsr(),
+                     "demand_array":demand_array,
+                     "cf_matrix":np.vstack(cf_list),
+                     "product_dict":dict(lca.product_dict),
+                     "activity_dict":dict(lca.activity_dict),
+                     "exchange_dict":{exc_key:tuple(exc_value) for exc_key,exc_value in exchange_dict.items()}}
+    return scenario_base
+
+def get_scenario_patch(scenario_base,exc_update_list):
+    '''
+    Convert exchange updates into coefficients of the technosphere matrix (see build_scenario_base)
+    Attributes:
+        scenario_base is the output of build_scenario_base
+        exc_update_list is a list of (output key, input key, amount) tuples (see update_exchanges). If a pair is given several times, the last amount is kept.
+    Output:
+        row_array, col_array, value_array are the rows, columns and new values of the coefficients.
+        As in update_exchanges, only the technosphere exchanges of a pair are set to the amount. Technosphere exchanges are negative in the matrix, so the coefficient is the coefficient of the base matrix plus the previous amount of the technosphere exchanges, minus the amount times their number.
+    '''
+    amount_dict = {(tuple(output_key),tuple(input_key)):amount for output_key,input_key,amount in exc_update_list}
+    mat_techno = scenario_base["technosphere_matrix"]
+    row_array = np.zeros(len(amount_dict),dtype=np.int64)
+    col_array = np.zeros(len(amount_dict),dtype=np.int64)
+    value_array = np.zeros(len(amount_dict))
+    for index,((output_key,input_key),amount) in enumerate(amount_dict.items()):
+        exc_key = (output_key,input_key)
+        if exc_key not in scenario_base["exchange_dict"] or output_key not in scenario_base["activity_dict"] or input_key not in scenario_base["product_dict"]:
+            raise KeyError("No technosphere exchange between output and input: {exc_key}".format(exc_key=exc_key))
+        row = scenario_base["product_dict"][input_key]
+        col = scenario_base["activity_dict"][output_key]
+        #The coefficient must exist in the technosphere matrix
+        if col not in mat_techno.indices[mat_techno.indptr[row]:mat_techno.indptr[row+1]]:
+            raise KeyError("No coefficient in the technosphere matrix for the exchange: {exc_key}".format(exc_key=exc_key))
+        row_array[index] = row
+        col_array[index] = col
+        nb_exc,exc_amount = scenario_base["exchange_dict"][exc_key]
+        value_array[index] = mat_techno[row,col]+exc_amount-amount*nb_exc
+    return row_array,col_array,value_array
+
+def patch_technosphere_matrix(mat_techno,row_array,col_array,value_array):
+    '''
+    Return a copy of the technosphere matrix where the coefficients (row_array,col_array) are replaced by value_array
+    '''
+    mat_techno = sparse.csr_matrix(mat_techno)
+    if len(value_array)==0:
+        return mat_techno.copy()
+    old_value_array = np.asarray(mat_techno[row_array,col_array]).ravel()
+    mat_delta = sparse.csr_matrix((value_array-old_value_array,(row_array,col_array)),shape=mat_techno.shape)
+    return mat_techno+mat_delta
+
+def solve_scenario_lca(mat_techno,row_array,col_array,value_array,demand_array,cf_matrix):
+    '''
+    Calculate the scores of a scenario (see calculate_scenario_lca): one factorization of the patched technosphere matrix for all functional units
+    Output:
+        results is an array of scores. Rows are the functional units, columns are the methods (same as MultiLCA.results)
+    '''
+    mat_techno = patch_technosphere_matrix(mat_techno,row_array,col_array,value_array)
+    supply_array = linalg.splu(sparse.csc_matrix(mat_techno)).solve(demand_array)
+    return cf_matrix.dot(supply_array).T
+
+def calculate_scenario_lca(scenario_base,scenario_list,max_workers=None):
+    '''
+    Calculate the LCA scores of scenarios in memory. A scenario is a list of exchange updates applied to the matrices of the calculation setup, the database is not modified.
+    Scenarios are independent and are calculated in parallel processes.
+    Attributes:
+        scenario_base is the output of build_scenario_base
+        scenario_list is a list of scenarios. A scenario is a list of (output key, input key, amount) tuples, e.g. from the get_*_updates functions of utils_update
+        max_workers is the number of processes (None for the number of processors, 1 to calculate in the current process). Worker processes import the main module again on Windows, so a script calling this function with several processes needs an if __name__=="__main__" guard.
+    Output:
+        results_list is the list of the scores by scenario. Rows are the functional units, columns are the methods (see get_lca_results_to_dataframe)
+    '''
+    task_list = [(scenario_base["technosphere_matrix"],)+get_scenario_patch(scenario_base,exc_update_list)+(scenario_base["demand_array"],scenario_base["cf_matrix"]) for exc_update_list in scenario_list]
+    if max_workers==1 or len(task_list)<=1:
+        results_list = [solve_scenario_lca(*task) for task in task_list]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results_list = list(executor.map(solve_scenario_lca,*zip(*task_list)))
+    return results_list
     
 def get_activity_to_dataframe(act):
     '''
@@ -225,12 +729,8 @@ def get_median_act(bw_db_name,name_to_include,name_to_exclude,unit,ia_method,loc
         unit is the string of activity unit.
         ia_method is a bw Impact Assessment method        
     '''    
-    bw_db = bw.Database(bw_db_name)
     #Get the list of all potential activities
-    if (location_keywords==None):
-        act_list = [act for act in bw_db if all(keyword in act['name'] for keyword in name_to_include) and all(keyword not in act['name'] for keyword in name_to_exclude) and unit in act['unit']]
-    else:
-        act_list = [act for act in bw_db if all(keyword in act['name'] for keyword in name_to_include) and all(keyword not in act['name'] for keyword in name_to_exclude) and any(keyword==act['location'] for keyword in location_keywords) and unit in act['unit']]
+    act_list = find_activities(bw_db_name,name_contains=name_to_include,name_not_contains=name_to_exclude,location_in=location_keywords,unit_contains=unit)
     #Check the number of activities
     if len(act_list)==0:
         raise KeyError("No activities found")
@@ -254,7 +754,7 @@ def create_act_new_location(bw_db_name,act_name,new_location,cut_off_occurence=0
     Function that creates an activity from an existing one with new location, and update exchanges
     '''   
     bw_db = bw.Database(bw_db_name)
-    act_list=[act for act in bw_db if act_name == act['name']]
+    act_list=find_activities(bw_db_name,name=act_name)
     #Create activity if not existing
     if new_location not in [act['location'] for act in act_list]:
          #Create the new activity
@@ -267,13 +767,15 @@ def create_act_new_location(bw_db_name,act_name,new_location,cut_off_occurence=0
         new_act['unit']=act_list[0]['unit']
         new_act['production amount']=act_list[0]['production amount']
         new_act.save()
+        update_activity_index(new_act)
     else:
         new_act = [act for act in act_list if new_location in act['location']][0]
     #For the rest, only consider the other activities except RoW
     if copy_from_glo=='y':
-        act_list=[act for act in bw_db if act_name == act['name'] and 'GLO' in act['location']]
+        act_list=find_activities(bw_db_name,name=act_name,location_contains='GLO')
     elif copy_from_glo=='n':
-        act_list=[act for act in bw_db if act_name == act['name'] and new_location not in act['location'] and 'RoW' not in act['location']]
+        act_list=find_activities(bw_db_name,name=act_name,location_not_contains='RoW')
+        act_list=[act for act in act_list if new_location not in act['location']]
     #Create a data frame with all exchanges by activity (only technosphere) for already existing activities
     techno_exc_dt=pd.DataFrame()
     for act in act_list:
@@ -303,7 +805,7 @@ def create_act_new_location(bw_db_name,act_name,new_location,cut_off_occurence=0
             act_location_list = techno_exc_dt.loc[techno_exc_dt.Input==input_name,'Activity Location'].unique().tolist()
             #Check if single location
             if len(input_loc_list)==1:
-                input_act = [act for act in bw_db if input_name == act['name'] and input_loc_list[0] in act['location']][0]
+                input_act = find_activities(bw_db_name,name=input_name,location_contains=input_loc_list[0])[0]
                 new_exc = new_act.new_exchange(type='technosphere',input=input_act, amount=input_amount)
                 new_exc['uncertainty type']=4
                 new_exc['minimum']=input_min
@@ -311,7 +813,7 @@ def create_act_new_location(bw_db_name,act_name,new_location,cut_off_occurence=0
                 new_exc.save()
             #Check if all locations of the inputs are also in the activity locations list. In that case, it is an exchange with a location-specific activity
             elif all(elem in act_location_list for elem in input_loc_list):
-                input_act_list = [act for act in bw_db if input_name == act['name'] and new_location == act['location']]
+                input_act_list = find_activities(bw_db_name,name=input_name,location=new_location)
                 if len(input_act_list)==0:
                     print('Issue with exchange creation: '+input_name+' for '+new_location+' does not exist')
                 elif len(input_act_list)==1:
@@ -329,7 +831,7 @@ def create_act_new_location(bw_db_name,act_name,new_location,cut_off_occurence=0
                 ipcc2013 = ('IPCC 2013', 'climate change', 'GWP 100a')
                 median_act_dic = get_median_act(bw_db_name=bw_db_name,name_to_include=[input_name],name_to_exclude=[],unit=unit,ia_method=ipcc2013,location_keywords=None)
                 #Create exchange
-                input_act = [act for act in bw_db if act['code']==median_act_dic['Median']][0]
+                input_act = find_activities(bw_db_name,code=median_act_dic['Median'])[0]
                 new_exc = new_act.new_exchange(type='technosphere',input=input_act, amount=input_amount)
                 new_exc['uncertainty type']=4
                 new_exc['minimum']=input_min
@@ -351,7 +853,7 @@ def create_act_new_location(bw_db_name,act_name,new_location,cut_off_occurence=0
                     input_min = np.min(techno_exc_dt.loc[(techno_exc_dt['Input']==input_name) & (techno_exc_dt['Input Location']==location),'Input Amount'])
                     inpu_max = np.max(techno_exc_dt.loc[(techno_exc_dt['Input']==input_name) & (techno_exc_dt['Input Location']==location),'Input Amount'])
                     #Create exchange
-                    input_act = [act for act in bw_db if input_name == act['name'] and location == act['location']][0]
+                    input_act = find_activities(bw_db_name,name=input_name,location=location)[0]
                     new_exc = new_act.new_exchange(type='technosphere',input=input_act, amount=input_amount)
                     new_exc['uncertainty type']=4
                     new_exc['minimum']=input_min
@@ -368,7 +870,7 @@ def create_act_new_location(bw_db_name,act_name,new_location,cut_off_occurence=0
                     input_min = input_min + np.min(techno_exc_dt.loc[(techno_exc_dt['Input']==input_name) & (techno_exc_dt['Input Location']==location),'Input Amount'])
                     inpu_max = inpu_max + np.max(techno_exc_dt.loc[(techno_exc_dt['Input']==input_name) & (techno_exc_dt['Input Location']==location),'Input Amount'])
                 #List of potential activities
-                input_act_list = [act for act in bw_db if input_name == act['name']]
+                input_act_list = find_activities(bw_db_name,name=input_name)
                 available_loc_list = [act['location'] for act in input_act_list]
                 if new_location in available_loc_list:
                     location = new_location
@@ -393,7 +895,6 @@ def create_act_new_location(bw_db_name,act_name,new_location,cut_off_occurence=0
             new_row= pd.DataFrame({'Activity':act['name'],'Activity Location':act['location'],'Input':exc.input['name'],'Input code':exc.input['code'],'Input Amount':exc.amount},index=[0])
             bio_exc_dt = bio_exc_dt.append(new_row,ignore_index=True)  
     if len(bio_exc_dt)!=0:
-        bio_db = bw.Database('biosphere3')
         #Create the list of technosphere inputs for the new activity and see for each input if it is present in most of the existing activities.
         input_code_list = bio_exc_dt['Input code'].unique().tolist()
         for input_code in input_code_list:
@@ -410,12 +911,13 @@ def create_act_new_location(bw_db_name,act_name,new_location,cut_off_occurence=0
                 input_min = np.min(bio_exc_dt.loc[bio_exc_dt['Input code']==input_code,'Input Amount'])
                 inpu_max = np.max(bio_exc_dt.loc[bio_exc_dt['Input code']==input_code,'Input Amount'])
                 #Activity to use
-                input_act = [act for act in bio_db if input_code == act['code']][0]
+                input_act = find_activities('biosphere3',code=input_code)[0]
                 new_exc = new_act.new_exchange(type='biosphere',input=input_act, amount=input_amount)
                 new_exc['uncertainty type']=4
                 new_exc['minimum']=input_min
                 new_exc['maximum']=inpu_max
                 new_exc.save()  
+    set_database_modified(bw_db_name)
     return
 
 def duplicate_act_new_location(bw_db_name,act_key,new_location,prod_system_depth=3):
@@ -427,7 +929,6 @@ def duplicate_act_new_location(bw_db_name,act_key,new_location,prod_system_depth
     Input arguments:
         *``act_key``: Activity tuple or object
     '''    
-    bw_db = bw.Database(bw_db_name)
     activity = bw.get_activity(act_key)
     #Output
     duplicated_act = {}
@@ -436,13 +937,14 @@ def duplicate_act_new_location(bw_db_name,act_key,new_location,prod_system_depth
         #print('No duplicates for '+ activity['name']+' at location '+new_location)
         non_duplicated_act[activity['name']] = activity['location']
         return activity,duplicated_act,non_duplicated_act
-    elif len([act for act in bw_db if act['name']==activity['name'] and act['location']==new_location])>0:
+    elif len(find_activities(bw_db_name,name=activity['name'],location=new_location,as_key=True))>0:
         print('Activity '+ activity['name']+' already exists in '+new_location)
-        new_activity = [act for act in bw_db if act['name']==activity['name'] and act['location']==new_location][0]
+        new_activity = find_activities(bw_db_name,name=activity['name'],location=new_location)[0]
     else:
         new_activity = activity.copy()
         new_activity['location'] = new_location
         new_activity.save()
+        update_activity_index(new_activity)
         #add to list of duplicates
         duplicated_act[new_activity['name']] = new_location
     prod_system_depth = prod_system_depth - 1
@@ -457,7 +959,7 @@ def duplicate_act_new_location(bw_db_name,act_key,new_location,prod_system_depth
             exc_input = temp_exc_list[0].input
         #If many exchanges with such input name. Aggregate them in one input
         else:
-            all_exc_input_list = [act for act in bw_db if act['name']==exc_name]
+            all_exc_input_list = find_activities(bw_db_name,name=exc_name)
             if new_location in [act['location'] for act in all_exc_input_list]:
                 exc_input = [act for act in all_exc_input_list if act['location']==new_location][0]
             elif 'GLO' in [act['location'] for act in all_exc_input_list]:
@@ -472,6 +974,7 @@ def duplicate_act_new_location(bw_db_name,act_key,new_location,prod_system_depth
             for exc in temp_exc_list:
                 exc.delete()
             new_activity.save()
+            update_activity_index(new_activity)
             #Create new exchange with the input name
             new_activity.new_exchange(amount=exc_amount,input=exc_input,type="technosphere").save()
         #Consider the exc_to_update
@@ -479,7 +982,7 @@ def duplicate_act_new_location(bw_db_name,act_key,new_location,prod_system_depth
         #Update the exc_input
         if exc_input['location']!=new_location:
             #Search if activity exist with new location
-            search_list = [act for act in bw_db if act['name']==exc_input['name'] and act['location']==new_location]
+            search_list = find_activities(bw_db_name,name=exc_input['name'],location=new_location)
             if len(search_list)>0:
                 new_exc_input = search_list[0]
             #If not, create the new inputs with the new location (recursive function)
@@ -490,4 +993,5 @@ def duplicate_act_new_location(bw_db_name,act_key,new_location,prod_system_depth
                 non_duplicated_act = {**non_duplicated_act, **temp_non_duplicated_act}
             exc_to_update['input'] = new_exc_input
             exc_to_update.save()
+    set_database_modified(bw_db_name)
     return new_activity,duplicated_act,non_duplicated_act
\ No newline at end of file
@@ -6,17 +6,168 @@ Functions to calculate material flow matrices of bauxite, alumina and aluminum
 """
 import requests
 import logging
+import os
+import json
+import hashlib
+import pickle
+import collections
+import time
+import threading
+import weakref
+import concurrent.futures
 import pandas as pd
 from scipy import sparse
 import numpy as np
 from scipy.sparse import linalg
 
+COMTRADE_API_URL = "http://comtrade.un.org/api/get?"
+
+def get_comtrade_parameters(reporting_area="all",
+                            partner_area="all",
+                            trade_type=1,
+                            commodity_code="TOTAL", 
+                            year="recent", 
+                            classification="HS"):
+    """
+    get_comtrade_parameters returns the parameters of the UN Comtrade API request (see get_commodity_data). The token is not included.
+    """
+    parameters = {"max": 250000,
+                  "type": "C",
+                  "freq": "A",
+                  "px": classification,
+                  "ps": year,
+                  "r": reporting_area,
+                  "p": partner_area,
+                  "rg": trade_type,
+                  "cc": commodity_code,
+                  "fmt": "json",
+                  "head":"M"
+                  }
+    return parameters
+
+def wait_rate_limit(rate_limit):
+    """
+    Wait until the next request is allowed by the rate limit
+    Args:
+        rate_limit is a dictionnary shared by the threads: {"lock":threading.Lock(),"min_interval":seconds between two requests,"next_time":time of the next allowed request}
+    """
+    if rate_limit is None:
+        return
+    with rate_limit["lock"]:
+        now = time.monotonic()
+        wait_time = rate_limit["next_time"]-now
+        rate_limit["next_time"] = max(now,rate_limit["next_time"])+rate_limit["min_interval"]
+    if wait_time>0:
+        time.sleep(wait_time)
+    return
+
+def get_comtrade_response(parameters,base_url=COMTRADE_API_URL,timeout=60,max_try=3,backoff=1,rate_limit=None):
+    """
+    get_comtrade_response sends the request to UN Comtrade API and retries with exponential backoff
+    Args:
+        parameters is the dictionnary of parameters of the request (see get_comtrade_parameters)
+        base_url is the URL of the API. Can be changed to a local server.
+        timeout is the timeout of the request in seconds
+        max_try is the maximum number of retries
+        backoff is the waiting time before the first retry in seconds. The waiting time doubles at each retry.
+        rate_limit is the rate limit shared by concurrent requests (see wait_rate_limit)
+    Returns:
+        (status_code, content). (None, None) if the request failed.
+    """
+    un_comtrade_token="TO_OBTAIN" #Token to use for downloading data
+    trial = 0
+    status_code = None
+    while True:
+        wait_rate_limit(rate_limit)
+        try:
+            get_request = requests.get(base_url, params={**parameters,"token":un_comtrade_token}, timeout=timeout)
+            status_code = get_request.status_code
+            #409 and 429 are returned when the usage limit is reached. 5xx are server errors.
+            if status_code not in [409,429] and status_code<500:
+                return status_code,get_request.content
+            err = "status code {status_code}".format(status_code=status_code)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as request_err:
+            err = request_err
+        logging.warning("request failed at country {country} at trial: {trial} for error: {err}".format(
+            country=parameters["r"],
+            trial=trial,
+            err=err))
+        trial += 1
+        if trial > max_try:
+            logging.warning("! Giving up on request, country: {country}, year: {year} !".format(
+                country=parameters["r"],
+                year=parameters["ps"])
+            )
+            return status_code,None
+        time.sleep(backoff*2**(trial-1))
+
+def get_comtrade_cache_path(parameters,cache_dir):
+    """
+    Return the path of the file referencing the payload of the request in the cache
+    The payloads are stored by hash of their content (cache_dir/objects). The references link the hash of the parameters to the hash of the payload (cache_dir/refs).
+    """
+    request_hash = hashlib.sha256(json.dumps({key:str(value) for key,value in parameters.items()},sort_keys=True).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir,"refs",request_hash)
+
+def read_comtrade_cache(parameters,cache_dir):
+    """
+    Return the cached payload of the request. None if the request is not cached.
+    """
+    ref_path = get_comtrade_cache_path(parameters,cache_dir)
+    if not os.path.exists(ref_path):
+        return None
+    with open(ref_path,"r") as f:
+        content_hash = f.read().strip()
+    content_path = os.path.join(cache_dir,"objects",content_hash)
+    if not os.path.exists(content_path):
+        return None
+    with open(content_path,"rb") as f:
+        return f.read()
+
+def write_comtrade_cache(parameters,content,cache_dir):
+    """
+    Store the payload of the request in the cache
+    """
+    content_hash = hashlib.sha256(content).hexdigest()
+    os.makedirs(os.path.join(cache_dir,"objects"),exist_ok=True)
+    os.makedirs(os.path.join(cache_dir,"refs"),exist_ok=True)
+    content_path = os.path.join(cache_dir,"objects",content_hash)
+    if not os.path.exists(content_path):
+        with open(content_path+".tmp","wb") as f:
+            f.write(content)
+        os.replace(content_path+".tmp",content_path)
+    with open(get_comtrade_cache_path(parameters,cache_dir),"w") as f:
+        f.write(content_hash)
+    return
+
+def read_comtrade_payload(content,reporting_area="all"):
+    """
+    Convert the payload of UN Comtrade API in pandas.DataFrame format
+    """
+    try:
+        payload = json.loads(content.decode("utf-8"))
+        dataset = payload["dataset"]
+        if dataset == []:
+            logging.warning("Empty dataset. Message is: {message}".format(message=payload["validation"]['message']))
+            return []
+        else:
+            return pd.DataFrame(dataset)
+    except ValueError:
+        logging.warning("country_code: {country}, skipped because of ValueError in json".format(
+                        country=reporting_area))
+        return "JSON Error"
+
 def get_commodity_data(reporting_area="all",
                        partner_area="all",
                        trade_type=1,
                        commodity_code="TOTAL", 
                        year="recent", 
-                       classification="HS"):
+                       classification="HS",
+                       base_url=COMTRADE_API_URL,
+                       cache_dir=None,
+                       rate_limit=None,
+                       max_try=3,
+                       backoff=1):
     """
     get_commodity_data returns the comtrade data in pandas.DataFrame format for the given parameters
     Args:
@@ -26,68 +177,95 @@ def get_commodity_data(reporting_area="all",
         commodity_code (str): commodity code as defined by comtrade
         year (int): 4 digit e.g. 2003
         classification: 
+        base_url: URL of the API. Can be changed to a local server.
+        cache_dir: directory of the cache of payloads. None means no cache.
+        rate_limit, max_try and backoff: see get_comtrade_response
     ps, r and p are limited to 5 codes each. Only one of the above codes may use the special ALL value in a given API call.
     Returns:
     """
     #Website: https://comtrade.un.org/data/doc/api/
-    # global get_request
-    un_comtrade_token="TO_OBTAIN" #Token to use for downloading data
-    parameters = {"max": 250000,
-                  "type": "C",
-                  "freq": "A",
-                  "px": classification,
-                  "ps": year,
-                  "r": reporting_area,
-                  "p": partner_area,
-                  "rg": trade_type,
-                  "cc": commodity_code,
-                  "fmt": "json",
-                  "head":"M",
-                  "token": un_comtrade_token
-                  }
-    #
-    TIMEOUT =60
-    MAX_TRY = 3
-    trial = 0
-    failed = True
+    parameters = get_comtrade_parameters(reporting_area=reporting_area,partner_area=partner_area,trade_type=trade_type,commodity_code=commodity_code,year=year,classification=classification)
+    content = None
+    if cache_dir!=None:
+        content = read_comtrade_cache(parameters,cache_dir)
+    if content is None:
+        TIMEOUT = 60
+        status_code,content = get_comtrade_response(parameters,base_url=base_url,timeout=TIMEOUT,max_try=max_try,backoff=backoff,rate_limit=rate_limit)
+        if status_code is None:
+            return []
+        elif status_code!=200:
+            return status_code
+        if cache_dir!=None:
+            write_comtrade_cache(parameters,content,cache_dir)
+    return read_comtrade_payload(content,reporting_area=reporting_area)
 
-    while failed:
-        try:
-            get_request = requests.get("http://comtrade.un.org/api/get?", params=parameters, timeout=TIMEOUT)
-            failed = False
-        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as err:
-            logging.warning("request timed out at country {country} at trial: {trial} for error: {err}".format(
-                country=reporting_area,
-                trial=trial,
-                err=err))
-            trial += 1
-            if trial > MAX_TRY:
-                logging.warning("! Giving up on request, country: {country}, year: {year} !".format(
-                    country=reporting_area,
-                    year=year)
-                )
-                return []
-            else:
-                continue
+def get_commodity_data_batch(request_list,
+                             max_workers=4,
+                             min_interval=1,
+                             base_url=COMTRADE_API_URL,
+                             cache_dir="inputs/comtrade_cache",
+                             max_try=5,
+                             backoff=2):
+    """
+    get_commodity_data_batch downloads many requests concurrently under a rate limit
+    Args:
+        request_list: list of dictionnaries of parameters of get_commodity_data, e.g. {"trade_type":1,"commodity_code":"7601","year":2000,"classification":"H0"}
+        max_workers: number of concurrent requests
+        min_interval: minimum time between two requests in seconds (shared by all the workers)
+        base_url: URL of the API. Can be changed to a local server.
+        cache_dir: directory of the cache of payloads. Cached requests are not downloaded again. None means no cache.
+        max_try and backoff: see get_comtrade_response
+    Returns:
+        List of the outputs of get_commodity_data in the order of request_list
+    """
+    rate_limit = {"lock":threading.Lock(),"min_interval":min_interval,"next_time":0}
+    def get_request_data(request):
+        return get_commodity_data(**request,base_url=base_url,cache_dir=cache_dir,rate_limit=rate_limit,max_try=max_try,backoff=backoff)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dataset_list = list(executor.map(get_request_data,request_list))
+    return dataset_list
 
-    if get_request.status_code == 200:
-        try:
-            # payload = json.loads(get_request.content.decode("utf-8"))["dataset"]
-            payload = get_request.json()["dataset"]
-            if payload == []:
-                logging.warning("Empty dataset. Message is: {message}".format(message=get_request.json()["validation"]['message']))
-                return []
-            else:
-                return pd.DataFrame(payload)
-        except ValueError:
-            logging.warning("country_code: {country}, skipped because of ValueError in json".format(
-                            country=reporting_area))
-            return "JSON Error"
-    else:
-        return get_request.status_code
 
+#Resolvers of country indexes by column of the list of Comtrade countries
+_country_index_dict = {}
 
-def get_mat_trad_raw(commodity_dict={"name":["Aluminium; unwrought"],"level":4,'classification':'H0'},year=2000,trade_type=1):
+def get_country_index(value_list,column="ctyCode"):
+    '''
+    Return the indexes of countries in the list of Comtrade countries (rows and columns of the matrices)
+    The resolver (code or name to index) is built once per column.
+    Attributes:
+        value_list is the list (or array) of country codes or names to resolve
+        column is the column of the list of Comtrade countries used to identify the countries
+            "ctyCode" | "cty Name English"
+    Output:
+        index_array is the array of indexes. If a value appears many times in the list of countries, the first index is used.
+        Raises KeyError with all the unknown values
+    '''
+    if column not in _country_index_dict:
+        uncomtrade_area_list=get_reference_table("inputs/Comtrade Country Code and ISO list.xlsx",sheet_name="Sheet1")
+        country_col = uncomtrade_area_list[column]
+        country_col = country_col[~country_col.duplicated()]
+        _country_index_dict[column] = (pd.Index(country_col.values),country_col.index.values)
+    value_index,country_index = _country_index_dict[column]
+    position_array = value_index.get_indexer(np.asarray(value_list))
+    if (position_array==-1).any():
+        unknown_list = pd.unique(np.asarray(value_list)[position_array==-1]).tolist()
+        raise KeyError("Unknown countries in {column}: {unknown_list}".format(column=column,unknown_list=unknown_list))
+    return country_index[position_array]
+
+def get_comm_number_list(commodity_dict={"name":["Aluminium; unwrought"],"level":4,'classification':'H0'}):
+    '''
+    Return the list of UN Comtrade commodity codes of the commodity
+    Attributes:
+        commodity_dict is the dictionnary of the commodity to consider from UN Comtrade database
+            {"name":[NAMES_OF_COMODITY],
+            "level":LEVEL_OF_COMMODITY,
+            'classification':'H0'}
+    '''
+    commodity_class = get_reference_table("inputs/UN Comtrade Commodity Classifications.xlsx",sheet_name="2017-06-13")
+    return commodity_class.loc[commodity_class["Description"].isin(commodity_dict["name"]) & (commodity_class["Level"]==commodity_dict["level"]) & (commodity_class["Classification"]==commodity_dict["classification"]),"Code"].tolist()
+
+def get_mat_trad_raw(commodity_dict={"name":["Aluminium; unwrought"],"level":4,'classification':'H0'},year=2000,trade_type=1,base_url=COMTRADE_API_URL,cache_dir="inputs/comtrade_cache"):
     '''
     Construct the trade matrix from UN Comtrade without reconciliation
     Attributes:
@@ -97,21 +275,22 @@ def get_mat_trad_raw(commodity_dict={"name":["Aluminium; unwrought"],"level":4,'
             'classification':'H0'}
         year
         trade_type: Types of data to consider.
+        base_url and cache_dir: URL of UN Comtrade API and directory of the cache of payloads (see get_commodity_data_batch)
     Output:
         mat_trad is the trade matrix. The rows are the importer. The columns are the exporter.
         aij is the quantity imported by i from j
+        The matrices of the commodities are summed.
         Unit:
     
     '''
     #Inputs
-    commodity_class = pd.read_excel("inputs/UN Comtrade Commodity Classifications.xlsx",sheet_name="2017-06-13")
-    uncomtrade_area_list=pd.read_excel("inputs/Comtrade Country Code and ISO list.xlsx",sheet_name="Sheet1")
-    comm_number_list=commodity_class.loc[commodity_class["Description"].isin(commodity_dict["name"]) & (commodity_class["Level"]==commodity_dict["level"]) & (commodity_class["Classification"]==commodity_dict["classification"]),"Code"].tolist() 
+    uncomtrade_area_list=get_reference_table("inputs/Comtrade Country Code and ISO list.xlsx",sheet_name="Sheet1")
+    comm_number_list=get_comm_number_list(commodity_dict)
     mat_trad = sparse.csc_matrix((len(uncomtrade_area_list),len(uncomtrade_area_list)))
     #Create the dataset from the the databased associated with the specific year and the considered commodities
-    for comm_number in comm_number_list:
-        #Get data
-        dataset = get_commodity_data(reporting_area="all",partner_area="all",trade_type=trade_type,commodity_code=comm_number,year=year,classification=commodity_dict["classification"])
+    #Get data of all the commodities. The requests are sent concurrently.
+    dataset_list = get_commodity_data_batch([{"reporting_area":"all","partner_area":"all","trade_type":trade_type,"commodity_code":comm_number,"year":year,"classification":commodity_dict["classification"]} for comm_number in comm_number_list],base_url=base_url,cache_dir=cache_dir)
+    for dataset in dataset_list:
         #World partner is a summary of a country with world. Delete rows
         dataset = dataset.loc[dataset["ptCode"]!=0].reset_index(drop=True)
         #Some missing quantity data. qtCode == 8 represents values in kilograms
@@ -123,18 +302,117 @@ def get_mat_trad_raw(commodity_dict={"name":["Aluminium; unwrought"],"level":4,'
         #Update dataset with importer and exporter indexes. The rows are the importer. The columns are the exporter.
         #Attention: If trade_type is 1, then imports. Reporter is the importer. Otherwise, reporter is the exporter.
         if trade_type==1:
-            dataset["index_importer"] = [uncomtrade_area_list[uncomtrade_area_list["ctyCode"]==dataset.loc[i,"rtCode"]].index[0] for i in dataset.index]
-            dataset["index_exporter"] = [uncomtrade_area_list[uncomtrade_area_list["ctyCode"]==dataset.loc[i,"ptCode"]].index[0] for i in dataset.index]
+            dataset["index_importer"] = get_country_index(dataset["rtCode"],column="ctyCode")
+            dataset["index_exporter"] = get_country_index(dataset["ptCode"],column="ctyCode")
         elif trade_type==2:
-            dataset["index_exporter"] = [uncomtrade_area_list[uncomtrade_area_list["ctyCode"]==dataset.loc[i,"rtCode"]].index[0] for i in dataset.index]
-            dataset["index_importer"] = [uncomtrade_area_list[uncomtrade_area_list["ctyCode"]==dataset.loc[i,"ptCode"]].index[0] for i in dataset.index]
+            dataset["index_exporter"] = get_country_index(dataset["rtCode"],column="ctyCode")
+            dataset["index_importer"] = get_country_index(dataset["ptCode"],column="ctyCode")
         #Create sparse matrix from previous dataset
         temp_mat_trad = sparse.csc_matrix((dataset["NetWeight"],(dataset["index_importer"],dataset["index_exporter"])),shape=(len(uncomtrade_area_list),len(uncomtrade_area_list)))
-    #Create total matrix of bilateral trade data from previous matrix per commodity.
-    mat_trad = mat_trad+temp_mat_trad
+        #Create total matrix of bilateral trade data from previous matrix per commodity.
+        mat_trad = mat_trad+temp_mat_trad
     return mat_trad
 
-def get_mat_trad_reconciliation(commodity_dict={"name":["Aluminium; unwrought"],"level":4,'classification':'H0'},year=2000):
+def get_trade_records(dataset):
+    '''
+    Create the dataset of bilateral transactions from UN Comtrade data reported as imports and exports
+    Attributes:
+        dataset is the UN Comtrade data (see get_commodity_data) with imports and exports
+    Output:
+        trade_dt is the dataset of transactions. Each row is a transaction, with one variable for importer value, and one for exporter value
+            Columns: Importer, Exporter, Reported_imports, Reported_exports
+    '''
+    #Eliminate re-imports or re-exports. Only consider imports and exports. Eliminate imports and exports from same partner
+    dataset = dataset.loc[dataset["rtCode"]!=dataset["ptCode"]].reset_index(drop=True)
+    #Only consider trade reported as imports or exports
+    dataset = dataset.loc[dataset["rgCode"].isin([1,2])].reset_index(drop=True)
+    #World partner is a summary of a country with world. Delete rows
+    dataset = dataset.loc[dataset["ptCode"]!=0].reset_index(drop=True)
+    #Some errors in data (nan). 
+    dataset = dataset.loc[dataset["NetWeight"].notnull()].reset_index(drop=True)
+    #First for imports
+    imports_dt = dataset.loc[dataset["rgCode"].isin([1])].reset_index(drop=True)[['rtCode','ptCode','NetWeight']]
+    imports_dt = imports_dt.rename({"rtCode":"Importer","ptCode":"Exporter","NetWeight":"Reported_imports"},axis="columns") 
+    #Second for exports
+    exports_dt = dataset.loc[dataset["rgCode"].isin([2])].reset_index(drop=True)[['rtCode','ptCode','NetWeight']]
+    exports_dt = exports_dt.rename({"rtCode":"Exporter","ptCode":"Importer","NetWeight":"Reported_exports"},axis="columns")
+    #If a transaction is reported many times by the exporter, the last reported value is considered
+    exports_dt = exports_dt.groupby(["Importer","Exporter"],sort=False,as_index=False)["Reported_exports"].last()
+    #Merge the two dataset. Transactions only reported by the exporter are added after the transactions reported by the importer.
+    trade_dt = imports_dt.merge(exports_dt,how="left",on=["Importer","Exporter"])
+    exports_only_dt = exports_dt.merge(imports_dt[["Importer","Exporter"]].drop_duplicates(),how="left",on=["Importer","Exporter"],indicator=True)
+    exports_only_dt = exports_only_dt.loc[exports_only_dt["_merge"]=="left_only",["Importer","Exporter","Reported_exports"]]
+    trade_dt = pd.concat([trade_dt,exports_only_dt],ignore_index=True,sort=False)
+    #Convert NaN values in 0. We asssume no imports (or no exports)
+    trade_dt["Reported_imports"] = trade_dt["Reported_imports"].fillna(0)
+    trade_dt["Reported_exports"] = trade_dt["Reported_exports"].fillna(0)
+    return trade_dt[["Importer","Exporter","Reported_imports","Reported_exports"]]
+
+def reconcile_trade_records(trade_dt,accuracy_threshold=0.2):
+    '''
+    Select the best value of each transaction with the reconciliation method from Gehlhar
+    Attributes:
+        trade_dt is the dataset of transactions (see get_trade_records)
+        accuracy_threshold is the maximum relative difference between importer and exporter values for a transaction to be accurate
+    Output:
+        trade_dt is the dataset of transactions with the reliability indexes of the importer and the exporter and the selected value
+            Columns: Importer, Exporter, Reported_imports, Reported_exports, Accuracy_level, RI_importer, RI_exporter, Value
+    '''
+    trade_dt = trade_dt.copy()
+    #3) Calculate Accuracy level of the transactions
+    reported_imports = trade_dt["Reported_imports"].values
+    reported_exports = trade_dt["Reported_exports"].values
+    with np.errstate(divide="ignore",invalid="ignore"):
+        trade_dt["Accuracy_level"] = np.where(reported_imports!=0,abs(reported_imports-reported_exports)/reported_imports,1)
+    is_accurate = trade_dt["Accuracy_level"].values<=accuracy_threshold
+    #4)Importer and exporter commodity specific reliability index
+    trade_dt["Accurate_imports"] = np.where(is_accurate,reported_imports,0)
+    trade_dt["Accurate_exports"] = np.where(is_accurate,reported_exports,0)
+    rim_dt = trade_dt.groupby(["Importer"])[["Reported_imports","Accurate_imports"]].transform("sum")
+    rix_dt = trade_dt.groupby(["Exporter"])[["Reported_exports","Accurate_exports"]].transform("sum")
+    #Calculate reliability index. NaN means no total imports (or exports) and no accurate. So we cannot judge the reliability.
+    with np.errstate(divide="ignore",invalid="ignore"):
+        trade_dt["RI_importer"] = np.nan_to_num(rim_dt["Accurate_imports"].values/rim_dt["Reported_imports"].values*100)
+        trade_dt["RI_exporter"] = np.nan_to_num(rix_dt["Accurate_exports"].values/rix_dt["Reported_exports"].values*100)
+    #5) Select the best trade data
+    trade_dt["Value"] = np.where(trade_dt["RI_importer"].values>=trade_dt["RI_exporter"].values,reported_imports,reported_exports)
+    return trade_dt.drop(columns=["Accurate_imports","Accurate_exports"])
+
+def reconcile_trade_records_sweep(trade_dt,accuracy_threshold_list=None):
+    '''
+    Select the best value of each transaction with the reconciliation method from Gehlhar for several accuracy thresholds at once (see reconcile_trade_records)
+    The accuracy levels are calculated once. The reliability indexes of all thresholds are calculated in one pass with one column per threshold.
+    Attributes:
+        trade_dt is the dataset of transactions (see get_trade_records)
+        accuracy_threshold_list is the list of accuracy thresholds. None is [0.1,0.2,0.3].
+    Output:
+        mat_value is the array of selected values. Rows are the transactions of trade_dt, columns are the thresholds of accuracy_threshold_list.
+    '''
+    if accuracy_threshold_list is None:
+        accuracy_threshold_list = [0.1,0.2,0.3]
+    accuracy_threshold_list = np.asarray(accuracy_threshold_list,dtype=np.float64)
+    reported_imports = trade_dt["Reported_imports"].values
+    reported_exports = trade_dt["Reported_exports"].values
+    #3) Calculate Accuracy level of the transactions
+    with np.errstate(divide="ignore",invalid="ignore"):
+        accuracy_level = np.where(reported_imports!=0,abs(reported_imports-reported_exports)/reported_imports,1)
+    is_accurate = accuracy_level[:,np.newaxis]<=accuracy_threshold_list[np.newaxis,:]
+    #4)Importer and exporter commodity specific reliability index. One column per threshold.
+    nb_threshold = len(accuracy_threshold_list)
+    sum_dt = pd.DataFrame(np.hstack([reported_imports[:,np.newaxis],np.where(is_accurate,reported_imports[:,np.newaxis],0)]))
+    sum_dt["Importer"] = trade_dt["Importer"].values
+    rim = sum_dt.groupby("Importer").transform("sum").values
+    sum_dt = pd.DataFrame(np.hstack([reported_exports[:,np.newaxis],np.where(is_accurate,reported_exports[:,np.newaxis],0)]))
+    sum_dt["Exporter"] = trade_dt["Exporter"].values
+    rix = sum_dt.groupby("Exporter").transform("sum").values
+    with np.errstate(divide="ignore",invalid="ignore"):
+        ri_importer = np.nan_to_num(rim[:,1:nb_threshold+1]/rim[:,[0]]*100)
+        ri_exporter = np.nan_to_num(rix[:,1:nb_threshold+1]/rix[:,[0]]*100)
+    #5) Select the best trade data
+    mat_value = np.where(ri_importer>=ri_exporter,reported_imports[:,np.newaxis],reported_exports[:,np.newaxis])
+    return mat_value
+
+def get_mat_trad_reconciliation(commodity_dict={"name":["Aluminium; unwrought"],"level":4,'classification':'H0'},year=2000,accuracy_threshold=0.2,base_url=COMTRADE_API_URL,cache_dir="inputs/comtrade_cache"):
     '''
     Construct the trade matrix from UN Comtrade with reconciliation method from Gehlhar
     Attributes:
@@ -143,103 +421,549 @@ def get_mat_trad_reconciliation(commodity_dict={"name":["Aluminium; unwrought"],
             "level":LEVEL_OF_COMMODITY,
             'classification':'H0'}
         year
+        accuracy_threshold is the maximum relative difference between importer and exporter values for a transaction to be accurate
+        base_url and cache_dir: URL of UN Comtrade API and directory of the cache of payloads (see get_commodity_data_batch)
     Output:
         mat_trad is the trade matrix. The rows are the importer. The columns are the exporter.
         aij is the quantity imported by i from j
+        The matrices of the commodities are summed.
         Unit: kg
     
     '''
     #Inputs
-    commodity_class = pd.read_excel("inputs/UN Comtrade Commodity Classifications.xlsx",sheet_name="2017-06-13")
-    uncomtrade_area_list = pd.read_excel("inputs/Comtrade Country Code and ISO list.xlsx",sheet_name="Sheet1")
-    comm_number_list = commodity_class.loc[commodity_class["Description"].isin(commodity_dict["name"]) & (commodity_class["Level"]==commodity_dict["level"]) & (commodity_class["Classification"]==commodity_dict["classification"]),"Code"].tolist() 
+    uncomtrade_area_list = get_reference_table("inputs/Comtrade Country Code and ISO list.xlsx",sheet_name="Sheet1")
+    comm_number_list = get_comm_number_list(commodity_dict)
     mat_trad = sparse.csc_matrix((len(uncomtrade_area_list),len(uncomtrade_area_list)))
     #Create the dataset from the the databased associated with the specific year and the considered commodities
-    for comm_number in comm_number_list:
-        #1) Extract data from UN COMTRADE. Process them.
-        #Get data (for imports and exports)
-        dataset = get_commodity_data(reporting_area="all",partner_area="all",trade_type="all",commodity_code=comm_number,year=year,classification=commodity_dict["classification"])
-        #Eliminate re-imports or re-exports. Only consider imports and exports. Eliminate imports and exports from same partner
-        dataset = dataset.loc[dataset["rtCode"]!=dataset["ptCode"]].reset_index(drop=True)
-        #Only consider trade reported as imports or exports
-        dataset = dataset.loc[dataset["rgCode"].isin([1,2])].reset_index(drop=True)
-        #World partner is a summary of a country with world. Delete rows
-        dataset = dataset.loc[dataset["ptCode"]!=0].reset_index(drop=True)
-        #Some errors in data (nan). 
-        dataset = dataset.loc[dataset["NetWeight"].notnull()].reset_index(drop=True)
-        
+    #1) Extract data from UN COMTRADE. Process them.
+    #Get data (for imports and exports) of all the commodities. The requests are sent concurrently.
+    dataset_list = get_commodity_data_batch([{"reporting_area":"all","partner_area":"all","trade_type":"all","commodity_code":comm_number,"year":year,"classification":commodity_dict["classification"]} for comm_number in comm_number_list],base_url=base_url,cache_dir=cache_dir)
+    for dataset in dataset_list:
         #2) Create a dataset of transactions. Each row is a transaction, with one variable for importer value, and one for exporter value
-        #First for imports
-        imports_dt = dataset.loc[dataset["rgCode"].isin([1])].reset_index(drop=True)[['rtCode','ptCode','NetWeight']]
-        imports_dt = imports_dt.rename({"rtCode":"Importer","ptCode":"Exporter","NetWeight":"Reported_imports"},axis="columns") 
-        #Second for exports
-        exports_dt = dataset.loc[dataset["rgCode"].isin([2])].reset_index(drop=True)[['rtCode','ptCode','NetWeight']]
-        exports_dt = exports_dt.rename({"rtCode":"Exporter","ptCode":"Importer","NetWeight":"Reported_exports"},axis="columns") 
-        #Merge the two dataset
-        trade_dt = imports_dt
-        trade_dt["Reported_exports"] = 0
-        for i in exports_dt.index:
-            #If existing data, update dataframe
-            if any(x==True for x in (trade_dt["Importer"]==exports_dt.loc[i,"Importer"]) & (trade_dt["Exporter"]==exports_dt.loc[i,"Exporter"])):
-                trade_dt.loc[(trade_dt["Importer"]==exports_dt.loc[i,"Importer"]) & (trade_dt["Exporter"]==exports_dt.loc[i,"Exporter"]),"Reported_exports"] = exports_dt.loc[i,"Reported_exports"]
-            #If not existing, create new row
-            else:
-                trade_dt = trade_dt.append(exports_dt.loc[i,],ignore_index=True)
-        #Convert NaN values in 0. We asssume no imports
-        trade_dt.loc[trade_dt["Reported_imports"].isnull(),"Reported_imports"] = 0
-        
-        #3) Calculate Accuracy level of the transactions
-        trade_dt["Accuracy_level"] = 1
-        trade_dt.loc[trade_dt["Reported_imports"]!=0,"Accuracy_level"] = abs(trade_dt.loc[trade_dt["Reported_imports"]!=0,"Reported_imports"].values-trade_dt.loc[trade_dt["Reported_imports"]!=0,"Reported_exports"].values)/trade_dt.loc[trade_dt["Reported_imports"]!=0,"Reported_imports"].values
-        accuracy_threshold = 0.2
-        
-        #4)Importer and exporter commodity specific reliability index
-        #Importer index
-        rim_dt = pd.DataFrame(trade_dt.groupby(["Importer"])["Reported_imports"].agg(sum)).rename({"Reported_imports":"Total_imports"},axis="columns")
-        accurate_imports_dt = pd.DataFrame(trade_dt.loc[trade_dt["Accuracy_level"]<=accuracy_threshold].groupby(["Importer"])["Reported_imports"].agg(sum)).rename({"Reported_imports":"Total_accurate_imports"},axis="columns")
-        #Combine data
-        rim_dt = rim_dt.join(accurate_imports_dt)
-        #Convert NaN values in 0
-        rim_dt.loc[rim_dt["Total_accurate_imports"].isnull(),"Total_accurate_imports"] = 0
-        #Calculate reliability index
-        rim_dt["Reliability_index"] = rim_dt["Total_accurate_imports"].values/rim_dt["Total_imports"].values*100
-        #Convert NaN values in 0. NaN means no total imports and no accurate. So we cannot judge the reliability.
-        rim_dt.loc[rim_dt["Reliability_index"].isnull(),"Reliability_index"] = 0
-        #Exporter index
-        rix_dt = pd.DataFrame(trade_dt.groupby(["Exporter"])["Reported_exports"].agg(sum)).rename({"Reported_exports":"Total_exports"},axis="columns")
-        accurate_exports_dt = pd.DataFrame(trade_dt.loc[trade_dt["Accuracy_level"]<=accuracy_threshold].groupby(["Exporter"])["Reported_exports"].agg(sum)).rename({"Reported_exports":"Total_accurate_exports"},axis="columns")
-        #Combine data
-        rix_dt = rix_dt.join(accurate_exports_dt)
-        #Convert NaN values in 0
-        rix_dt.loc[rix_dt["Total_accurate_exports"].isnull(),"Total_accurate_exports"] = 0
-        #Calculate reliability index
-        rix_dt["Reliability_index"] = rix_dt["Total_accurate_exports"].values/rix_dt["Total_exports"].values*100
-        #Convert NaN values in 0. NaN means no total exports and no accurate. So we cannot judge the reliability.
-        rix_dt.loc[rix_dt["Reliability_index"].isnull(),"Reliability_index"] = 0
-        
-        #5) Select the best trade data
-        #Fill the reliability indexes
-        trade_dt["RI_importer"] = [rim_dt.loc[rim_dt.index==trade_dt.loc[i,"Importer"],"Reliability_index"].values[0] for i in trade_dt.index]
-        trade_dt["RI_exporter"] = [rix_dt.loc[rix_dt.index==trade_dt.loc[i,"Exporter"],"Reliability_index"].values[0] for i in trade_dt.index]
-        #Choose the best value
-        trade_dt["Value"] = 0
-        for i in trade_dt.index:
-            if trade_dt.loc[i,"RI_importer"]>=trade_dt.loc[i,"RI_exporter"]:
-                trade_dt.loc[i,"Value"] = trade_dt.loc[i,"Reported_imports"]
-            else:
-                trade_dt.loc[i,"Value"] = trade_dt.loc[i,"Reported_exports"]
+        trade_dt = get_trade_records(dataset)
+        #3), 4) and 5) Calculate the reliability indexes of importers and exporters and select the best trade data
+        trade_dt = reconcile_trade_records(trade_dt,accuracy_threshold=accuracy_threshold)
         
         #6) Create matrix
         #Update dataset with importer and exporter indexes. The rows are the importer. The columns are the exporter.
-        trade_dt["index_importer"] = [uncomtrade_area_list[uncomtrade_area_list["ctyCode"]==trade_dt.loc[i,"Importer"]].index[0] for i in trade_dt.index]
-        trade_dt["index_exporter"] = [uncomtrade_area_list[uncomtrade_area_list["ctyCode"]==trade_dt.loc[i,"Exporter"]].index[0] for i in trade_dt.index]
+        trade_dt["index_importer"] = get_country_index(trade_dt["Importer"],column="ctyCode")
+        trade_dt["index_exporter"] = get_country_index(trade_dt["Exporter"],column="ctyCode")
         #Create sparse matrix from previous dataset
         temp_mat_trad = sparse.csc_matrix((trade_dt["Value"],(trade_dt["index_importer"],trade_dt["index_exporter"])),shape=(len(uncomtrade_area_list),len(uncomtrade_area_list)))
-    
-    #Create total matrix of bilateral trade data from previous matrix per commodity.
-    mat_trad = mat_trad+temp_mat_trad
+        #Create total matrix of bilateral trade data from previous matrix per commodity.
+        mat_trad = mat_trad+temp_mat_trad
     return mat_trad
 
+def get_mat_trad_reconciliation_sweep(commodity_dict=None,year=2000,accuracy_threshold_list=None,file_path_list=None,chunksize=100000,base_url=COMTRADE_API_URL,cache_dir="inputs/comtrade_cache"):
+    '''
+    Construct the trade matrices reconciliated with the method from Gehlhar for several accuracy thresholds (see get_mat_trad_reconciliation)
+    The records are downloaded (or read from bulk files) and parsed once. All thresholds are evaluated at once (see reconcile_trade_records_sweep).
+    Attributes:
+        commodity_dict is the dictionnary of the commodity to consider from UN Comtrade database. None is unwrought aluminium.
+            {"name":[NAMES_OF_COMODITY],
+            "level":LEVEL_OF_COMMODITY,
+            'classification':'H0'}
+        year
+        accuracy_threshold_list is the list of accuracy thresholds. None is [0.1,0.2,0.3].
+        file_path_list is the list of local bulk files (see read_comtrade_bulk_file). None uses UN Comtrade API (see get_commodity_data_batch).
+        chunksize is the number of records read at once from the bulk files
+        base_url and cache_dir: URL of UN Comtrade API and directory of the cache of payloads (see get_commodity_data_batch)
+    Output:
+        mat_trad_dict is the dictionnary of trade matrices {accuracy_threshold:mat_trad}. The matrices of the commodities are summed.
+        Unit: kg
+    '''
+    if commodity_dict is None:
+        commodity_dict = {"name":["Aluminium; unwrought"],"level":4,'classification':'H0'}
+    if accuracy_threshold_list is None:
+        accuracy_threshold_list = [0.1,0.2,0.3]
+    nb_country = len(get_reference_table("inputs/Comtrade Country Code and ISO list.xlsx",sheet_name="Sheet1"))
+    comm_number_list = [str(comm_number) for comm_number in get_comm_number_list(commodity_dict)]
+    #1) and 2) Create the datasets of transactions of all the commodities. Importer and exporter are the indexes of the countries.
+    trade_dt_list = []
+    if file_path_list is None:
+        dataset_list = get_commodity_data_batch([{"reporting_area":"all","partner_area":"all","trade_type":"all","commodity_code":comm_number,"year":year,"classification":commodity_dict["classification"]} for comm_number in comm_number_list],base_url=base_url,cache_dir=cache_dir)
+        for dataset in dataset_list:
+            trade_dt = get_trade_records(dataset)
+            trade_dt["Importer"] = get_country_index(trade_dt["Importer"],column="ctyCode")
+            trade_dt["Exporter"] = get_country_index(trade_dt["Exporter"],column="ctyCode")
+            trade_dt_list.append(trade_dt)
+    else:
+        trade_dt_dict = read_trade_records_from_bulk(file_path_list=file_path_list,comm_number_list=comm_number_list,year=year,chunksize=chunksize)
+        trade_dt_list = [trade_dt_dict[comm_number] for comm_number in comm_number_list]
+    #3), 4) and 5) Select the best trade data for all thresholds
+    mat_trad_dict = {accuracy_threshold:sparse.csc_matrix((nb_country,nb_country)) for accuracy_threshold in accuracy_threshold_list}
+    for trade_dt in trade_dt_list:
+        mat_value = reconcile_trade_records_sweep(trade_dt,accuracy_threshold_list=accuracy_threshold_list)
+        #6) Create matrices
+        for i,accuracy_threshold in enumerate(accuracy_threshold_list):
+            mat_trad_dict[accuracy_threshold] = mat_trad_dict[accuracy_threshold]+sparse.csc_matrix((mat_value[:,i],(trade_dt["Importer"].values,trade_dt["Exporter"].values)),shape=(nb_country,nb_country))
+    return mat_trad_dict
+
+#Correspondence between the columns of UN Comtrade bulk files and the columns of UN Comtrade API
+COMTRADE_BULK_COLUMNS = {"Year":"yr",
+                         "Trade Flow Code":"rgCode",
+                         "Reporter Code":"rtCode",
+                         "Partner Code":"ptCode",
+                         "Commodity Code":"cmdCode",
+                         "Qty Unit Code":"qtCode",
+                         "Netweight (kg)":"NetWeight"}
+COMTRADE_BULK_DTYPES = {"yr":np.int16,
+                        "rgCode":np.int8,
+                        "rtCode":np.int32,
+                        "ptCode":np.int32,
+                        "cmdCode":str,
+                        "qtCode":np.float32,
+                        "NetWeight":np.float64}
+
+def read_comtrade_bulk_file(file_path,comm_number_list,year=None,chunksize=100000):
+    '''
+    Read a UN Comtrade bulk file chunk by chunk
+    Attributes:
+        file_path is the path of the bulk file
+            .csv (can be compressed, e.g. .csv.gz or .zip): Comtrade bulk download format (e.g. "Reporter Code", "Netweight (kg)") or API column names
+            .json or .jsonl: one record per line with API column names (e.g. "rtCode", "NetWeight")
+        comm_number_list is the list of commodity codes to keep
+        year is the year to keep. None keeps all years.
+        chunksize is the number of records read at once
+    Output:
+        Generator of pandas.DataFrame with API column names (see COMTRADE_BULK_DTYPES) and compact dtypes
+    '''
+    comm_number_list = [str(comm_number) for comm_number in comm_number_list]
+    if ".json" in os.path.basename(file_path):
+        reader = pd.read_json(file_path,lines=True,chunksize=chunksize,dtype={"cmdCode":str})
+    else:
+        header = pd.read_csv(file_path,nrows=0).columns.tolist()
+        usecols = [col for col in header if col in COMTRADE_BULK_COLUMNS.keys() or col in COMTRADE_BULK_DTYPES.keys()]
+        dtype = {col:COMTRADE_BULK_DTYPES[COMTRADE_BULK_COLUMNS.get(col,col)] for col in usecols if COMTRADE_BULK_COLUMNS.get(col,col) in ["cmdCode","NetWeight","qtCode"]}
+        reader = pd.read_csv(file_path,usecols=usecols,dtype=dtype,chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk.rename(COMTRADE_BULK_COLUMNS,axis="columns")
+        chunk = chunk[[col for col in COMTRADE_BULK_DTYPES.keys() if col in chunk.columns]]
+        #Keep the selected commodities and year
+        is_selected = chunk["cmdCode"].astype(str).isin(comm_number_list).values
+        if year!=None and "yr" in chunk.columns:
+            is_selected = is_selected & (chunk["yr"].values==year)
+        chunk = chunk.loc[is_selected]
+        if len(chunk)==0:
+            continue
+        yield chunk.astype({col:col_dtype for col,col_dtype in COMTRADE_BULK_DTYPES.items() if col in chunk.columns and col not in ["rgCode","qtCode","yr"]})
+
+def read_mat_flow_from_bulk(file_path_list,comm_number_list,year=2000,kg_only=False,chunksize=100000):
+    '''
+    Read the bilateral flows of local UN Comtrade bulk files in sparse matrices by commodity and trade flow
+    Attributes:
+        file_path_list is the list of bulk files (see read_comtrade_bulk_file)
+        comm_number_list is the list of commodity codes
+        year
+        kg_only specifies if only the records in kilograms are kept (qtCode==8)
+        chunksize is the number of records read at once
+    Output:
+        mat_flow_dict is the dictionnary of matrices {(comm_number,rgCode):mat}. rgCode is 1 for imports and 2 for exports. The rows are the importer. The columns are the exporter.
+    '''
+    comm_number_list = [str(comm_number) for comm_number in comm_number_list]
+    uncomtrade_area_list = get_reference_table("inputs/Comtrade Country Code and ISO list.xlsx",sheet_name="Sheet1")
+    nb_country = len(uncomtrade_area_list)
+    #Sparse matrices by commodity and trade flow (1 is for imports, 2 for exports). The rows are the importer. The columns are the exporter.
+    mat_flow_dict = {}
+    for file_path in file_path_list:
+        for chunk in read_comtrade_bulk_file(file_path,comm_number_list,year=year,chunksize=chunksize):
+            #Same filters as get_mat_trad_raw and get_mat_trad_reconciliation
+            chunk = chunk.loc[(chunk["ptCode"]!=0) & (chunk["rtCode"]!=chunk["ptCode"]) & chunk["NetWeight"].notnull() & chunk["rgCode"].isin([1,2])]
+            if kg_only:
+                #qtCode == 8 represents values in kilograms
+                chunk = chunk.loc[chunk["qtCode"]==8]
+            for (comm_number,rg_code),flow_dt in chunk.groupby(["cmdCode","rgCode"]):
+                index_reporter = get_country_index(flow_dt["rtCode"].values,column="ctyCode")
+                index_partner = get_country_index(flow_dt["ptCode"].values,column="ctyCode")
+                #Attention: If imports, reporter is the importer. Otherwise, reporter is the exporter.
+                if rg_code==1:
+                    index_importer,index_exporter = index_reporter,index_partner
+                else:
+                    index_importer,index_exporter = index_partner,index_reporter
+                temp_mat = sparse.csr_matrix((flow_dt["NetWeight"].values,(index_importer,index_exporter)),shape=(nb_country,nb_country))
+                if (comm_number,rg_code) in mat_flow_dict:
+                    mat_flow_dict[(comm_number,rg_code)] = mat_flow_dict[(comm_number,rg_code)]+temp_mat
+                else:
+                    mat_flow_dict[(comm_number,rg_code)] = temp_mat
+    return mat_flow_dict
+
+def read_trade_records_from_bulk(file_path_list,comm_number_list,year=2000,chunksize=100000):
+    '''
+    Read the datasets of transactions (see get_trade_records) of local UN Comtrade bulk files by commodity
+    The files are read chunk by chunk. Only the records of the selected commodities and year are kept in memory.
+    The records reported many times for the same partners are handled as in get_mat_trad_reconciliation (see get_trade_records), so the records are kept in the order of the files.
+    Attributes:
+        file_path_list is the list of bulk files (see read_comtrade_bulk_file)
+        comm_number_list is the list of commodity codes
+        year
+        chunksize is the number of records read at once
+    Output:
+        trade_dt_dict is the dictionnary of datasets of transactions {comm_number:trade_dt}. Importer and Exporter are the indexes of the countries.
+    '''
+    comm_number_list = [str(comm_number) for comm_number in comm_number_list]
+    dataset_dict = {comm_number:[] for comm_number in comm_number_list}
+    for file_path in file_path_list:
+        for chunk in read_comtrade_bulk_file(file_path,comm_number_list,year=year,chunksize=chunksize):
+            for comm_number,dataset in chunk.groupby("cmdCode",sort=False):
+                dataset_dict[str(comm_number)].append(dataset[["rgCode","rtCode","ptCode","NetWeight"]])
+    trade_dt_dict = {}
+    for comm_number,dataset_list in dataset_dict.items():
+        if len(dataset_list)>0:
+            dataset = pd.concat(dataset_list,ignore_index=True)
+        else:
+            dataset = pd.DataFrame({"rgCode":[],"rtCode":[],"ptCode":[],"NetWeight":[]})
+        trade_dt = get_trade_records(dataset)
+        trade_dt["Importer"] = get_country_index(trade_dt["Importer"],column="ctyCode")
+        trade_dt["Exporter"] = get_country_index(trade_dt["Exporter"],column="ctyCode")
+        trade_dt_dict[comm_number] = trade_dt
+    return trade_dt_dict
+
+def get_mat_trad_from_bulk(file_path_list,commodity_dict=None,year=2000,trade_data_type="reconciliated",accuracy_threshold=0.2,chunksize=100000):
+    '''
+    Construct the trade matrix from local UN Comtrade bulk files (no request to UN Comtrade API)
+    The files are read chunk by chunk. The bilateral flows of imports and exports are accumulated in sparse matrices, so the memory does not depend on the size of the files. The reconciliation only keeps the records of the selected commodities in memory (see read_trade_records_from_bulk).
+    Attributes:
+        file_path_list is the list of bulk files (see read_comtrade_bulk_file)
+        commodity_dict is the dictionnary of the commodity to consider from UN Comtrade database. None is unwrought aluminium.
+            {"name":[NAMES_OF_COMODITY],
+            "level":LEVEL_OF_COMMODITY,
+            'classification':'H0'}
+        year
+        trade_data_type is the type of trade data to consider
+            'imports' (see get_mat_trad_raw with trade_type=1) | 'exports' (see get_mat_trad_raw with trade_type=2) | 'reconciliated' (see get_mat_trad_reconciliation)
+        accuracy_threshold is the accuracy threshold of the reconciliation
+        chunksize is the number of records read at once
+    Output:
+        mat_trad is the trade matrix. The rows are the importer. The columns are the exporter.
+        The matrices of the commodities are summed. For imports and exports, records reported many times for the same commodity and partners are summed (as in get_mat_trad_raw). For the reconciliation, they are handled as in get_mat_trad_reconciliation (see get_trade_records).
+        Unit: kg
+    '''
+    if commodity_dict is None:
+        commodity_dict = {"name":["Aluminium; unwrought"],"level":4,'classification':'H0'}
+    if trade_data_type not in ["imports","exports","reconciliated"]:
+        raise ValueError("Unknown trade data type: {trade_data_type}".format(trade_data_type=trade_data_type))
+    comm_number_list = [str(comm_number) for comm_number in get_comm_number_list(commodity_dict)]
+    nb_country = len(get_reference_table("inputs/Comtrade Country Code and ISO list.xlsx",sheet_name="Sheet1"))
+    mat_trad = sparse.csc_matrix((nb_country,nb_country))
+    if trade_data_type=="reconciliated":
+        trade_dt_dict = read_trade_records_from_bulk(file_path_list=file_path_list,comm_number_list=comm_number_list,year=year,chunksize=chunksize)
+        for comm_number in comm_number_list:
+            trade_dt = reconcile_trade_records(trade_dt_dict[comm_number],accuracy_threshold=accuracy_threshold)
+            mat_trad = mat_trad+sparse.csc_matrix((trade_dt["Value"],(trade_dt["Importer"],trade_dt["Exporter"])),shape=(nb_country,nb_country))
+    else:
+        mat_flow_dict = read_mat_flow_from_bulk(file_path_list=file_path_list,comm_number_list=comm_number_list,year=year,kg_only=True,chunksize=chunksize)
+        #rgCode is 1 for imports and 2 for exports
+        rg_code = 1 if trade_data_type=="imports" else 2
+        for comm_number in comm_number_list:
+            mat_trad = mat_trad+mat_flow_dict.get((comm_number,rg_code),sparse.csr_matrix((nb_country,nb_country)))
+    return sparse.csc_matrix(mat_trad)
+
+def get_mat_trad_file_name(mineral="aluminium",year=2000,trade_data_type="reconciliated"):
+    '''
+    Return the name of the .npz file of the bilateral trade matrix in the internal inputs
+    Attributes:
+        mineral
+            'aluminium' | 'alumina' | 'bauxite'
+        year
+        trade_data_type
+            'imports' | 'exports' | 'reconciliated' | 'reconciliated_THRESHOLD'
+    '''
+    file_prefix_dict = {"imports":"mat_imports_",
+                        "exports":"mat_exports_",
+                        "reconciliated":"mat_recon_trade_"}
+    #Matrices reconciliated with another accuracy threshold (see sweep_trade_store), e.g. 'reconciliated_0.1'
+    if trade_data_type.startswith("reconciliated_"):
+        return "inputs/internal/mat_recon_trade_"+trade_data_type[len("reconciliated_"):]+"_"+mineral+"_"+str(year)+".npz"
+    if trade_data_type not in file_prefix_dict.keys():
+        raise ValueError("Unknown trade data type: {trade_data_type}".format(trade_data_type=trade_data_type))
+    return "inputs/internal/"+file_prefix_dict[trade_data_type]+mineral+"_"+str(year)+".npz"
+
+#Checksums of files by (path, modification time, size)
+_file_checksum_dict = {}
+
+def get_file_checksum(file_path):
+    '''
+    Return the SHA-1 checksum of a file. The checksum is only recalculated when the file is modified.
+    '''
+    file_stat = os.stat(file_path)
+    stat_key = (file_path,file_stat.st_mtime_ns,file_stat.st_size)
+    if stat_key not in _file_checksum_dict:
+        with open(file_path,"rb") as f:
+            _file_checksum_dict[stat_key] = hashlib.sha1(f.read()).hexdigest()
+    return _file_checksum_dict[stat_key]
+
+def write_trade_store(mat_dict,store_path="inputs/internal/mat_trade_store.bin",source_checksum_dict=None):
+    '''
+    Write bilateral trade matrices in a single uncompressed file that can be memory-mapped
+    The file contains a JSON header followed by the CSR arrays (indptr, indices, data) of all the matrices concatenated.
+    Attributes:
+        mat_dict is the dictionnary of matrices to store. All matrices must have the same shape.
+            {(mineral,trade_data_type,year):mat_trad}
+        store_path is the path of the store
+        source_checksum_dict is the dictionnary of the checksums of the .npz files the matrices are converted from {(mineral,trade_data_type,year):checksum}.
+            get_mat_trad uses the .npz file instead of the store when the checksum of the .npz file changes. None for matrices without .npz file.
+    '''
+    if source_checksum_dict==None:
+        source_checksum_dict = {}
+    key_list = list(mat_dict.keys())
+    shape_list = list(set([mat_dict[key].shape for key in key_list]))
+    if len(shape_list)!=1:
+        raise ValueError("All matrices of the trade store must have the same shape")
+    shape = shape_list[0]
+    #Convert all matrices in canonical CSR format
+    csr_list = []
+    for key in key_list:
+        mat_trad = sparse.csr_matrix(mat_dict[key],dtype=np.float64)
+        mat_trad.sum_duplicates()
+        mat_trad.sort_indices()
+        csr_list.append(mat_trad)
+    #indptr contains the position of the rows of all matrices in the concatenated indices and data arrays
+    nnz_offset = np.cumsum([0]+[mat_trad.nnz for mat_trad in csr_list])
+    indptr = np.vstack([mat_trad.indptr.astype(np.int64)+nnz_offset[i] for i,mat_trad in enumerate(csr_list)]) if len(csr_list)>0 else np.zeros((0,shape[0]+1),dtype=np.int64)
+    indices = np.concatenate([mat_trad.indices.astype(np.int32) for mat_trad in csr_list]+[np.zeros(0,dtype=np.int32)])
+    data = np.concatenate([mat_trad.data for mat_trad in csr_list]+[np.zeros(0,dtype=np.float64)])
+    #Position of arrays in file. Arrays are aligned on 64 bytes.
+    array_dict = {"indptr":indptr,"indices":indices,"data":data}
+    header = {"shape":list(shape),
+              "keys":[[key[0],key[1],int(key[2])] for key in key_list],
+              "sources":[source_checksum_dict.get(key) for key in key_list],
+              "checksums":[get_csr_checksum(mat_trad) for mat_trad in csr_list],
+              "arrays":{array_name:{"offset":0,"dtype":array.dtype.str,"shape":list(array.shape)} for array_name,array in array_dict.items()}}
+    #The header starts after the magic string and the header length (16 bytes). Margin of 64 bytes per array for the offsets.
+    offset = 64*(1+(16+len(json.dumps(header))+64*len(array_dict))//64)
+    for array_name,array in array_dict.items():
+        header["arrays"][array_name]["offset"] = offset
+        offset = offset+64*(1+array.nbytes//64)
+    header_bytes = json.dumps(header).encode("utf-8")
+    #The store is written in a temporary file and then replaced. The mapping of the current store must be released before (a mapped file cannot be replaced on Windows).
+    with open(store_path+".tmp","wb") as f:
+        f.write(b"MATSTORE")
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for array_name,array in array_dict.items():
+            f.seek(header["arrays"][array_name]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(offset)
+    close_trade_store(store_path=store_path)
+    os.replace(store_path+".tmp",store_path)
+    return
+
+def get_csr_checksum(mat_trad):
+    '''
+    Return the SHA-1 checksum of the CSR arrays (indptr, indices, data) of a matrix in canonical format, as stored in the trade store
+    '''
+    indptr = np.asarray(mat_trad.indptr,dtype=np.int64)
+    return hashlib.sha1(np.ascontiguousarray(indptr-indptr[0]).tobytes()+np.ascontiguousarray(mat_trad.indices,dtype=np.int32).tobytes()+np.ascontiguousarray(mat_trad.data,dtype=np.float64).tobytes()).hexdigest()
+
+def build_trade_store(store_path="inputs/internal/mat_trade_store.bin",
+                      mineral_list=['aluminium','alumina','bauxite'],
+                      year_list=range(2000,2018),
+                      trade_data_type_list=["imports","exports","reconciliated"]):
+    '''
+    Convert the .npz files of bilateral trade matrices of the internal inputs in a single trade store
+    The store is a generated file (not versioned). It must be built again with this function when the .npz files change.
+    Attributes:
+        store_path is the path of the store to create
+        mineral_list, year_list and trade_data_type_list are the matrices to include in the store
+    '''
+    mat_dict = {}
+    source_checksum_dict = {}
+    for mineral in mineral_list:
+        for trade_data_type in trade_data_type_list:
+            for year in year_list:
+                file_name = get_mat_trad_file_name(mineral=mineral,year=year,trade_data_type=trade_data_type)
+                mat_dict[(mineral,trade_data_type,year)] = sparse.load_npz(file_name)
+                source_checksum_dict[(mineral,trade_data_type,year)] = get_file_checksum(file_name)
+    write_trade_store(mat_dict=mat_dict,store_path=store_path,source_checksum_dict=source_checksum_dict)
+    return
+
+def update_trade_store(mat_dict,store_path="inputs/internal/mat_trade_store.bin"):
+    '''
+    Add (or replace) bilateral trade matrices in the trade store. The matrices already in the store are kept.
+    Attributes:
+        mat_dict is the dictionnary of matrices to add {(mineral,trade_data_type,year):mat_trad}
+        store_path is the path of the store
+    '''
+    all_mat_dict = {}
+    source_checksum_dict = {}
+    if os.path.exists(store_path):
+        store = open_trade_store(store_path=store_path)
+        for key,position in store["keys"].items():
+            mineral,trade_data_type,year = key
+            #Outdated matrices are replaced by the .npz file (see get_mat_trad)
+            all_mat_dict[key] = get_mat_trad(mineral=mineral,year=year,trade_data_type=trade_data_type,store_path=store_path).copy()
+            file_name = get_mat_trad_file_name(mineral=mineral,year=year,trade_data_type=trade_data_type)
+            if store["sources"][position]!=None and os.path.exists(file_name):
+                source_checksum_dict[key] = get_file_checksum(file_name)
+            else:
+                source_checksum_dict[key] = store["sources"][position]
+        del store
+    all_mat_dict.update(mat_dict)
+    for key in mat_dict.keys():
+        source_checksum_dict.pop(key,None)
+    write_trade_store(mat_dict=all_mat_dict,store_path=store_path,source_checksum_dict=source_checksum_dict)
+    return
+
+def sweep_trade_store(mineral="aluminium",
+                      commodity_dict=None,
+                      year_list=range(2000,2018),
+                      accuracy_threshold_list=None,
+                      file_path_list=None,
+                      store_path="inputs/internal/mat_trade_store.bin"):
+    '''
+    Add the trade matrices reconciliated with several accuracy thresholds in the trade store (see get_mat_trad_reconciliation_sweep)
+    The matrices are stored with the trade data type 'reconciliated_THRESHOLD' (e.g. 'reconciliated_0.1') and can be used with get_mat_trad and get_mat_cons.
+    Attributes:
+        mineral is the name of the mineral in the store
+        commodity_dict is the dictionnary of the commodity to consider from UN Comtrade database. None is unwrought aluminium.
+        year_list is the list of years
+        accuracy_threshold_list is the list of accuracy thresholds. None is [0.1,0.2,0.3].
+        file_path_list is the list of local bulk files. None uses UN Comtrade API.
+        store_path is the path of the store
+    '''
+    mat_dict = {}
+    for year in year_list:
+        mat_trad_dict = get_mat_trad_reconciliation_sweep(commodity_dict=commodity_dict,year=year,accuracy_threshold_list=accuracy_threshold_list,file_path_list=file_path_list)
+        for accuracy_threshold,mat_trad in mat_trad_dict.items():
+            mat_dict[(mineral,"reconciliated_"+str(accuracy_threshold),year)] = mat_trad
+    update_trade_store(mat_dict=mat_dict,store_path=store_path)
+    return
+
+#Opened trade stores by path: (status of the file, store)
+_trade_store_dict = {}
+
+def open_trade_store(store_path="inputs/internal/mat_trade_store.bin"):
+    '''
+    Open the trade store as memory-mapped arrays. Opened stores are kept until the file is modified.
+    Attributes:
+        store_path is the path of the store
+    Output:
+        store is a dictionnary with the keys, the checksums of the .npz files and of the matrices, the shape and the memory-mapped CSR arrays
+            {'keys':{(mineral,trade_data_type,year):position},'sources':[checksum],'checksums':[checksum],'shape':shape,'indptr':array,'indices':array,'data':array}
+    '''
+    file_stat = os.stat(store_path)
+    stat_key = (file_stat.st_mtime_ns,file_stat.st_size,file_stat.st_ino)
+    if store_path in _trade_store_dict and _trade_store_dict[store_path][0]==stat_key:
+        return _trade_store_dict[store_path][1]
+    close_trade_store(store_path=store_path)
+    with open(store_path,"rb") as f:
+        if f.read(8)!=b"MATSTORE":
+            raise ValueError("{path} is not a trade store".format(path=store_path))
+        header_length = int(np.frombuffer(f.read(8),dtype=np.uint64)[0])
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    store = {"keys":{tuple(key):i for i,key in enumerate(header["keys"])},
+             "sources":header.get("sources",[None]*len(header["keys"])),
+             "checksums":header.get("checksums",[None]*len(header["keys"])),
+             "shape":tuple(header["shape"])}
+    for array_name,array_info in header["arrays"].items():
+        if np.prod(array_info["shape"])==0:
+            store[array_name] = np.zeros(array_info["shape"],dtype=array_info["dtype"])
+        else:
+            store[array_name] = np.memmap(store_path,dtype=array_info["dtype"],mode="r",offset=array_info["offset"],shape=tuple(array_info["shape"]))
+    _trade_store_dict[store_path] = (stat_key,store)
+    return store
+
+def close_trade_store(store_path="inputs/internal/mat_trade_store.bin"):
+    '''
+    Remove the trade store from the opened stores and release its memory-mapped arrays
+    The mapping of the file is closed when the arrays are deleted, i.e. immediately if no matrix of the store is used anymore.
+    Attributes:
+        store_path is the path of the store
+    '''
+    if store_path not in _trade_store_dict:
+        return
+    store = _trade_store_dict.pop(store_path)[1]
+    array_ref_list = [weakref.ref(store[array_name]) for array_name in ["indptr","indices","data"]]
+    del store
+    if any([array_ref() is not None for array_ref in array_ref_list]):
+        logging.warning("Matrices of the trade store {path} are still used. The file stays mapped until they are deleted.".format(path=store_path))
+    return
+
+def get_trade_store_entry(mineral="aluminium",year=2000,trade_data_type="reconciliated",store_path="inputs/internal/mat_trade_store.bin"):
+    '''
+    Return the opened trade store and the position of a matrix in the store (see get_mat_trad)
+    Output:
+        store, position. store is None if the matrix is not in the store. position is None if the .npz file was modified after the conversion in the store.
+    '''
+    if store_path==None or not os.path.exists(store_path):
+        return None,None
+    store = open_trade_store(store_path=store_path)
+    if (mineral,trade_data_type,year) not in store["keys"]:
+        return None,None
+    position = store["keys"][(mineral,trade_data_type,year)]
+    source_checksum = store["sources"][position]
+    file_name = get_mat_trad_file_name(mineral=mineral,year=year,trade_data_type=trade_data_type)
+    if source_checksum!=None and os.path.exists(file_name) and get_file_checksum(file_name)!=source_checksum:
+        return store,None
+    return store,position
+
+def get_mat_trad_checksum(mineral="aluminium",year=2000,trade_data_type="reconciliated",store_path="inputs/internal/mat_trade_store.bin"):
+    '''
+    Return the checksum of the bilateral trade matrix returned by get_mat_trad: checksum of the matrix in the trade store, or of the .npz file. None if the matrix does not exist.
+    Only the matrix is considered, so the other matrices of the store can be modified without changing the checksum.
+    '''
+    store,position = get_trade_store_entry(mineral=mineral,year=year,trade_data_type=trade_data_type,store_path=store_path)
+    if position!=None:
+        #Stores written before the checksums of the matrices
+        if store["checksums"][position]==None:
+            store["checksums"][position] = get_csr_checksum(get_mat_trad(mineral=mineral,year=year,trade_data_type=trade_data_type,store_path=store_path))
+        return "store:"+store["checksums"][position]
+    file_name = get_mat_trad_file_name(mineral=mineral,year=year,trade_data_type=trade_data_type)
+    if os.path.exists(file_name):
+        return get_file_checksum(file_name)
+    return None
+
+def get_mat_trad(mineral="aluminium",year=2000,trade_data_type="reconciliated",store_path="inputs/internal/mat_trade_store.bin"):
+    '''
+    Return the bilateral trade matrix from the internal inputs
+    The matrix is sliced from the memory-mapped trade store if available (no decompression and no copy of the data). Otherwise, it is loaded from the .npz file.
+    The .npz file is also used when it was modified after the conversion in the store.
+    Attributes:
+        mineral
+            'aluminium' | 'alumina' | 'bauxite'
+        year
+        trade_data_type
+            'imports' | 'exports' | 'reconciliated'
+        store_path is the path of the trade store
+    Output:
+        mat_trad is the trade matrix. The rows are the importer. The columns are the exporter.
+        The matrix shares its memory with the store, so it must not be modified in place.
+    '''
+    file_name = get_mat_trad_file_name(mineral=mineral,year=year,trade_data_type=trade_data_type)
+    store,position = get_trade_store_entry(mineral=mineral,year=year,trade_data_type=trade_data_type,store_path=store_path)
+    if store!=None and position==None:
+        logging.warning("{file_name} was modified after the conversion in the trade store {path}. The .npz file is used. Build the store again with build_trade_store.".format(file_name=file_name,path=store_path))
+    elif position!=None:
+        indptr = store["indptr"][position]
+        mat_trad = sparse.csr_matrix((store["data"][indptr[0]:indptr[-1]],store["indices"][indptr[0]:indptr[-1]],np.asarray(indptr-indptr[0])),shape=store["shape"])
+        mat_trad.has_canonical_format = True
+        return mat_trad
+    return sparse.load_npz(file_name)
+
+def get_vec_prod(mineral="aluminium",year_list=[2000]):
+    '''
+    Construct the vectors of production for several years
+    Attributes:
+        mineral is the mineral to consider
+            aluminium | alumina | bauxite
+        year_list is the list of years
+    Output:
+        vec_prod is an array of production. Rows are the countries, columns are the years of year_list.
+        Unit: kg
+    '''
+    uncomtrade_area_list=get_reference_table("inputs/Comtrade Country Code and ISO list.xlsx",sheet_name="Sheet1")
+    file_name='inputs/'+mineral+'_production_data.csv'
+    prod_ds = get_reference_table(file_name).fillna(0)
+    year_list = list(year_list)
+    array_prod=prod_ds.loc[prod_ds['Year'].isin(year_list),['Country','Value','Year']]
+    array_prod.columns=["Country","Weight_ton","Year"]
+    array_prod["Index_producer"]=get_country_index(array_prod["Country"],column="cty Name English")
+    array_prod["Index_year"]=[year_list.index(year) for year in array_prod["Year"]]
+    vec_prod_th_ton=np.zeros((len(uncomtrade_area_list),len(year_list)))
+    np.add.at(vec_prod_th_ton,(array_prod["Index_producer"].values,array_prod["Index_year"].values),array_prod["Weight_ton"].values.astype(np.float64))
+    vec_prod = vec_prod_th_ton*pow(10,6)
+    return vec_prod
+
 def get_mat_prod(mineral="aluminium",year=2000):
     '''
     Construct the matrix of production
@@ -250,46 +974,23 @@ def get_mat_prod(mineral="aluminium",year=2000):
     Output:
         Unit:
     '''
-    uncomtrade_area_list=pd.read_excel("inputs/Comtrade Country Code and ISO list.xlsx",sheet_name="Sheet1")
-    file_name='inputs/'+mineral+'_production_data.csv'
-    prod_ds = pd.read_csv(file_name).fillna(0)
+    vec_prod = get_vec_prod(mineral=mineral,year_list=[year])[:,0]
     #Create production matrix
-    array_prod=prod_ds.loc[prod_ds['Year']==year,['Country','Value']]
-    array_prod.columns=["Country","Weight_ton"]
-    array_prod["Index_producer"]=0
-    for i in array_prod.index:
-        array_prod.loc[i,"Index_producer"]=uncomtrade_area_list[uncomtrade_area_list["cty Name English"]==array_prod.loc[i,"Country"]].index[0]
-    mat_prod_th_ton = sparse.csc_matrix((array_prod["Weight_ton"],(array_prod["Index_producer"],array_prod["Index_producer"])),(len(uncomtrade_area_list),len(uncomtrade_area_list)))
-    mat_prod = mat_prod_th_ton.multiply(pow(10,6))
+    index_producer = np.flatnonzero(vec_prod)
+    mat_prod = sparse.csc_matrix((vec_prod[index_producer],(index_producer,index_producer)),(len(vec_prod),len(vec_prod)))
     return mat_prod
 
-def calculate_mat_cons_kastner(mineral="aluminium",year=2000,trade_data_type="reconciliated"):
+def get_kastner_system(mat_trad,mat_prod):
     '''
-    Return matrix of apparent national level consumption according to country of origin based on Kastner et al. model
-    The calculations include the iterative imports of imports
+    Return the components of the Kastner et al. model from the bilateral trade and production matrices
     Attributes:
-        mineral to consider in the production
-            'aluminium' | 'alumina' | 'bauxite'
-        year
-        from_local specifies if data are taken from online api of from local data
-            "y" | "n"
+        mat_trad is the trade matrix. The rows are the importer. The columns are the exporter.
+        mat_prod is the matrix of production (production in diagonal)
     Output:
-        R_hat is the matrix of apparent national level consumption according to country of origin
-        Rows are the consuming countries, columns are the producing countries.
-        Rij is the part of the apparent consumption of country i produced from country j.
-        Unit:
+        mat_ex_share is the export share matrix (A in the math model)
+        vec_dmi_adj is the vector of domestic production plus imports adjusted with inventory changes (x in the math model)
+        vec_cons is the share of DMI used for national consumption
     '''
-    uncomtrade_area_list=pd.read_excel("inputs/Comtrade Country Code and ISO list.xlsx",sheet_name="Sheet1")
-    #Get bilateral matrix data
-    if trade_data_type=="imports":
-        mat_trad = sparse.load_npz("inputs/internal/mat_imports_"+mineral+"_"+str(year)+".npz")
-    elif trade_data_type=="exports":
-        mat_trad = sparse.load_npz("inputs/internal/mat_exports_"+mineral+"_"+str(year)+".npz")
-    elif trade_data_type=="reconciliated":
-        mat_trad = sparse.load_npz("inputs/internal/mat_recon_trade_"+mineral+"_"+str(year)+".npz")
-    #Get production matrix data
-    mat_prod = get_mat_prod(mineral=mineral,year=year)
-    #Convert tons in kg
     #Create the vector of domestic production plus imports (DMI) (x in the math model). Checked.
     vec_dmi = mat_prod.sum(axis=1) + mat_trad.sum(axis=1)
     #Consistency check: DMI should always by higher than the exports in a given region. If not, create an inventory change vector to add to the DMI vector.
@@ -298,36 +999,486 @@ def calculate_mat_cons_kastner(mineral="aluminium",year=2000,trade_data_type="re
     vec_inv[vec_inv<0]=0
     print("Inventory changes account for {} % of domestic production plus imports".format(round(vec_inv.sum()/vec_dmi.sum()*100,ndigits=2)))
     #Adjusting the DMI
-    vec_dmi_adj=vec_dmi+vec_inv
+    vec_dmi_adj=np.asarray(vec_dmi+vec_inv).ravel()
     """
     Mathematical issue: Some elements in the diagonal may be zero. Impossible to invert.
     Reason: Means that a country/region has no production nor import. Either no consumption, rely on inventory changes, or inconsistencies
     Solution: Force one as a value. Invert it. Then Force to 0 all 1 values.
     """
     vec_dmi_adj[vec_dmi_adj==0]=1
-    #Create the matrix containing DMI in diagonal (x_hat in the math model)
-    mat_dmi=sparse.csc_matrix((vec_dmi_adj.A1,(np.array(range(0,len(uncomtrade_area_list))),np.array(range(0,len(uncomtrade_area_list))))),shape=(len(uncomtrade_area_list),len(uncomtrade_area_list)))
-    #Create the reciprocal of vector of DMI (x_hat-1 in the math model)
-    inv_mat_dmi=linalg.inv(mat_dmi)
+    #Create the reciprocal of vector of DMI (x_hat-1 in the math model). The inverse of a diagonal matrix is the reciprocal of its diagonal.
+    vec_dmi_rec=1/vec_dmi_adj
     #Force the diagonal with 1 at 0
-    inv_mat_dmi[inv_mat_dmi==1]=0
-    #Calculate the export share matrix (A in the math model)  
-    mat_ex_share = mat_trad*inv_mat_dmi
-    #Check the consistency (the sums of the columns should be lower than 1). Otherwise means that the sum of the shares of exports is higher than the country's DMI
-    #Diagonal matrix with one in diagonals
-    mat_ones=sparse.eye(len(uncomtrade_area_list),len(uncomtrade_area_list))
-    #Create the matrix of DMI according to country of origin  
-    mat_dmi_ori=linalg.spsolve((mat_ones - mat_ex_share).tocsc(),mat_ones.tocsc())*mat_prod
+    vec_dmi_rec[vec_dmi_rec==1]=0
+    #Calculate the export share matrix (A in the math model)
+    mat_ex_share = sparse.csc_matrix(mat_trad*sparse.diags(vec_dmi_rec))
     #Create the vector of apparent consumption
     #Represent the share of DMI used for national consumption
-    vec_cons=(vec_dmi_adj-mat_trad.sum(axis=0).transpose())/vec_dmi_adj
+    vec_cons=(vec_dmi_adj-np.asarray(mat_trad.sum(axis=0)).ravel())/vec_dmi_adj
+    return mat_ex_share,vec_dmi_adj,vec_cons
+
+def get_kastner_vectors(vec_prod,vec_imp,vec_exp):
+    '''
+    Return the vectors of the Kastner et al. model from the production, imports and exports of the countries. Same assumptions as get_kastner_system.
+    Works with vectors (one country per element) or arrays (one country per row, one system per column).
+    Attributes:
+        vec_prod is the production
+        vec_imp is the imports (sum over the rows of the trade matrix)
+        vec_exp is the exports (sum over the columns of the trade matrix)
+    Output:
+        vec_dmi_adj is the vector of domestic production plus imports adjusted with inventory changes (x in the math model)
+        vec_dmi_rec is the reciprocal of vec_dmi_adj, with 0 for the countries without DMI
+        vec_cons is the share of DMI used for national consumption
+    '''
+    vec_dmi = vec_prod + vec_imp
+    vec_dmi_adj = vec_dmi + np.maximum(vec_exp-vec_dmi,0)
+    vec_dmi_adj[vec_dmi_adj==0] = 1
+    vec_dmi_rec = 1/vec_dmi_adj
+    vec_dmi_rec[vec_dmi_rec==1] = 0
+    vec_cons = (vec_dmi_adj-vec_exp)/vec_dmi_adj
+    return vec_dmi_adj,vec_dmi_rec,vec_cons
+
+def solve_mat_dmi_ori(mat_ex_share,mat_prod,solver="lu",tol=1e-10,maxiter=None,x0=None):
+    '''
+    Return the matrix of DMI according to country of origin ((I-A)^-1 * mat_prod in the math model)
+    Attributes:
+        mat_ex_share is the export share matrix (A in the math model)
+        mat_prod is the matrix of production (production in diagonal)
+        solver is the method to solve the system
+            "lu": Factorize (I-A) once with a sparse LU and only solve for the nonzero columns of mat_prod (producing countries)
+            "inverse": Calculate the full inverse of (I-A)
+            "neumann": Truncated Neumann series X = P + A*P + A^2*P + ... (iterations X(k+1) = P + A*X(k))
+            "gmres" | "bicgstab": Krylov solver for each producing country with an incomplete LU preconditioner
+        tol is the relative residual ||P-(I-A)*X||/||P|| to reach for each producing country (iterative solvers only)
+        maxiter is the maximum number of iterations (iterative solvers only)
+        x0 is the initial guess of mat_dmi_ori, e.g. the solution of the previous year (iterative solvers only)
+    Output:
+        mat_dmi_ori is the matrix of DMI according to country of origin. Rows are the countries, columns are the producing countries.
+    '''
+    mat_ones=sparse.eye(mat_ex_share.shape[0],mat_ex_share.shape[1])
+    if solver=="inverse":
+        return linalg.spsolve((mat_ones - mat_ex_share).tocsc(),mat_ones.tocsc())*mat_prod
+    mat_prod=sparse.csc_matrix(mat_prod)
+    #prod_index contains the index of the producing countries (nonzero columns of mat_prod)
+    prod_index=np.flatnonzero(np.diff(mat_prod.indptr))
+    mat_rhs=mat_prod[:,prod_index].toarray()
+    if solver=="lu":
+        lu=linalg.splu((mat_ones - mat_ex_share).tocsc())
+        temp_mat_dmi_ori=lu.solve(mat_rhs)
+    elif solver in ["neumann","gmres","bicgstab"]:
+        temp_mat_dmi_ori=solve_mat_dmi_ori_iterative(mat_ex_share=mat_ex_share,mat_rhs=mat_rhs,solver=solver,tol=tol,maxiter=maxiter,
+                                                     x0=None if x0 is None else sparse.csc_matrix(x0)[:,prod_index].toarray())
+    else:
+        raise ValueError("Unknown solver: {solver}".format(solver=solver))
+    #Put the solutions back in the columns of the producing countries
+    index_row,index_col=np.nonzero(temp_mat_dmi_ori)
+    mat_dmi_ori=sparse.csc_matrix((temp_mat_dmi_ori[index_row,index_col],(index_row,prod_index[index_col])),shape=mat_prod.shape)
+    return mat_dmi_ori
+
+def solve_mat_dmi_ori_iterative(mat_ex_share,mat_rhs,solver="gmres",tol=1e-10,maxiter=None,x0=None):
+    '''
+    Solve (I-A) * X = mat_rhs with an iterative solver. The number of iterations and the residuals are logged (logging.info), and the columns which did not converge raise a warning.
+    Attributes:
+        mat_ex_share is the export share matrix (A in the math model)
+        mat_rhs is the dense matrix of right-hand sides (one column per producing country)
+        solver
+            "neumann" | "gmres" | "bicgstab"
+        tol is the relative residual ||rhs-(I-A)*X||/||rhs|| to reach for each column
+        maxiter is the maximum number of iterations (default: 1000 for "neumann", the scipy default otherwise)
+        x0 is the dense initial guess of X (same shape as mat_rhs)
+    Output:
+        mat_x is the dense solution (same shape as mat_rhs)
+    '''
+    mat_ex_share=sparse.csr_matrix(mat_ex_share)
+    mat_sys=(sparse.eye(mat_ex_share.shape[0],format="csc") - mat_ex_share).tocsc()
+    vec_rhs_norm=np.linalg.norm(mat_rhs,axis=0)
+    vec_rhs_norm[vec_rhs_norm==0]=1
+    if x0 is None:
+        mat_x=mat_rhs.copy()
+    else:
+        mat_x=np.array(x0,dtype=np.float64)
+    if solver=="neumann":
+        #All columns are iterated together. The residual of X(k) is X(k+1)-X(k). The iterations are counted once for all columns.
+        if maxiter is None:
+            maxiter=1000
+        nb_iter=0
+        vec_res=np.linalg.norm(mat_rhs+mat_ex_share*mat_x-mat_x,axis=0)/vec_rhs_norm
+        while vec_res.max(initial=0)>tol and nb_iter<maxiter:
+            mat_x=mat_rhs+mat_ex_share*mat_x
+            nb_iter+=1
+            vec_res=np.linalg.norm(mat_rhs+mat_ex_share*mat_x-mat_x,axis=0)/vec_rhs_norm
+        list_iter=[nb_iter]
+    elif solver in ["gmres","bicgstab"]:
+        #Incomplete LU factorization of (I-A) as preconditioner
+        ilu=linalg.spilu(mat_sys)
+        mat_precond=linalg.LinearOperator(mat_sys.shape,ilu.solve)
+        list_iter=[]
+        for j in range(mat_rhs.shape[1]):
+            nb_iter=[0]
+            def count_iter(temp):
+                nb_iter[0]+=1
+            if solver=="gmres":
+                mat_x[:,j],info=linalg.gmres(mat_sys,mat_rhs[:,j],x0=mat_x[:,j],rtol=tol,atol=0.,maxiter=maxiter,M=mat_precond,callback=count_iter,callback_type="pr_norm")
+            else:
+                mat_x[:,j],info=linalg.bicgstab(mat_sys,mat_rhs[:,j],x0=mat_x[:,j],rtol=tol,atol=0.,maxiter=maxiter,M=mat_precond,callback=count_iter)
+            list_iter.append(nb_iter[0])
+        vec_res=np.linalg.norm(mat_rhs-mat_sys*mat_x,axis=0)/vec_rhs_norm
+    else:
+        raise ValueError("Unknown solver: {solver}".format(solver=solver))
+    if mat_rhs.shape[1]>0:
+        logging.info("Solver {solver}: {nb_col} columns, {nb_iter} iterations in total ({max_iter} max), max relative residual {res:.2e}".format(solver=solver,nb_col=mat_rhs.shape[1],nb_iter=sum(list_iter),max_iter=max(list_iter),res=vec_res.max()))
+        if vec_res.max()>tol:
+            logging.warning("Solver {solver}: {nb_col} columns did not converge to the tolerance {tol:.0e} (max relative residual {res:.2e})".format(solver=solver,nb_col=(vec_res>tol).sum(),tol=tol,res=vec_res.max()))
+    return mat_x
+
+def get_active_index(mat_trad,mat_prod):
+    '''
+    Return the index of the active countries, i.e. the countries which produce, import or export
+    The other countries have no DMI and no consumption. Their rows and columns are empty in all matrices of the Kastner et al. model.
+    Attributes:
+        mat_trad is the trade matrix. The rows are the importer. The columns are the exporter.
+        mat_prod is the matrix of production (production in diagonal)
+    Output:
+        active_index is the sorted array of index of the active countries
+    '''
+    mat_trad = sparse.csc_matrix(mat_trad)
+    mat_trad.eliminate_zeros()
+    mat_prod = sparse.csr_matrix(mat_prod)
+    mat_prod.eliminate_zeros()
+    is_active = (np.diff(mat_prod.indptr)>0) | (np.diff(mat_trad.indptr)>0) | (np.bincount(mat_trad.indices,minlength=mat_trad.shape[0])>0)
+    return np.flatnonzero(is_active)
+
+def compact_matrix(mat,active_index):
+    '''
+    Return the submatrix of the active countries (rows and columns) in CSC format
+    '''
+    return sparse.csc_matrix(mat)[active_index,:][:,active_index]
+
+def expand_matrix(mat,active_index,shape):
+    '''
+    Return the matrix of the active countries scattered back to all countries in CSC format (inverse of compact_matrix)
+    Attributes:
+        mat is the matrix of the active countries
+        active_index is the index of the active countries (see get_active_index)
+        shape is the shape of the matrix with all countries
+    '''
+    mat = sparse.coo_matrix(mat)
+    return sparse.csc_matrix((mat.data,(active_index[mat.row],active_index[mat.col])),shape=shape)
+
+def calculate_mat_cons_kastner(mineral="aluminium",year=2000,trade_data_type="reconciliated",solver="lu",tol=1e-10,maxiter=None,x0=None,compact=False,store_path="inputs/internal/mat_trade_store.bin"):
+    '''
+    Return matrix of apparent national level consumption according to country of origin based on Kastner et al. model
+    The calculations include the iterative imports of imports
+    Attributes:
+        mineral to consider in the production
+            'aluminium' | 'alumina' | 'bauxite'
+        year
+        from_local specifies if data are taken from online api of from local data
+            "y" | "n"
+        solver is the method to solve the system (see solve_mat_dmi_ori)
+            "lu" | "inverse" | "neumann" | "gmres" | "bicgstab"
+        tol, maxiter and x0 are the tolerance, maximum number of iterations and initial guess of the iterative solvers (see solve_mat_dmi_ori)
+        compact specifies if the system is reduced to the active countries (see get_active_index) before solving. All active countries have a nonzero DMI.
+        store_path is the path of the trade store (see get_mat_trad)
+    Output:
+        R_hat is the matrix of apparent national level consumption according to country of origin
+        Rows are the consuming countries, columns are the producing countries.
+        Rij is the part of the apparent consumption of country i produced from country j.
+        Unit:
+    '''
+    #Get bilateral matrix data
+    mat_trad = get_mat_trad(mineral=mineral,year=year,trade_data_type=trade_data_type,store_path=store_path)
+    #Get production matrix data
+    mat_prod = get_mat_prod(mineral=mineral,year=year)
+    if compact:
+        #Reduce the matrices to the active countries
+        shape = mat_trad.shape
+        active_index = get_active_index(mat_trad=mat_trad,mat_prod=mat_prod)
+        mat_trad = compact_matrix(mat_trad,active_index)
+        mat_prod = compact_matrix(mat_prod,active_index)
+        if x0 is not None:
+            x0 = compact_matrix(x0,active_index)
+    #Get the export share matrix, the adjusted DMI and the share of DMI used for national consumption
+    mat_ex_share,vec_dmi_adj,vec_cons = get_kastner_system(mat_trad=mat_trad,mat_prod=mat_prod)
+    #Create the matrix of DMI according to country of origin
+    mat_dmi_ori = solve_mat_dmi_ori(mat_ex_share=mat_ex_share,mat_prod=mat_prod,solver=solver,tol=tol,maxiter=maxiter,x0=x0)
     #Create the matrix of apparent consumption
-    mat_cons=sparse.csc_matrix((vec_cons.A1,(np.array(range(0,len(uncomtrade_area_list))),np.array(range(0,len(uncomtrade_area_list))))),shape=(len(uncomtrade_area_list),len(uncomtrade_area_list)))
+    mat_cons=sparse.diags(vec_cons,format="csc")
     #Create the matrix of apparent national level consumptionm according to country of origin (R_hat in the math model). 
     R_hat=mat_cons * mat_dmi_ori
+    if compact:
+        #Scatter back to all countries
+        R_hat = expand_matrix(R_hat,active_index,shape)
     return R_hat
 
-def calculate_mat_cons(mineral="aluminium",year=2000,trade_data_type="reconciliated"):
+def calculate_mat_cons_kastner_years(mineral="aluminium",year_list=range(2000,2018),trade_data_type="reconciliated",solver="lu",tol=1e-10,maxiter=None,compact=False):
+    '''
+    Return matrices of apparent national level consumption according to country of origin based on Kastner et al. model for several years (and minerals) in one pass
+    The DMI and inventory changes are calculated for all years at once. The column ordering of the sparse LU factorization is calculated once on the union of the sparsity patterns of all years and reused for every year.
+    With an iterative solver, the solution of each year is the initial guess of the next year (scaled by the production of each country).
+    Attributes:
+        mineral to consider in the production. A list of minerals can be provided.
+            'aluminium' | 'alumina' | 'bauxite'
+        year_list is the list of years
+        trade_data_type
+            'imports' | 'exports' | 'reconciliated'
+        solver is the method to solve the systems
+            "lu" | "neumann" | "gmres" | "bicgstab"
+        tol and maxiter are the tolerance and maximum number of iterations of the iterative solvers (see solve_mat_dmi_ori)
+        compact specifies if the systems are reduced to the countries active in at least one year (see get_active_index) before solving
+    Output:
+        R_hat_dict is the dictionnary of matrices of apparent national level consumption according to country of origin (see calculate_mat_cons_kastner)
+            {year:R_hat} if mineral is a string
+            {mineral:{year:R_hat}} if mineral is a list
+    '''
+    year_list = list(year_list)
+    if isinstance(mineral,str):
+        mineral_list = [mineral]
+    else:
+        mineral_list = list(mineral)
+    key_list = [(temp_mineral,year) for temp_mineral in mineral_list for year in year_list]
+    #Get bilateral trade matrices and production vectors
+    mat_trad_list = [sparse.csc_matrix(get_mat_trad(mineral=temp_mineral,year=year,trade_data_type=trade_data_type)) for temp_mineral,year in key_list]
+    vec_prod = np.hstack([get_vec_prod(mineral=temp_mineral,year_list=year_list) for temp_mineral in mineral_list])
+    shape = (vec_prod.shape[0],vec_prod.shape[0])
+    if compact:
+        #Reduce the matrices to the countries active in at least one year
+        active_index = get_active_index(mat_trad=sum(mat_trad_list),mat_prod=sparse.diags(abs(vec_prod).sum(axis=1)))
+        mat_trad_list = [compact_matrix(mat_trad,active_index) for mat_trad in mat_trad_list]
+        vec_prod = vec_prod[active_index,:]
+    #Imports (sum over rows) and exports (sum over columns) of all years. Rows are the countries, columns are the years.
+    vec_imp = np.column_stack([np.asarray(mat_trad.sum(axis=1)).ravel() for mat_trad in mat_trad_list])
+    vec_exp = np.column_stack([np.asarray(mat_trad.sum(axis=0)).ravel() for mat_trad in mat_trad_list])
+    #Create the vectors of domestic production plus imports (DMI) and inventory changes. Same assumptions as calculate_mat_cons_kastner.
+    vec_dmi = vec_prod + vec_imp
+    vec_inv = np.maximum(vec_exp-vec_dmi,0)
+    for i,(temp_mineral,year) in enumerate(key_list):
+        print("Inventory changes account for {} % of domestic production plus imports".format(round(vec_inv[:,i].sum()/vec_dmi[:,i].sum()*100,ndigits=2)))
+    vec_dmi_adj,vec_dmi_rec,vec_cons = get_kastner_vectors(vec_prod=vec_prod,vec_imp=vec_imp,vec_exp=vec_exp)
+    #Create the export share matrices A and the systems (I-A) of all years
+    mat_ones = sparse.eye(vec_prod.shape[0],format="csc")
+    mat_ex_share_list = [mat_trad*sparse.diags(vec_dmi_rec[:,i]) for i,mat_trad in enumerate(mat_trad_list)]
+    mat_sys_list = [(mat_ones - mat_ex_share).tocsc() for mat_ex_share in mat_ex_share_list]
+    if solver=="lu":
+        #Column ordering of the factorization from the union of the sparsity patterns
+        mat_pattern = sum([abs(mat_sys) for mat_sys in mat_sys_list]).tocsc()
+        col_order = np.argsort(linalg.splu(mat_pattern).perm_c)
+    elif solver not in ["neumann","gmres","bicgstab"]:
+        raise ValueError("Unknown solver: {solver}".format(solver=solver))
+    #Solutions per unit of production of the previous year (initial guess of the iterative solvers)
+    mat_unit_dict = {}
+    R_hat_dict = {}
+    for i,(temp_mineral,year) in enumerate(key_list):
+        prod_index = np.flatnonzero(vec_prod[:,i])
+        rhs = np.zeros((vec_prod.shape[0],len(prod_index)))
+        rhs[prod_index,np.arange(len(prod_index))] = vec_prod[prod_index,i]
+        if solver=="lu":
+            #Solve for the producing countries with the common column ordering
+            lu = linalg.splu(mat_sys_list[i][:,col_order],permc_spec="NATURAL")
+            temp_mat_dmi_ori = np.empty(rhs.shape)
+            temp_mat_dmi_ori[col_order,:] = lu.solve(rhs)
+        else:
+            mat_unit = mat_unit_dict.setdefault(temp_mineral,np.eye(vec_prod.shape[0]))
+            temp_mat_dmi_ori = solve_mat_dmi_ori_iterative(mat_ex_share=mat_ex_share_list[i],mat_rhs=rhs,solver=solver,tol=tol,maxiter=maxiter,
+                                                           x0=mat_unit[:,prod_index]*vec_prod[prod_index,i])
+            mat_unit[:,prod_index] = temp_mat_dmi_ori/vec_prod[prod_index,i]
+        #Create R_hat with the consumption shares in rows
+        temp_R_hat = vec_cons[:,[i]]*temp_mat_dmi_ori
+        index_row,index_col = np.nonzero(temp_R_hat)
+        R_hat = sparse.csc_matrix((temp_R_hat[index_row,index_col],(index_row,prod_index[index_col])),shape=mat_sys_list[i].shape)
+        if compact:
+            R_hat = expand_matrix(R_hat,active_index,shape)
+        R_hat_dict.setdefault(temp_mineral,{})[year] = R_hat
+    if isinstance(mineral,str):
+        return R_hat_dict[mineral]
+    return R_hat_dict
+
+def get_kastner_state(mineral="aluminium",year=2000,trade_data_type="reconciliated"):
+    '''
+    Return the solved Kastner et al. model of a given mineral and year. The state is used to evaluate trade or production shocks with update_mat_cons_kastner.
+    Attributes:
+        mineral to consider in the production
+            'aluminium' | 'alumina' | 'bauxite'
+        year
+        trade_data_type
+            'imports' | 'exports' | 'reconciliated'
+    Output:
+        kastner_state is a dictionnary with
+            mat_trad: the trade matrix (CSC)
+            vec_prod, vec_imp, vec_exp: the production, imports and exports of the countries
+            vec_dmi_rec, vec_cons: the components of the model (see get_kastner_vectors)
+            lu: the sparse LU factorization of (I-A)
+            mat_dmi_ori: the dense matrix of DMI according to country of origin ((I-A)^-1 * mat_prod)
+            R_hat: the matrix of apparent national level consumption according to country of origin (see calculate_mat_cons_kastner)
+    '''
+    mat_trad = sparse.csc_matrix(get_mat_trad(mineral=mineral,year=year,trade_data_type=trade_data_type),dtype=np.float64)
+    vec_prod = get_vec_prod(mineral=mineral,year_list=[year])[:,0]
+    vec_imp = np.asarray(mat_trad.sum(axis=1)).ravel()
+    vec_exp = np.asarray(mat_trad.sum(axis=0)).ravel()
+    vec_dmi_adj,vec_dmi_rec,vec_cons = get_kastner_vectors(vec_prod=vec_prod,vec_imp=vec_imp,vec_exp=vec_exp)
+    mat_ex_share = mat_trad*sparse.diags(vec_dmi_rec)
+    lu = linalg.splu((sparse.eye(mat_trad.shape[0],format="csc") - mat_ex_share).tocsc())
+    #Only solve for the producing countries
+    mat_dmi_ori = np.zeros(mat_trad.shape)
+    prod_index = np.flatnonzero(vec_prod)
+    if len(prod_index)>0:
+        mat_dmi_ori[:,prod_index] = lu.solve(np.diag(vec_prod)[:,prod_index])
+    kastner_state = {"mineral":mineral,
+                     "year":year,
+                     "trade_data_type":trade_data_type,
+                     "mat_trad":mat_trad,
+                     "vec_prod":vec_prod,
+                     "vec_imp":vec_imp,
+                     "vec_exp":vec_exp,
+                     "vec_dmi_rec":vec_dmi_rec,
+                     "vec_cons":vec_cons,
+                     "lu":lu,
+                     "mat_dmi_ori":mat_dmi_ori,
+                     "R_hat":sparse.csc_matrix(vec_cons[:,np.newaxis]*mat_dmi_ori)}
+    return kastner_state
+
+def update_mat_cons_kastner(kastner_state,delta_trad=None,delta_prod=None):
+    '''
+    Return the matrix of apparent national level consumption according to country of origin after a shock on trade and/or production, without solving the system again
+    A change of trade or production modifies the DMI of a few countries and thus only a few columns K of the export share matrix A.
+    The new system (I-A') = (I-A) - dA[:,K] * E_K' is solved with the Sherman-Morrison-Woodbury formula from the existing LU factorization:
+        (I-A')^-1 * P' = Y + W * (I_k - W[K,:])^-1 * Y[K,:], with Y = (I-A)^-1 * P' and W = (I-A)^-1 * dA[:,K]
+    Attributes:
+        kastner_state is the solved model (see get_kastner_state). The state is not modified.
+        delta_trad is the sparse change of the trade matrix (same shape as mat_trad)
+        delta_prod is the change of production. Either a vector or a sparse matrix with the changes in diagonal (same shape as mat_prod).
+    Output:
+        R_hat is the matrix of apparent national level consumption according to country of origin after the shock (see calculate_mat_cons_kastner)
+    '''
+    lu = kastner_state["lu"]
+    mat_trad = kastner_state["mat_trad"]
+    vec_prod = kastner_state["vec_prod"]
+    vec_imp = kastner_state["vec_imp"]
+    vec_exp = kastner_state["vec_exp"]
+    mat_dmi_ori = kastner_state["mat_dmi_ori"].copy()
+    #Countries with a change of trade
+    trad_index = np.array([],dtype=int)
+    if delta_trad is not None:
+        delta_trad = sparse.csc_matrix(delta_trad)
+        mat_trad = mat_trad + delta_trad
+        vec_imp = vec_imp + np.asarray(delta_trad.sum(axis=1)).ravel()
+        vec_exp = vec_exp + np.asarray(delta_trad.sum(axis=0)).ravel()
+        trad_index = np.flatnonzero(np.diff(delta_trad.indptr))
+    #Y: Solutions of the initial system for the new production. Only the countries with a change of production are solved again.
+    if delta_prod is not None:
+        if sparse.issparse(delta_prod):
+            delta_prod = delta_prod.diagonal()
+        vec_prod = vec_prod + np.asarray(delta_prod,dtype=np.float64).ravel()
+        prod_index = np.flatnonzero(delta_prod)
+        if len(prod_index)>0:
+            mat_dmi_ori[:,prod_index] = lu.solve(np.diag(vec_prod)[:,prod_index])
+    #Components of the model after the shock. Same assumptions (inventory changes, countries without DMI) as calculate_mat_cons_kastner.
+    vec_dmi_adj,vec_dmi_rec,vec_cons = get_kastner_vectors(vec_prod=vec_prod,vec_imp=vec_imp,vec_exp=vec_exp)
+    #K: Columns of the export share matrix modified by the shock (change of exports or of DMI)
+    col_index = np.union1d(trad_index,np.flatnonzero(vec_dmi_rec!=kastner_state["vec_dmi_rec"]))
+    if len(col_index)>0:
+        mat_delta_ex_share = mat_trad[:,col_index].toarray()*vec_dmi_rec[col_index] - kastner_state["mat_trad"][:,col_index].toarray()*kastner_state["vec_dmi_rec"][col_index]
+        #W = (I-A)^-1 * dA[:,K]
+        mat_w = lu.solve(mat_delta_ex_share)
+        #Capacitance matrix (I_k - W[K,:])
+        mat_capacitance = np.eye(len(col_index)) - mat_w[col_index,:]
+        mat_dmi_ori += mat_w.dot(np.linalg.solve(mat_capacitance,mat_dmi_ori[col_index,:]))
+    R_hat = sparse.csc_matrix(vec_cons[:,np.newaxis]*mat_dmi_ori)
+    return R_hat
+
+def solve_monte_carlo_draws(mat_trad_low,mat_trad_high,vec_prod,prod_uncertainty,nb_draw,seed):
+    '''
+    Solve draws of the Kastner et al. model with perturbed trade and production and return the consumption mixes (see calculate_mat_cons_kastner_monte_carlo)
+    Attributes:
+        mat_trad_low and mat_trad_high are the lower and upper bounds of the trade matrix. Each trade flow is drawn uniformly between its bounds.
+        vec_prod is the vector of production. The production of each country is multiplied by a factor drawn uniformly in [1-prod_uncertainty,1+prod_uncertainty].
+        nb_draw is the number of draws
+        seed is the seed of the random generator (np.random.SeedSequence or int)
+    Output:
+        mat_mix is the array of consumption mixes (float32). Dimensions are the draws, the consuming countries and the producing countries (nonzero values of vec_prod).
+        mat_mix(k,i,j) is the share of the consumption of country i produced from country j in draw k
+    '''
+    rng = np.random.default_rng(seed)
+    nb_country = vec_prod.shape[0]
+    #Trade flows on the union of the sparsity patterns of the bounds
+    mat_trad_low = sparse.csc_matrix(mat_trad_low,dtype=np.float64)
+    mat_trad_high = sparse.csc_matrix(mat_trad_high,dtype=np.float64)
+    mat_pattern = sparse.coo_matrix(abs(mat_trad_low)+abs(mat_trad_high)+abs(mat_trad_high-mat_trad_low))
+    index_row,index_col = mat_pattern.row,mat_pattern.col
+    vec_low = np.asarray(mat_trad_low[index_row,index_col]).ravel()
+    vec_delta = np.asarray(mat_trad_high[index_row,index_col]).ravel()-vec_low
+    prod_index = np.flatnonzero(vec_prod)
+    mat_ones = sparse.eye(nb_country,format="csc")
+    mat_mix = np.zeros((nb_draw,nb_country,len(prod_index)),dtype=np.float32)
+    for k in range(nb_draw):
+        vec_trad = vec_low + rng.random(len(vec_low))*vec_delta
+        temp_vec_prod = vec_prod*(1+prod_uncertainty*rng.uniform(-1,1,nb_country))
+        vec_imp = np.bincount(index_row,weights=vec_trad,minlength=nb_country)
+        vec_exp = np.bincount(index_col,weights=vec_trad,minlength=nb_country)
+        vec_dmi_adj,vec_dmi_rec,vec_cons = get_kastner_vectors(vec_prod=temp_vec_prod,vec_imp=vec_imp,vec_exp=vec_exp)
+        mat_ex_share = sparse.csc_matrix((vec_trad*vec_dmi_rec[index_col],(index_row,index_col)),shape=(nb_country,nb_country))
+        lu = linalg.splu((mat_ones - mat_ex_share).tocsc())
+        rhs = np.zeros((nb_country,len(prod_index)))
+        rhs[prod_index,np.arange(len(prod_index))] = temp_vec_prod[prod_index]
+        temp_R_hat = vec_cons[:,np.newaxis]*lu.solve(rhs)
+        #Consumption mix: R_hat relative to the consumption of each country (see get_relative_matrix)
+        vec_sum = temp_R_hat.sum(axis=1)
+        vec_sum[vec_sum==0] = np.inf
+        mat_mix[k] = temp_R_hat/vec_sum[:,np.newaxis]
+    return mat_mix
+
+def calculate_mat_cons_kastner_monte_carlo(mineral="aluminium",year=2000,nb_draw=1000,prod_uncertainty=0.1,percentile_list=[2.5,50,97.5],seed=None,max_workers=None,draw_per_task=50):
+    '''
+    Return percentile bands of the consumption mixes (relative apparent consumption according to country of origin) from a Monte Carlo ensemble of the Kastner et al. model
+    Each trade flow is drawn uniformly between the values reported by the importer and by the exporter (trade data types "imports" and "exports").
+    The production of each country is multiplied by a factor drawn uniformly in [1-prod_uncertainty,1+prod_uncertainty].
+    The draws are split in tasks of draw_per_task draws solved in a process pool. Each task has its own random stream spawned from seed, so the results only depend on seed and draw_per_task (not on max_workers).
+    The processes import the main module: scripts must call this function under if __name__=="__main__" on platforms without fork, or use max_workers=1.
+    Attributes:
+        mineral to consider in the production
+            'aluminium' | 'alumina' | 'bauxite'
+        year
+        nb_draw is the number of draws
+        prod_uncertainty is the relative uncertainty of the production
+        percentile_list is the list of percentiles to return
+        seed is the seed of the ensemble (None for a random seed)
+        max_workers is the number of processes. 1 solves the draws in the current process.
+        draw_per_task is the number of draws per task
+    Output:
+        mix_percentile_dict is the dictionnary of consumption mixes by percentile {percentile:mat_mix}
+        Rows are the consuming countries, columns are the producing countries.
+        mat_mix(i,j) is the percentile of the share of the consumption of country i produced from country j
+    '''
+    mat_trad_imp = sparse.csc_matrix(get_mat_trad(mineral=mineral,year=year,trade_data_type="imports"),dtype=np.float64)
+    mat_trad_exp = sparse.csc_matrix(get_mat_trad(mineral=mineral,year=year,trade_data_type="exports"),dtype=np.float64)
+    mat_trad_low = mat_trad_imp.minimum(mat_trad_exp)
+    mat_trad_high = mat_trad_imp.maximum(mat_trad_exp)
+    vec_prod = get_vec_prod(mineral=mineral,year_list=[year])[:,0]
+    shape = mat_trad_imp.shape
+    #Reduce the problem to the active countries
+    active_index = get_active_index(mat_trad=mat_trad_high,mat_prod=sparse.diags(vec_prod))
+    mat_trad_low = compact_matrix(mat_trad_low,active_index)
+    mat_trad_high = compact_matrix(mat_trad_high,active_index)
+    vec_prod = vec_prod[active_index]
+    #Tasks with independent random streams
+    task_size_list = [min(draw_per_task,nb_draw-i) for i in range(0,nb_draw,draw_per_task)]
+    seed_list = np.random.SeedSequence(seed).spawn(len(task_size_list))
+    task_list = [(mat_trad_low,mat_trad_high,vec_prod,prod_uncertainty,task_size,task_seed) for task_size,task_seed in zip(task_size_list,seed_list)]
+    if max_workers==1:
+        mat_mix_list = [solve_monte_carlo_draws(*task) for task in task_list]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            mat_mix_list = list(executor.map(solve_monte_carlo_draws,*zip(*task_list)))
+    mat_mix_percentile = np.percentile(np.concatenate(mat_mix_list,axis=0),percentile_list,axis=0)
+    #Scatter back to all countries
+    prod_index = active_index[np.flatnonzero(vec_prod)]
+    mix_percentile_dict = {}
+    for percentile,temp_mat_mix in zip(percentile_list,mat_mix_percentile):
+        index_row,index_col = np.nonzero(temp_mat_mix)
+        mix_percentile_dict[percentile] = sparse.csc_matrix((temp_mat_mix[index_row,index_col].astype(np.float64),(active_index[index_row],prod_index[index_col])),shape=shape)
+    return mix_percentile_dict
+
+def calculate_mat_cons(mineral="aluminium",year=2000,trade_data_type="reconciliated",store_path="inputs/internal/mat_trade_store.bin"):
     '''
     Return matrix of apparent national level consumption according to country of origin
     The calculations only consider direct imports and not the iterative imports of imports    
@@ -337,6 +1488,7 @@ def calculate_mat_cons(mineral="aluminium",year=2000,trade_data_type="reconcilia
         year
         from_local specifies if data are taken from online api of from local data
             "y" | "n"
+        store_path is the path of the trade store (see get_mat_trad)
     Output:
         mat_cons is the matrix of apparent national level consumption according to country of origin
         Rows are the consuming countries, columns are the producing countries
@@ -344,12 +1496,7 @@ def calculate_mat_cons(mineral="aluminium",year=2000,trade_data_type="reconcilia
     '''
     #Get trades matrix
     #Get bilateral matrix data
-    if trade_data_type=="imports":
-        mat_trad = sparse.load_npz("inputs/internal/mat_imports_"+mineral+"_"+str(year)+".npz")
-    elif trade_data_type=="exports":
-        mat_trad = sparse.load_npz("inputs/internal/mat_exports_"+mineral+"_"+str(year)+".npz")
-    elif trade_data_type=="reconciliated":
-        mat_trad = sparse.load_npz("inputs/internal/mat_recon_trade_"+mineral+"_"+str(year)+".npz")
+    mat_trad = get_mat_trad(mineral=mineral,year=year,trade_data_type=trade_data_type,store_path=store_path)
     #Get production matrix
     mat_prod = get_mat_prod(mineral=mineral,year=year)
     #Calculate consumption matrix.
@@ -360,6 +1507,154 @@ def calculate_mat_cons(mineral="aluminium",year=2000,trade_data_type="reconcilia
     R_hat = mat_cons*mat_conv_prod
     return R_hat
 
+#Cache of apparent consumption matrices. In-memory LRU cache and optional on-disk cache (directory of .npz files).
+_mat_cons_cache = collections.OrderedDict()
+_mat_cons_cache_config = {"max_size":128,"cache_dir":None}
+
+def configure_mat_cons_cache(max_size=128,cache_dir=None):
+    '''
+    Configure the cache of apparent consumption matrices used by get_mat_cons
+    Attributes:
+        max_size is the maximum number of matrices kept in memory. The least recently used matrices are evicted first.
+        cache_dir is the directory of the on-disk cache. None disables the on-disk cache.
+    '''
+    _mat_cons_cache_config["max_size"] = max_size
+    _mat_cons_cache_config["cache_dir"] = cache_dir
+    while len(_mat_cons_cache)>max_size:
+        _mat_cons_cache.popitem(last=False)
+    return
+
+def clear_mat_cons_cache():
+    '''
+    Clear the in-memory cache of apparent consumption matrices. The on-disk cache is kept.
+    '''
+    _mat_cons_cache.clear()
+    return
+
+#Reference tables (csv and xlsx files of inputs) by (file path, sheet name): (checksum, table). On-disk cache of pickle files, see get_reference_table.
+_reference_table_dict = {}
+_reference_table_config = {"cache_dir":"inputs/internal/cache/tables"}
+
+def configure_reference_table_cache(cache_dir="inputs/internal/cache/tables"):
+    '''
+    Configure the on-disk cache of reference tables used by get_reference_table
+    Attributes:
+        cache_dir is the directory of the on-disk cache. None disables the on-disk cache.
+    '''
+    _reference_table_config["cache_dir"] = cache_dir
+    return
+
+def get_reference_table(file_path,sheet_name=0):
+    '''
+    Return a reference table of the inputs (csv file or sheet of an xlsx file)
+    The file is parsed once per process. The parsed table is also stored in a binary cache (pickle), which is regenerated when the checksum of the file changes or when it can not be read.
+    Attributes:
+        file_path is the path of the csv or xlsx file
+        sheet_name is the sheet of the xlsx file
+    Output:
+        table is a copy of the table. The table in the cache is not modified by the caller.
+    '''
+    checksum = get_file_checksum(file_path)
+    table_key = (file_path,sheet_name)
+    if table_key not in _reference_table_dict or _reference_table_dict[table_key][0]!=checksum:
+        table = None
+        cache_dir = _reference_table_config["cache_dir"]
+        cache_file = None
+        if cache_dir!=None:
+            cache_file = os.path.join(cache_dir,"table_"+hashlib.sha1(repr(table_key).encode("utf-8")).hexdigest()+".pkl")
+            if os.path.exists(cache_file):
+                try:
+                    with open(cache_file,"rb") as f:
+                        cache_checksum,cache_table = pickle.load(f)
+                    if cache_checksum==checksum:
+                        table = cache_table
+                except (pickle.UnpicklingError,EOFError,AttributeError,ImportError,IndexError,TypeError,ValueError) as error:
+                    #Corrupted or incompatible cache file (e.g. other pandas version). It is deleted and the file is parsed again.
+                    logging.warning("Cache of {file_path} can not be read ({error}). The file is parsed again.".format(file_path=file_path,error=repr(error)))
+                    os.remove(cache_file)
+        #Parse the file
+        if table is None:
+            if file_path.endswith(".csv"):
+                table = pd.read_csv(file_path)
+            else:
+                table = pd.read_excel(file_path,sheet_name=sheet_name)
+            if cache_file!=None:
+                os.makedirs(cache_dir,exist_ok=True)
+                with open(cache_file+".tmp","wb") as f:
+                    pickle.dump((checksum,table),f,protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(cache_file+".tmp",cache_file)
+        _reference_table_dict[table_key] = (checksum,table)
+    return _reference_table_dict[table_key][1].copy()
+
+def get_mat_cons_cache_key(mineral="aluminium",year=2000,trade_data_type="reconciliated",adjustment="kastner",store_path="inputs/internal/mat_trade_store.bin"):
+    '''
+    Return the key of the apparent consumption matrix in the cache: parameters and checksums of the inputs
+    The trade matrix is identified by its own checksum (see get_mat_trad_checksum), so the modification of other matrices of the trade store does not change the key.
+    '''
+    if adjustment not in ["kastner","no"]:
+        raise ValueError("Unknown adjustment: {adjustment}".format(adjustment=adjustment))
+    #Input files of the calculation
+    input_file_list = ['inputs/'+mineral+'_production_data.csv',
+                       "inputs/Comtrade Country Code and ISO list.xlsx"]
+    return (mineral,year,trade_data_type,adjustment,get_mat_trad_checksum(mineral=mineral,year=year,trade_data_type=trade_data_type,store_path=store_path))+tuple(get_file_checksum(file_path) for file_path in input_file_list if os.path.exists(file_path))
+
+def add_mat_cons_cache(cache_key,mat):
+    '''
+    Add a matrix in the in-memory cache and evict the least recently used matrices
+    '''
+    _mat_cons_cache[cache_key] = mat
+    _mat_cons_cache.move_to_end(cache_key)
+    while len(_mat_cons_cache)>_mat_cons_cache_config["max_size"]:
+        _mat_cons_cache.popitem(last=False)
+    return
+
+def get_mat_cons(mineral="aluminium",year=2000,trade_data_type="reconciliated",adjustment="kastner",store_path="inputs/internal/mat_trade_store.bin"):
+    '''
+    Return matrix of apparent national level consumption according to country of origin from the cache
+    The matrix is calculated with calculate_mat_cons_kastner or calculate_mat_cons the first time and then reused until the input files change.
+    Attributes:
+        mineral to consider in the production
+            'aluminium' | 'alumina' | 'bauxite'
+        year
+        trade_data_type
+            'imports' | 'exports' | 'reconciliated'
+        adjustment is the model of apparent consumption
+            'kastner' (calculate_mat_cons_kastner) | 'no' (calculate_mat_cons)
+        store_path is the path of the trade store (see get_mat_trad)
+    Output:
+        R_hat is the matrix of apparent national level consumption according to country of origin
+        Rows are the consuming countries, columns are the producing countries.
+    '''
+    cache_key = get_mat_cons_cache_key(mineral=mineral,year=year,trade_data_type=trade_data_type,adjustment=adjustment,store_path=store_path)
+    #In-memory cache
+    if cache_key in _mat_cons_cache:
+        _mat_cons_cache.move_to_end(cache_key)
+        return _mat_cons_cache[cache_key].copy()
+    #On-disk cache
+    cache_dir = _mat_cons_cache_config["cache_dir"]
+    cache_file = None
+    R_hat = None
+    if cache_dir!=None:
+        cache_file = os.path.join(cache_dir,"mat_cons_"+hashlib.sha1(repr(cache_key).encode("utf-8")).hexdigest()+".npz")
+        if os.path.exists(cache_file):
+            R_hat = sparse.load_npz(cache_file).tocsc()
+    #Calculation
+    if R_hat is None:
+        if adjustment=="kastner":
+            R_hat = calculate_mat_cons_kastner(mineral=mineral,year=year,trade_data_type=trade_data_type,store_path=store_path)
+        elif adjustment=="no":
+            R_hat = calculate_mat_cons(mineral=mineral,year=year,trade_data_type=trade_data_type,store_path=store_path)
+        R_hat = sparse.csc_matrix(R_hat)
+        if cache_file!=None:
+            os.makedirs(cache_dir,exist_ok=True)
+            sparse.save_npz(cache_file,R_hat,compressed=False)
+    add_mat_cons_cache(cache_key,R_hat)
+    return R_hat.copy()
+
+#Stages of the aluminium chain. Next stage of each mineral and input of mineral per kg of the next stage.
+MINERAL_NEXT_STAGE_DICT = {'alumina':'aluminium','bauxite':'alumina'}
+MINERAL_INPUT_DICT = {'aluminium':1,'alumina':1.93538,'bauxite':2.8764}
+
 def calculate_emb_cons(production_of,consumption_of,year,trade_data_type="reconciliated"):
     '''
     Return matrix of embodied consumption   
@@ -376,86 +1671,164 @@ def calculate_emb_cons(production_of,consumption_of,year,trade_data_type="reconc
         Rows are the consuming countries, columns are the embodied producing countries
         mat_cons(i,j) is the part of the consumption of country i of mineral "consumption_of" produced from country j of mineral "production_of"
     '''
-    mineral_list = {'alumina':'aluminium','bauxite':'alumina'}
-    input_list = {'aluminium':1,'alumina':1.93538,'bauxite':2.8764}
+    mineral_list = MINERAL_NEXT_STAGE_DICT
+    input_list = MINERAL_INPUT_DICT
+    #The embodied consumption matrix depends on all the stages from production_of to consumption_of
+    stage_list = [production_of]
+    while stage_list[-1]!=consumption_of:
+        stage_list.append(mineral_list[stage_list[-1]])
+    cache_key = ("embodied",production_of,consumption_of)+tuple(get_mat_cons_cache_key(mineral=stage,year=year,trade_data_type=trade_data_type) for stage in stage_list)
+    if cache_key in _mat_cons_cache:
+        _mat_cons_cache.move_to_end(cache_key)
+        return _mat_cons_cache[cache_key].copy()
     #Get apparent consumption matrix
-    mat_cons = calculate_mat_cons_kastner(mineral=production_of,year=year,trade_data_type=trade_data_type)
+    mat_cons = get_mat_cons(mineral=production_of,year=year,trade_data_type=trade_data_type)
     if production_of==consumption_of:
         emb_cons = mat_cons
     else:
         temp_mineral = mineral_list[production_of]
-        #Get embodied consumption matrix for temp_mineral
+        #Get embodied consumption matrix for temp_mineral (computed once and reused)
         temp_emb_cons = calculate_emb_cons(production_of=temp_mineral,consumption_of=consumption_of,year=year,trade_data_type=trade_data_type)
         #Get relative apparent consumption matrix for production_of
         temp_mat_cons_rel = get_relative_matrix(mat=mat_cons,axis=1)
         #Input factor
         conversion_factor = input_list[production_of]
-        emb_cons = temp_emb_cons*conversion_factor*temp_mat_cons_rel
-    return emb_cons
+        emb_cons = sparse.csc_matrix(temp_emb_cons*conversion_factor*temp_mat_cons_rel)
+    add_mat_cons_cache(cache_key,emb_cons)
+    return emb_cons.copy()
+
+def calculate_mat_cons_chain(year,trade_data_type="reconciliated",mineral_list=["aluminium","alumina","bauxite"]):
+    '''
+    Return the matrices of apparent consumption and of embodied consumption of all the stages of the aluminium chain for one year
+    The Kastner et al. systems of all stages are assembled in one block diagonal system diag(I-A_s) and factorized once.
+    The stages are then linked MRIO-style by the block matrix Z with Z(t,s) = input of s per kg of t * relative apparent consumption of s (see calculate_emb_cons) if s is the stage before t.
+    Z is nilpotent, so (I-Z)^-1 = I + Z + Z^2 + ... is exact and the embodied consumption of all pairs of stages is diag(R_t) * (I-Z)^-1.
+    The matrices are also added to the in-memory cache of get_mat_cons and calculate_emb_cons.
+    Attributes:
+        year
+        trade_data_type
+            'imports' | 'exports' | 'reconciliated'
+        mineral_list is the list of stages of the chain
+    Output:
+        R_hat_dict is the dictionnary of matrices of apparent national level consumption according to country of origin {mineral:R_hat} (see calculate_mat_cons_kastner)
+        emb_cons_dict is the dictionnary of matrices of embodied consumption {(production_of,consumption_of):emb_cons} (see calculate_emb_cons)
+    '''
+    mineral_list = list(mineral_list)
+    #Get bilateral trade matrices and production vectors of all stages
+    mat_trad_list = [sparse.csc_matrix(get_mat_trad(mineral=mineral,year=year,trade_data_type=trade_data_type)) for mineral in mineral_list]
+    vec_prod = np.column_stack([get_vec_prod(mineral=mineral,year_list=[year])[:,0] for mineral in mineral_list])
+    vec_imp = np.column_stack([np.asarray(mat_trad.sum(axis=1)).ravel() for mat_trad in mat_trad_list])
+    vec_exp = np.column_stack([np.asarray(mat_trad.sum(axis=0)).ravel() for mat_trad in mat_trad_list])
+    vec_dmi = vec_prod + vec_imp
+    vec_inv = np.maximum(vec_exp-vec_dmi,0)
+    for i,mineral in enumerate(mineral_list):
+        print("Inventory changes account for {} % of domestic production plus imports".format(round(vec_inv[:,i].sum()/vec_dmi[:,i].sum()*100,ndigits=2)))
+    vec_dmi_adj,vec_dmi_rec,vec_cons = get_kastner_vectors(vec_prod=vec_prod,vec_imp=vec_imp,vec_exp=vec_exp)
+    #Block diagonal system of all stages. Stage i is in rows and columns i*n to (i+1)*n.
+    nb_country = vec_prod.shape[0]
+    nb_stage = len(mineral_list)
+    mat_ex_share = sparse.block_diag([mat_trad*sparse.diags(vec_dmi_rec[:,i]) for i,mat_trad in enumerate(mat_trad_list)],format="csc")
+    lu = linalg.splu((sparse.eye(nb_country*nb_stage,format="csc") - mat_ex_share).tocsc())
+    #Solve for the producing countries of all stages at once
+    vec_prod = vec_prod.ravel(order="F")
+    prod_index = np.flatnonzero(vec_prod)
+    rhs = np.zeros((nb_country*nb_stage,len(prod_index)))
+    rhs[prod_index,np.arange(len(prod_index))] = vec_prod[prod_index]
+    temp_R_hat = vec_cons.ravel(order="F")[:,np.newaxis]*lu.solve(rhs)
+    index_row,index_col = np.nonzero(temp_R_hat)
+    mat_R_hat = sparse.csc_matrix((temp_R_hat[index_row,index_col],(index_row,prod_index[index_col])),shape=(nb_country*nb_stage,nb_country*nb_stage))
+    R_hat_dict = {mineral:mat_R_hat[i*nb_country:(i+1)*nb_country,i*nb_country:(i+1)*nb_country].tocsc() for i,mineral in enumerate(mineral_list)}
+    #Inter-stage matrix Z
+    mat_z = sparse.lil_matrix((nb_country*nb_stage,nb_country*nb_stage))
+    for s,mineral in enumerate(mineral_list):
+        if MINERAL_NEXT_STAGE_DICT.get(mineral) in mineral_list:
+            t = mineral_list.index(MINERAL_NEXT_STAGE_DICT[mineral])
+            mat_z[t*nb_country:(t+1)*nb_country,s*nb_country:(s+1)*nb_country] = MINERAL_INPUT_DICT[mineral]*get_relative_matrix(mat=R_hat_dict[mineral],axis=1)
+    mat_z = sparse.csr_matrix(mat_z)
+    #(I-Z)^-1 as the finite sum of the powers of Z
+    mat_z_inv = sparse.eye(nb_country*nb_stage,format="csr")
+    mat_z_power = mat_z
+    while mat_z_power.nnz>0:
+        mat_z_inv = mat_z_inv + mat_z_power
+        mat_z_power = mat_z_power*mat_z
+    mat_emb_cons = sparse.csc_matrix(sparse.block_diag([R_hat_dict[mineral] for mineral in mineral_list])*mat_z_inv)
+    emb_cons_dict = {}
+    for s,production_of in enumerate(mineral_list):
+        for t,consumption_of in enumerate(mineral_list):
+            #Only the pairs of stages linked by the chain
+            stage = production_of
+            while stage!=consumption_of and stage in MINERAL_NEXT_STAGE_DICT:
+                stage = MINERAL_NEXT_STAGE_DICT[stage]
+            if stage==consumption_of:
+                emb_cons_dict[(production_of,consumption_of)] = mat_emb_cons[t*nb_country:(t+1)*nb_country,s*nb_country:(s+1)*nb_country].tocsc()
+    #Add the matrices in the cache (same keys as get_mat_cons and calculate_emb_cons)
+    mat_cons_key_dict = {mineral:get_mat_cons_cache_key(mineral=mineral,year=year,trade_data_type=trade_data_type) for mineral in mineral_list}
+    for mineral in mineral_list:
+        add_mat_cons_cache(mat_cons_key_dict[mineral],R_hat_dict[mineral].copy())
+    for (production_of,consumption_of),emb_cons in emb_cons_dict.items():
+        stage_list = [production_of]
+        while stage_list[-1]!=consumption_of:
+            stage_list.append(MINERAL_NEXT_STAGE_DICT[stage_list[-1]])
+        add_mat_cons_cache(("embodied",production_of,consumption_of)+tuple(mat_cons_key_dict[stage] for stage in stage_list),emb_cons.copy())
+    return R_hat_dict,emb_cons_dict
+
+#Aggregation matrices from countries to regions by region scheme
+_reg_aggregation_dict = {}
+
+def get_reg_aggregation_matrix(region_scheme):
+    '''
+    Return the matrix of aggregation from countries to regions. The matrix is built once per region scheme.
+    Attributes:
+        region_scheme is the column of country_correspondence.csv with the regions
+            aluminium_region_ei34 | aluminium_region_ei35 | alumina_region | graph_region | ecoinvent_country
+    Outputs:
+        mat_agg is the indicator matrix in CSR format. Rows are the regions, columns are the countries. mat_agg(r,i) is 1 if country i is in region r. Countries without region are in no region.
+        reg_list contains the sorted list of regions
+        country_list contains the list of countries
+    '''
+    if region_scheme not in _reg_aggregation_dict:
+        country_correspondence=get_reference_table('inputs/country_correspondence.csv')
+        reg_list=sorted(country_correspondence.loc[:,region_scheme].dropna().unique().tolist())
+        index_reg=pd.Index(reg_list).get_indexer(country_correspondence.loc[:,region_scheme])
+        index_cty=np.flatnonzero(index_reg>=0)
+        mat_agg=sparse.csr_matrix((np.ones(len(index_cty)),(index_reg[index_cty],index_cty)),shape=(len(reg_list),len(index_reg)))
+        country_list=country_correspondence.loc[:,'cty Name English'].tolist()
+        _reg_aggregation_dict[region_scheme]=(mat_agg,reg_list,country_list)
+    mat_agg,reg_list,country_list=_reg_aggregation_dict[region_scheme]
+    return mat_agg,list(reg_list),list(country_list)
 
 def build_reg_matrix(country_mat,region_to_consider_for_col=None,region_to_consider_for_row=None):
     '''
     Build a matrix aggregated by region from matrix of country
+    The aggregation is the product P * country_mat * Q' with P and Q the aggregation matrices of the regions (see get_reg_aggregation_matrix)
     Attributes:
         country_mat is matrix with countries as rows and/or columns
         region_to_consider_for_row is the list of region to use for aggregation per rows (from number of countries to number of regions in rows)
-            aluminium_region_ei34 | aluminium_region_ei35 | alumina_region
+            aluminium_region_ei34 | aluminium_region_ei35 | alumina_region | graph_region
         region_to_consider_for_col is the list of region to use for aggregation per columns (from number of countries to number of regions in columns)
-            aluminium_region_ei34 | aluminium_region_ei35 | alumina_region
+            aluminium_region_ei34 | aluminium_region_ei35 | alumina_region | graph_region
     Outputs:
         reg_mat is a matrix in CSC format which aggregates country_mat as specified
         list_rows contains the list of row names (either country or regions)
         list_columns contains the list of column names (either countries or regions)
     '''
-    #Inputs
-    country_correspondence=pd.read_csv('inputs/country_correspondence.csv')
+    if region_to_consider_for_col==None and region_to_consider_for_row==None:
+        raise ValueError("No region to consider for aggregation")
+    reg_mat=sparse.csr_matrix(country_mat,dtype=np.float64)
     #Aggregation over rows
-    if region_to_consider_for_col==None and region_to_consider_for_row!=None:
-        reg_list=sorted(country_correspondence.loc[:,region_to_consider_for_row].unique().tolist())
-        shape_mat=(len(reg_list),country_mat.shape[1])
-        #Create output
-        reg_mat=sparse.lil_matrix(shape_mat,dtype=np.float64)
-        for i in range(0,len(reg_list)):
-            reg=reg_list[i]
-            reg_index=country_correspondence.index[country_correspondence.loc[:,region_to_consider_for_row]==reg]
-            reg_mat[i,:]=sparse.lil_matrix(country_mat[reg_index,:].sum(axis=0))
-        #Get list of columns and row names
-        list_rows=reg_list
-        list_columns=country_correspondence.loc[:,'cty Name English'].tolist()
+    if region_to_consider_for_row!=None:
+        mat_agg_row,list_rows,country_list=get_reg_aggregation_matrix(region_to_consider_for_row)
+        reg_mat=mat_agg_row*reg_mat
     #Aggregation over columns
-    elif region_to_consider_for_col!=None and region_to_consider_for_row==None:
-        reg_list=sorted(country_correspondence.loc[:,region_to_consider_for_col].unique().tolist())
-        shape_mat=(country_mat.shape[0],len(reg_list))
-        #Create output
-        reg_mat=sparse.lil_matrix(shape_mat,dtype=np.float64)
-        for i in range(0,len(reg_list)):
-            reg=reg_list[i]
-            reg_index=country_correspondence.index[country_correspondence.loc[:,region_to_consider_for_col]==reg]
-            reg_mat[:,i]=sparse.lil_matrix(country_mat[:,reg_index].sum(axis=1))
-        #Get list of columns and row names
-        list_columns=reg_list
-        list_rows=country_correspondence.loc[:,'cty Name English'].tolist()
-    #Aggregation over rows and columns
-    elif region_to_consider_for_col!=None and region_to_consider_for_row!=None:
-        reg_list_col=sorted(country_correspondence.loc[:,region_to_consider_for_col].unique().tolist())
-        reg_list_row=sorted(country_correspondence.loc[:,region_to_consider_for_row].unique().tolist())
-        #Create output
-        temp_reg_mat=sparse.lil_matrix((len(reg_list_row),country_mat.shape[1]),dtype=np.float64)
-        #Aggregate per row
-        for i in range(0,len(reg_list_row)):
-            reg=reg_list_row[i]
-            reg_index=country_correspondence.index[country_correspondence.loc[:,region_to_consider_for_row]==reg]
-            temp_reg_mat[i,:]=sparse.lil_matrix(country_mat[reg_index,:].sum(axis=0))
-        #Aggregate per col
-        reg_mat=sparse.lil_matrix((len(reg_list_row),len(reg_list_col)),dtype=np.float64)
-        for i in range(0,len(reg_list_col)):
-            reg=reg_list_col[i]
-            reg_index=country_correspondence.index[country_correspondence.loc[:,region_to_consider_for_col]==reg]
-            reg_mat[:,i]=sparse.lil_matrix(temp_reg_mat[:,reg_index].sum(axis=1))
-        #Get lists of columns and row names
-        list_columns=reg_list_col
-        list_rows=reg_list_row
-    return reg_mat.tocsc(),list_rows,list_columns
+    if region_to_consider_for_col!=None:
+        mat_agg_col,list_columns,country_list=get_reg_aggregation_matrix(region_to_consider_for_col)
+        reg_mat=reg_mat*mat_agg_col.transpose()
+    #Get list of columns and row names
+    if region_to_consider_for_row==None:
+        list_rows=country_list
+    if region_to_consider_for_col==None:
+        list_columns=country_list
+    return sparse.csc_matrix(reg_mat),list_rows,list_columns
 
 def get_relative_matrix(mat,axis=1):
     '''
@@ -468,9 +1841,14 @@ def get_relative_matrix(mat,axis=1):
         rel_mat is the normalized matrix
     '''
     #Get sum over the rows
-    normalizing_sum=mat.sum(axis=axis)
+    normalizing_sum=np.asarray(mat.sum(axis=axis)).ravel()
     #If sum is 0, force to 1
     normalizing_sum[normalizing_sum==0]=1
-    #Divide the matrix per column
-    rel_mat=sparse.csc_matrix(mat/normalizing_sum)
+    #Divide the nonzero values by the sum of their row (or column). The matrix stays sparse.
+    mat=sparse.coo_matrix(mat)
+    if axis==1:
+        index_sum=mat.row
+    else:
+        index_sum=mat.col
+    rel_mat=sparse.csc_matrix((mat.data/normalizing_sum[index_sum],(mat.row,mat.col)),shape=mat.shape)
     return rel_mat
@@ -8,173 +8,343 @@ import brightway2 as bw
 import pandas as pd
 import numpy as np
 import logging
+import os
 import source.utils_mfa as utils_mfa
+import source.utils_brightway as utils_bw
 from scipy import sparse
 
-def dbUpdate_ElecAluLiq(bw_db_name,year,china_alu_elec='iai'):
+#Values of reference tables indexed by key columns, by (file path, key columns, value column): (checksum, series). See get_indexed_table.
+_indexed_table_dict = {}
+
+def get_indexed_table(file_path,key_column_list,value_column='value'):
     '''
-    Function that updates the brightway database with annual electricity mixes per region in aluminum liquid processes
+    Return the values of a reference table indexed by key columns, e.g. (year, region, source). The index is built once and rebuilt when the file changes.
+    Attributes:
+        file_path is the path of the csv file (see utils_mfa.get_reference_table)
+        key_column_list is the list of key columns
+        value_column is the column of values
+    Output:
+        value_series is a series of values with the key columns as index. If a key appears many times, the first value is used.
+    '''
+    checksum = utils_mfa.get_file_checksum(file_path)
+    table_key = (file_path,tuple(key_column_list),value_column)
+    if table_key not in _indexed_table_dict or _indexed_table_dict[table_key][0]!=checksum:
+        value_series = utils_mfa.get_reference_table(file_path).set_index(key_column_list)[value_column]
+        value_series = value_series[~value_series.index.duplicated()]
+        _indexed_table_dict[table_key] = (checksum,value_series)
+    return _indexed_table_dict[table_key][1]
+
+def gather_indexed_table(value_series,key_list):
+    '''
+    Return the array of values of a list of keys in one lookup (see get_indexed_table)
+    Raises KeyError with all the missing keys
+    '''
+    if len(key_list)==0:
+        return value_series.to_numpy()[:0]
+    index_array = value_series.index.get_indexer(key_list)
+    if (index_array==-1).any():
+        missing_list = [key for key,index in zip(key_list,index_array) if index==-1]
+        raise KeyError("Missing values for {names}: {missing_list}".format(names=value_series.index.names,missing_list=missing_list[:10]))
+    return value_series.to_numpy()[index_array]
+
+#Scenario in effect in the databases, by database name: {'modified':(modification time of the database,version of the database),'state':{component:fingerprint}}. See apply_scenario_updates.
+_applied_scenario_dict = {}
+
+def get_input_checksums(file_path_list):
+    '''
+    Return the checksums of the input files which exist (see utils_mfa.get_file_checksum)
+    '''
+    return tuple(utils_mfa.get_file_checksum(file_path) for file_path in file_path_list if os.path.exists(file_path))
+
+def get_database_modified(bw_db_name):
+    '''
+    Return the modification time of a database and the number of its modifications registered in the session (see utils_bw.set_database_modified)
+    '''
+    return (bw.databases[bw_db_name].get('modified'),utils_bw.get_database_version(bw_db_name))
+
+def get_applied_scenario(bw_db_name):
+    '''
+    Return the fingerprints of the updates in effect in a database {component:fingerprint} (see apply_scenario_updates)
+    The fingerprints are forgotten when the database has been modified by other means since the last update: processing of the database, or act.save() and exc.save() followed by utils_bw.update_activity_index or utils_bw.set_database_modified.
+    '''
+    modified = get_database_modified(bw_db_name)
+    if bw_db_name not in _applied_scenario_dict or _applied_scenario_dict[bw_db_name]['modified']!=modified:
+        _applied_scenario_dict[bw_db_name] = {'modified':modified,'state':{}}
+    return _applied_scenario_dict[bw_db_name]['state']
+
+def clear_applied_scenario(bw_db_name=None):
+    '''
+    Forget the fingerprints of the updates in effect in a database (all databases if None). The next updates are all applied.
+    '''
+    if bw_db_name==None:
+        _applied_scenario_dict.clear()
+    else:
+        _applied_scenario_dict.pop(bw_db_name,None)
+    return
+
+def apply_scenario_updates(bw_db_name,component_list):
+    '''
+    Apply in one batch the updates of the components of a scenario which are not already in effect in the database (see utils_bw.update_exchanges)
+    Attributes:
+        bw_db_name is the name of the Brightway database to update
+        component_list is a list of (component, fingerprint, get_updates, kwargs)
+            component is the part of the database updated, e.g. 'ElecAluLiq' or ('market','alumina')
+            fingerprint identifies the update: parameters and checksums of the input files. The update is skipped if the same fingerprint is in effect for the component.
+            get_updates(bw_db_name,**kwargs) returns the list of exchange updates of the component
+    Output:
+        nb_exc is the number of exchanges which amount changed
+    '''
+    state = get_applied_scenario(bw_db_name)
+    exc_update_list = []
+    new_state = {}
+    for component,fingerprint,get_updates,kwargs in component_list:
+        if state.get(component)!=fingerprint:
+            exc_update_list = exc_update_list + get_updates(bw_db_name,**kwargs)
+            new_state[component] = fingerprint
+    nb_exc = utils_bw.update_exchanges(bw_db_name,exc_update_list)
+    #Record the scenario in effect and the modification of the database after the update
+    state.update(new_state)
+    _applied_scenario_dict[bw_db_name]['modified'] = get_database_modified(bw_db_name)
+    return nb_exc
+
+def get_ElecAluLiq_component(year,china_alu_elec='iai'):
+    '''
+    Return the scenario component of the electricity inputs of aluminum liquid processes (see apply_scenario_updates)
+    '''
+    fingerprint = (year,china_alu_elec)+get_input_checksums(['inputs/list_region_iai.csv','inputs/electricity_input_iai.csv','inputs/elec_mix_iai_2000-2017.csv','inputs/elec_mix_china_2017.csv','inputs/country_correspondence.csv'])
+    return ('ElecAluLiq',fingerprint,get_ElecAluLiq_updates,{'year':year,'china_alu_elec':china_alu_elec})
+
+def get_EnerAlumina_component(year):
+    '''
+    Return the scenario component of the energy inputs of alumina production processes (see apply_scenario_updates)
+    '''
+    fingerprint = (year,)+get_input_checksums(['inputs/alumina_energy_consumption.csv','inputs/alumina_energy_mix.csv','inputs/energy_alumina_act.csv','inputs/country_correspondence.csv'])
+    return ('EnerAlumina',fingerprint,get_EnerAlumina_updates,{'year':year})
+
+def get_market_locations(bw_db_name,mineral):
+    '''
+    Return the locations of the market for consumption activities of mineral, except GLO. Part of the fingerprints of the market components (see get_cons_mix_component).
+    '''
+    act_list = utils_bw.find_activities(bw_db_name,name_contains='market for consumption of '+mineral,location_not_contains='GLO')
+    return tuple(sorted(act['location'] for act in act_list))
+
+def get_cons_mix_component(bw_db_name,year,mineral,adjustment="kastner",trade_data_type="reconciliated"):
+    '''
+    Return the scenario component of the consumption mixes of mineral (see apply_scenario_updates). The fingerprint includes the key of the consumption matrix (see utils_mfa.get_mat_cons_cache_key) and the locations of the markets.
+    '''
+    fingerprint = ('cons_mix',)+utils_mfa.get_mat_cons_cache_key(mineral=mineral,year=year,trade_data_type=trade_data_type,adjustment=adjustment)+get_input_checksums(['inputs/country_correspondence.csv'])+(get_market_locations(bw_db_name,mineral),)
+    return (('market',mineral),fingerprint,get_cons_mix_updates,{'year':year,'mineral':mineral,'adjustment':adjustment,'trade_data_type':trade_data_type})
+
+def get_localize_component(bw_db_name,mineral,localized_prod=None):
+    '''
+    Return the scenario component of the localized (localized_prod None) or globalized (localized_prod 'GLO') consumption of mineral (see apply_scenario_updates). The fingerprint includes the locations of the markets.
+    '''
+    fingerprint = ('localize',localized_prod,get_market_locations(bw_db_name,mineral))
+    return (('market',mineral),fingerprint,get_localize_updates,{'mineral_list':[mineral],'localized_prod':localized_prod})
+
+def get_ElecAluLiq_updates(bw_db_name,year,china_alu_elec='iai'):
+    '''
+    Function that calculates the annual electricity inputs and electricity mixes per region of aluminum liquid processes
     Attributes:
         bw_db_name is the name of the Brightway database to update. 
             Requirement: This database needs to be edited according to the project. Electricity inputs per aluminum liquid activites need to be available
         year is the year to consider
-        
+    Output:
+        exc_update_list is the list of (activity key, input key, amount) to update (see utils_bw.update_exchanges)
     '''
     #inputs
-    iai_region_data=pd.read_csv('inputs/list_region_iai.csv')
+    iai_region_data=utils_mfa.get_reference_table('inputs/list_region_iai.csv')
     iai_region_col_name = "aluminium_region_ei34"
-    iai_reg_l = iai_region_data[iai_region_col_name].unique().tolist()
-    iai_reg_l.append('GLO')
-    iai_elec_input = pd.read_csv('inputs/electricity_input_iai.csv')
-    iai_elec_mix = pd.read_csv('inputs/elec_mix_iai_2000-2017.csv')
-    cn_elec_mix = pd.read_csv('inputs/elec_mix_china_2017.csv')
-    country_correspondence = pd.read_csv('inputs/country_correspondence.csv').fillna(0)
+    iai_elec_input = get_indexed_table('inputs/electricity_input_iai.csv',['Region','Category','Year'])
+    iai_elec_mix = get_indexed_table('inputs/elec_mix_iai_2000-2017.csv',['Year','Region','ecoinvent_activity'])
+    country_correspondence = utils_mfa.get_reference_table('inputs/country_correspondence.csv').fillna(0)
     list_ei_country = country_correspondence.ecoinvent_country.unique().tolist()
     list_ei_country.append('GLO') #We add GLO in the list
-    bw_db = bw.Database(bw_db_name)
-    #Other parameters. bw_db is the brightway database to update
-    alu_act_list = [act for act in bw_db if 'aluminium production, primary, liquid' in act['name'] and act['location'] in list_ei_country]
+    #IAI region of each ecoinvent location
+    ei_iai_reg_dict = dict(zip(country_correspondence['ecoinvent_country'][::-1],country_correspondence[iai_region_col_name][::-1]))
+    iai_reg_dict = dict(zip(iai_region_data[iai_region_col_name][::-1],iai_region_data['region'][::-1]))
+    #Output
+    exc_update_list = []
+    #Other parameters. bw_db_name is the brightway database to update
+    alu_act_list = utils_bw.find_activities(bw_db_name,name_contains='aluminium production, primary, liquid',location_in=list_ei_country)
+    exc_key_list = []
+    reg_list = []
     for alu_act in alu_act_list:
         if alu_act['location']=='GLO':
             reg = 'World'
         else:
-            iai_reg = country_correspondence.loc[country_correspondence['ecoinvent_country']==alu_act['location'],iai_region_col_name].values[0]
-            reg = iai_region_data.loc[iai_region_data[iai_region_col_name]==iai_reg,'region'].values[0]
-        #Get IAI input for year and reigon
-        index_number = iai_elec_input[(iai_elec_input.Region == reg) & (iai_elec_input.Category == "AC") & (iai_elec_input.Year == year)].index
-        #If ND value. Consider world value
-        if iai_elec_input.loc[index_number,'value'].values[0]=="ND":
-            index_number = iai_elec_input[(iai_elec_input.Region == 'World') & (iai_elec_input.Category == "AC") & (iai_elec_input.Year == year)].index
-        elec_input_amount = float(iai_elec_input.loc[index_number,'value'])
-        #print(iai_reg+" "+reg+" "+str(elec_input_amount))
+            reg = iai_reg_dict[ei_iai_reg_dict[alu_act['location']]]
         elec_exc = [exc for exc in alu_act.technosphere() if "electricity" in exc.input['name']][0]
-        #Update electricity consumption value
-        elec_exc['amount'] = elec_input_amount/10**3
-        #Save update
-        elec_exc.save()            
+        exc_key_list.append((alu_act.key,elec_exc['input']))
+        reg_list.append(reg)
+    #Get IAI inputs for year and regions. If ND value, consider world value
+    elec_input_array = gather_indexed_table(iai_elec_input,[(reg,"AC",year) for reg in reg_list])
+    if (elec_input_array=="ND").any():
+        elec_input_array[elec_input_array=="ND"] = gather_indexed_table(iai_elec_input,[('World',"AC",year)])[0]
+    #Update electricity consumption value
+    for (act_key,input_key),elec_input_amount in zip(exc_key_list,elec_input_array.astype(float)):
+        exc_update_list.append((act_key,input_key,elec_input_amount/10**3))
     #Update electricit mixes
-    elec_alu_act_list = [act for act in bw_db if 'market for electricity, high voltage, aluminium industry' in act['name'] and 'RoW' not in act['location']]
+    elec_alu_act_list = utils_bw.find_activities(bw_db_name,name_contains='market for electricity, high voltage, aluminium industry',location_not_contains='RoW')
+    mix_request_dict = {'iai':[],'national':[]}
+    elec_mix_loc_dict = {}
     for elec_alu_act in elec_alu_act_list:
         if isinstance(elec_alu_act['location'],str):
             elec_mix_loc_input = elec_alu_act['location']
         elif isinstance(elec_alu_act['location'],tuple):
             elec_mix_loc_input = elec_alu_act['location'][1]
         if elec_mix_loc_input=='CN' and year==2017 and china_alu_elec=='national':
-            tmp_elec_mix = cn_elec_mix
+            mix_source = 'national'
         else :
+            mix_source = 'iai'
+        elec_mix_loc_dict[elec_alu_act.key] = elec_mix_loc_input
+        for elec_exc in elec_alu_act.technosphere():
+            elec_exc_name = elec_exc.input['name']
+            if 'electricity production' in elec_exc_name:
+                mix_request_dict[mix_source].append((elec_alu_act.key,elec_exc['input'],(year,elec_mix_loc_input,elec_exc_name)))
+    #Get mix values of all exchanges
+    elec_mix_tot_dict = {act_key:0 for act_key in elec_mix_loc_dict.keys()}
+    for mix_source,mix_request_list in mix_request_dict.items():
+        if len(mix_request_list)==0:
+            continue
+        if mix_source=='national':
+            tmp_elec_mix = get_indexed_table('inputs/elec_mix_china_2017.csv',['Year','Region','ecoinvent_activity'])
+        else:
             tmp_elec_mix = iai_elec_mix
-        elec_exc_list = [exc for exc in elec_alu_act.technosphere() if 'electricity production' in exc.input['name']]
-        elec_mix_tot = 0
-        for elec_exc in elec_exc_list:
-            #Get mix value of activity
-            elec_mix_value = tmp_elec_mix[(tmp_elec_mix.Year == year) & (tmp_elec_mix.Region == elec_mix_loc_input) & (tmp_elec_mix.ecoinvent_activity == elec_exc.input['name'])].value.tolist()[0]
+        elec_mix_array = gather_indexed_table(tmp_elec_mix,[mix_key for act_key,input_key,mix_key in mix_request_list])
+        for (act_key,input_key,mix_key),elec_mix_value in zip(mix_request_list,elec_mix_array):
             #Change value in exchange
-            elec_exc['amount'] = elec_mix_value
-            #Save value in activity
-            elec_exc.save()
+            exc_update_list.append((act_key,input_key,elec_mix_value))
             #Check sum of mixes equal 1
-            elec_mix_tot = elec_mix_tot+elec_mix_value
-        elec_alu_act.save()
-        #Check that mixes sum up to 1
+            elec_mix_tot_dict[act_key] = elec_mix_tot_dict[act_key]+elec_mix_value
+    #Check that mixes sum up to 1
+    for act_key,elec_mix_tot in elec_mix_tot_dict.items():
         if elec_mix_tot != 1:
-            logging.warning("Sum of electricity mixes is {elec_mix} for region: {region}!".format(elec_mix=elec_mix_tot,region=elec_mix_loc_input))
+            logging.warning("Sum of electricity mixes is {elec_mix} for region: {region}!".format(elec_mix=elec_mix_tot,region=elec_mix_loc_dict[act_key]))
+    return exc_update_list
+
+def dbUpdate_ElecAluLiq(bw_db_name,year,china_alu_elec='iai'):
+    '''
+    Function that updates the brightway database with annual electricity mixes per region in aluminum liquid processes
+    Attributes:
+        bw_db_name is the name of the Brightway database to update. 
+            Requirement: This database needs to be edited according to the project. Electricity inputs per aluminum liquid activites need to be available
+        year is the year to consider
+        
+    '''
+    apply_scenario_updates(bw_db_name,[get_ElecAluLiq_component(year,china_alu_elec=china_alu_elec)])
     return
 
-def dbUpdate_EnerAlumina(bw_db_name,year):
+def get_EnerAlumina_updates(bw_db_name,year):
     '''
-    Function that updates the brightway database with annual energy mixes in alumina production processes by producing country
+    Function that calculates the annual energy inputs of alumina production processes by producing country
     Attributes:
         bw_db_name is the name of the Brightway database to update
             requiremnt: Database needs to be edited according to project.
         year is the year to consider
-        
+    Output:
+        exc_update_list is the list of (activity key, input key, amount) to update (see utils_bw.update_exchanges)
     '''
-    region_data = pd.read_csv('inputs/iai_alumina_region_equivalency.csv')
-    reg_l = list(region_data.alumina_region.unique())
-    reg_l.append('GLO')
-    country_correspondence = pd.read_csv('inputs/country_correspondence.csv').fillna(0)
-    energy_input_dt = pd.read_csv('inputs/alumina_energy_consumption.csv')
-    energy_mixes_dt = pd.read_csv('inputs/alumina_energy_mix.csv')
-    energy_act_dt = pd.read_csv('inputs/energy_alumina_act.csv')
+    country_correspondence = utils_mfa.get_reference_table('inputs/country_correspondence.csv').fillna(0)
+    energy_input = get_indexed_table('inputs/alumina_energy_consumption.csv',['Region','Year'])
+    energy_mixes = get_indexed_table('inputs/alumina_energy_mix.csv',['Region','Year','source'])
+    energy_act_dt = utils_mfa.get_reference_table('inputs/energy_alumina_act.csv')
     energy_input_list = energy_act_dt.ori_exc_input.tolist()
-    bw_db = bw.Database(bw_db_name)
-    #Other parameters. bw_db is the brightway database to update
-    alumina_act_list = [act for act in bw_db if 'alumina production' == act['name']]
+    iai_source_list = energy_act_dt.source_iai.tolist()
+    #Alumina region of each ecoinvent location
+    alumina_reg_dict = dict(zip(country_correspondence['ecoinvent_country'][::-1],country_correspondence['alumina_region'][::-1]))
+    #Output
+    exc_update_list = []
+    #Other parameters. bw_db_name is the brightway database to update
+    alumina_act_list = utils_bw.find_activities(bw_db_name,name='alumina production')
+    #Energy exchanges to update: (activity key, input key, unit, region, IAI energy source)
+    energy_exc_list = []
+    #Alumina activities with a region: (activity key, region)
+    act_reg_list = []
     for alumina_act in alumina_act_list:
         if alumina_act['location']=='GLO':
             reg='GLO'
         else:
-            reg = country_correspondence.loc[country_correspondence['ecoinvent_country']==alumina_act['location'],'alumina_region'].values[0]
+            reg = alumina_reg_dict[alumina_act['location']]
         if reg==0:
             logging.warning("Country {country} does not have an alumina region!".format(country=alumina_act['location']))
             #return[]
         else:
-            #ene_input_amount is the energy intensity of alumina smelting [Mj/t]
-            ene_input_amount = float(energy_input_dt.loc[(energy_input_dt.Region == reg) & (energy_input_dt.Year == year),'value'])
-            #Update energetic inputs of alumina production activity
-            ene_mix_tot=0
-            for energy_exc_name in energy_input_list:
-                search_list = [exc for exc in alumina_act.technosphere() if energy_exc_name in exc.input['name']]
+            act_reg_list.append((alumina_act.key,reg))
+            #Technosphere exchanges of alumina production activity, read once
+            techno_exc_list = [(exc,exc.input['name']) for exc in alumina_act.technosphere()]
+            for energy_exc_name,iai_source in zip(energy_input_list,iai_source_list):
+                search_list = [exc for exc,exc_name in techno_exc_list if energy_exc_name in exc_name]
                 if len(search_list)!=1:
                     logging.warning("Multiple or no energy inputs entitled {exc_name} in alumina production for region: {region}!".format(exc_name=energy_exc_name,region=reg))
                     #return[]
                 else:
-                    energy_exc = search_list[0]
-                #IAI energy source
-                iai_source = energy_act_dt.loc[energy_act_dt.ori_exc_input==energy_exc_name,'source_iai'].values[0]
-                #Take energy mixes
-                ene_mix = float(energy_mixes_dt.loc[(energy_mixes_dt.Region == reg) & (energy_mixes_dt.Year == year) & (energy_mixes_dt.source == iai_source),'value'])
-                ene_mix_tot = ene_mix_tot+ene_mix
-                #If exchange is megajoule, convert energy input into MJ per kg of alumina
-                if energy_exc.unit=='megajoule':
-                    energy_exc_amount = ene_mix*ene_input_amount/10**3
-                #If exchange is kWh, convert into kWh per kg of alumina. 1 kWh per 3.6 MJ
-                elif energy_exc.unit=='kilowatt hour':
-                    energy_exc_amount = ene_mix*ene_input_amount/10**3/3.6
-                #Update exchange amount
-                energy_exc['amount'] = energy_exc_amount
-                energy_exc.save()
-        #Check that mixes sum up to 1
+                    energy_exc_list.append((alumina_act.key,search_list[0]['input'],search_list[0].unit,reg,iai_source))
+    #ene_input_array is the energy intensity of alumina smelting [Mj/t]. ene_mix_array are the energy mixes
+    ene_input_array = gather_indexed_table(energy_input,[(reg,year) for act_key,input_key,unit,reg,iai_source in energy_exc_list]).astype(float)
+    ene_mix_array = gather_indexed_table(energy_mixes,[(reg,year,iai_source) for act_key,input_key,unit,reg,iai_source in energy_exc_list]).astype(float)
+    for (act_key,input_key,unit,reg,iai_source),ene_input_amount,ene_mix in zip(energy_exc_list,ene_input_array,ene_mix_array):
+        #If exchange is megajoule, convert energy input into MJ per kg of alumina
+        if unit=='megajoule':
+            energy_exc_amount = ene_mix*ene_input_amount/10**3
+        #If exchange is kWh, convert into kWh per kg of alumina. 1 kWh per 3.6 MJ
+        elif unit=='kilowatt hour':
+            energy_exc_amount = ene_mix*ene_input_amount/10**3/3.6
+        #Update exchange amount
+        exc_update_list.append((act_key,input_key,energy_exc_amount))
+    #Check that mixes sum up to 1. The sum includes the mixes of all the energy sources, even if the exchange is not found in the activity.
+    ene_mix_tot_array = gather_indexed_table(energy_mixes,[(reg,year,iai_source) for act_key,reg in act_reg_list for iai_source in iai_source_list]).astype(float).reshape((len(act_reg_list),len(iai_source_list))).sum(axis=1)
+    for (act_key,reg),ene_mix_tot in zip(act_reg_list,ene_mix_tot_array):
         if ene_mix_tot < 0.99:
             logging.warning("Sum of energy mixes is {ene_mix_tot} for region: {region}!".format(ene_mix_tot=ene_mix_tot,region=reg))
-        alumina_act.save()
+    return exc_update_list
+
+def dbUpdate_EnerAlumina(bw_db_name,year):
+    '''
+    Function that updates the brightway database with annual energy mixes in alumina production processes by producing country
+    Attributes:
+        bw_db_name is the name of the Brightway database to update
+            requiremnt: Database needs to be edited according to project.
+        year is the year to consider
+        
+    '''
+    apply_scenario_updates(bw_db_name,[get_EnerAlumina_component(year)])
     return
 
-def dbUpdate_cons_mix(bw_db_name,year,mineral,adjustment="kastner",trade_data_type="reconciliated"):
+def get_cons_mix_updates(bw_db_name,year,mineral,adjustment="kastner",trade_data_type="reconciliated"):
     '''
-    Function that updates the consumption mixes of mineral in the consuming countries based on the annual trade flows
+    Function that calculates the consumption mixes of mineral in the consuming countries based on the annual trade flows
     Attributes:
         bw_db_name: is the name of the Brightway database to update
             requiremnt: Database needs to be edited according to project.
         year: is the year to consider
         mineral: is the mineral consumed which consumption mixes are updated in market for consumption of 'mineral'
         transport: do we account for transport or not in the trades.
+    Output:
+        exc_update_list is the list of (activity key, input key, amount) to update (see utils_bw.update_exchanges)
     '''
-    #inputs
-    country_correspondence = pd.read_csv('inputs/country_correspondence.csv').fillna(0)
-    bw_db = bw.Database(bw_db_name)
     #Get the name of the producing activity of mineral for the consumption mixes by producing region
     prod_act_name_dict={'bauxite':'bauxite mine operation',
                    'alumina':'alumina production',
                    'aluminium':'aluminium production, primary, ingot'}
     prod_act_name = prod_act_name_dict[mineral]
     #mat_cons contains the matrix of consumption. Rows are the consuming countries of mineral, columns are the producing countries of mineral
-    if adjustment=="kastner":
-        mat_cons = utils_mfa.calculate_mat_cons_kastner(mineral=mineral,year=year,trade_data_type=trade_data_type)
-    elif adjustment=="no":
-        mat_cons = utils_mfa.calculate_mat_cons(mineral=mineral,year=year,trade_data_type=trade_data_type)
-    list_rows = country_correspondence.loc[:,'cty Name English'].tolist()
-    list_columns = country_correspondence.loc[:,'cty Name English'].tolist()
-    #tot_app_cons contains the total apparent consumption of mineral by country
-    tot_app_cons = mat_cons.sum(axis=1)
+    mat_cons = utils_mfa.get_mat_cons(mineral=mineral,year=year,trade_data_type=trade_data_type,adjustment=adjustment)
+    #Aggregate consumption by ecoinvent location: mat_loc_cons(a,p) is the consumption of location a produced in location p
+    mat_agg,list_loc,list_countries = utils_mfa.get_reg_aggregation_matrix('ecoinvent_country')
+    loc_index_dict = {loc:index for index,loc in enumerate(list_loc)}
+    mat_loc_cons = (mat_agg*sparse.csr_matrix(mat_cons)*mat_agg.transpose()).toarray()
+    #vec_loc_cons contains the total apparent consumption of mineral by location, including the production of countries without location
+    vec_loc_cons = mat_agg*np.asarray(mat_cons.sum(axis=1)).ravel()
     act_name = 'market for consumption of '+mineral
+    #Output
+    exc_update_list = []
     #Get the list of market for consumption acitivites by consuming region/country
-    act_list = [act for act in bw_db if act_name in act['name'] and 'GLO' not in act['location']]
+    act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name,location_not_contains='GLO')
     for act in act_list:
-        #Get the list of countries associated with consuming location
-        cons_country_list = country_correspondence.loc[country_correspondence['ecoinvent_country'] == act['location'],'cty Name English'].values.tolist()
         #loc_mineral_cons is the total local consumption of mineral in the given area
-        loc_mineral_cons = sum([tot_app_cons.item(idx) for idx in [list_columns.index(country) for country in cons_country_list]])
+        index_row = loc_index_dict.get(act['location'])
+        loc_mineral_cons = 0 if index_row==None else vec_loc_cons[index_row]
         #Get the list of mineral producing activities in market for consumption of mineral
         prod_exc_list = [exc for exc in act.technosphere() if prod_act_name == exc.input['name']]
         #Check if total consumption different zero. Otherwise, link with GLO activity
@@ -189,54 +359,91 @@ def dbUpdate_cons_mix(bw_db_name,year,mineral,adjustment="kastner",trade_data_ty
                     amount = 1
                 else:
                     amount = 0
-                #Change amount to and save
-                prod_exc['amount'] = amount
-                prod_exc.save()
+                #Change amount
+                exc_update_list.append((act.key,prod_exc['input'],amount))
         else:
             #tot_input_mix is the sum of the consumption mixes. Has to be 1 at the end.
             tot_input_mix = 0
             for prod_exc in prod_exc_list:
-                if prod_exc.input['location']=='GLO':
+                index_col = loc_index_dict.get(prod_exc.input['location'])
+                if prod_exc.input['location']=='GLO' or index_col==None:
                     mix = 0
                 else:
-                    #Get the list of countries associated with the ecoinvent region of bauxite activity
-                    prod_country_list = country_correspondence.loc[country_correspondence['ecoinvent_country']==prod_exc.input['location'],'cty Name English'].values.tolist()
-                    mix = 0
-                    for cons_country in cons_country_list:
-                        index_row = list_rows.index(cons_country)
-                        for prod_country in prod_country_list:
-                            #Get index of region
-                            index_col = list_columns.index(prod_country)
-                            mix = mix + mat_cons[index_row,index_col]/loc_mineral_cons 
-                #Change mix pf producing region and save
-                prod_exc['amount'] = mix
-                prod_exc.save()
+                    mix = mat_loc_cons[index_row,index_col]/loc_mineral_cons
+                #Change mix pf producing region
+                exc_update_list.append((act.key,prod_exc['input'],mix))
                 #Sum mixes
                 tot_input_mix = tot_input_mix+mix 
             #Check that mixes sum up to alumina input
             if tot_input_mix < 1:
                 logging.warning("Sum of produced mineral for {mark_name} is {tot_input_mix} for location {region}!".format(mark_name=act_name,tot_input_mix=tot_input_mix,region=act['location']))
-        act.save()
+    return exc_update_list
+
+def dbUpdate_cons_mix(bw_db_name,year,mineral,adjustment="kastner",trade_data_type="reconciliated"):
+    '''
+    Function that updates the consumption mixes of mineral in the consuming countries based on the annual trade flows
+    Attributes:
+        bw_db_name: is the name of the Brightway database to update
+            requiremnt: Database needs to be edited according to project.
+        year: is the year to consider
+        mineral: is the mineral consumed which consumption mixes are updated in market for consumption of 'mineral'
+        transport: do we account for transport or not in the trades.
+    '''
+    apply_scenario_updates(bw_db_name,[get_cons_mix_component(bw_db_name,year,mineral,adjustment=adjustment,trade_data_type=trade_data_type)])
     return
 
-def dbUpdate_aluminum_global_production(bw_db_name,year):
+def get_year_updates(bw_db_name,year,mineral_list=['bauxite','alumina'],adjustment="kastner",trade_data_type="reconciliated",china_alu_elec='iai'):
     '''
-    Function that updates the aluminum consumption activity with the global production data
+    Function that calculates the electricity inputs of aluminum liquid processes, the energy inputs of alumina production processes and the consumption mixes of the minerals for a year
+    Attributes:
+        bw_db_name: is the name of the Brightway database to update
+            requiremnt: Database needs to be edited according to project.
+        year: is the year to consider
+        mineral_list: is the list of minerals which consumption mixes are updated. Empty list to update electricity and energy inputs only
+    Output:
+        exc_update_list is the list of (activity key, input key, amount) to update (see utils_bw.update_exchanges and utils_bw.calculate_scenario_lca)
+    '''
+    exc_update_list = get_ElecAluLiq_updates(bw_db_name,year,china_alu_elec=china_alu_elec)
+    exc_update_list = exc_update_list + get_EnerAlumina_updates(bw_db_name,year)
+    for mineral in mineral_list:
+        exc_update_list = exc_update_list + get_cons_mix_updates(bw_db_name,year,mineral,adjustment=adjustment,trade_data_type=trade_data_type)
+    return exc_update_list
+
+def dbUpdate_year(bw_db_name,year,mineral_list=['bauxite','alumina'],adjustment="kastner",trade_data_type="reconciliated",china_alu_elec='iai'):
+    '''
+    Function that updates the electricity inputs of aluminum liquid processes, the energy inputs of alumina production processes and the consumption mixes of the minerals for a year, in one batch of exchange updates
+    Same as dbUpdate_ElecAluLiq, dbUpdate_EnerAlumina and dbUpdate_cons_mix for each mineral, with one transaction and one processing of the database.
     Attributes:
         bw_db_name: is the name of the Brightway database to update
             requiremnt: Database needs to be edited according to project.
         year: is the year to consider
+        mineral_list: is the list of minerals which consumption mixes are updated. Empty list to update electricity and energy inputs only
+    '''
+    component_list = [get_ElecAluLiq_component(year,china_alu_elec=china_alu_elec),get_EnerAlumina_component(year)]
+    component_list = component_list+[get_cons_mix_component(bw_db_name,year,mineral,adjustment=adjustment,trade_data_type=trade_data_type) for mineral in mineral_list]
+    apply_scenario_updates(bw_db_name,component_list)
+    return
+
+def get_aluminum_global_production_updates(bw_db_name,year):
+    '''
+    Function that calculates the inputs of the aluminum consumption activity from the global production data
+    Attributes:
+        bw_db_name: is the name of the Brightway database to update
+            requiremnt: Database needs to be edited according to project.
+        year: is the year to consider
+    Output:
+        exc_update_list is the list of (activity key, input key, amount) to update (see utils_bw.update_exchanges)
     '''
     #inputs
-    country_correspondence = pd.read_csv('inputs/country_correspondence.csv').fillna(0)
+    country_correspondence = utils_mfa.get_reference_table('inputs/country_correspondence.csv').fillna(0)
     bw_db = bw.Database(bw_db_name)
     #mat_prod contains the matrix of production.
     mat_prod = utils_mfa.get_mat_prod(mineral='aluminium',year=year)
     list_countries = country_correspondence.loc[:,'cty Name English'].tolist()
     act = bw_db.get('market for consumption of aluminium')
-    act['location'] = 'GLO'
-    act.save()
     prod_act_name = 'aluminium production, primary, ingot'
+    #Output
+    exc_update_list = []
     #Get the list of mineral producing activities in market for consumption of mineral
     prod_exc_list = [exc for exc in act.technosphere() if prod_act_name == exc.input['name']]
     #tot_prod
@@ -254,54 +461,84 @@ def dbUpdate_aluminum_global_production(bw_db_name,year):
                 #Get index of region
                 index_cty = list_countries.index(prod_country)
                 mix = mix + mat_prod[index_cty,index_cty]
-        #Change mix pf producing region and save
-        prod_exc['amount'] = mix
-        prod_exc.save()
+        #Change mix pf producing region
+        exc_update_list.append((act.key,prod_exc['input'],mix))
         #Sum mixes
         tot_inputs = tot_inputs + mix
-    act.save()
     #Check that mixes sum up to alumina input
     if tot_inputs < tot_prod:
         logging.warning("Sum of produced mineral is {tot_inputs} compared to {tot_prod}!".format(tot_inputs=tot_inputs,tot_prod=tot_prod))
-    return
+    return exc_update_list
 
-def dbUpdate_localize(bw_db_name):
+def dbUpdate_aluminum_global_production(bw_db_name,year):
     '''
-    Function that updates the localize the consumption of bauxite, alumina and aluminium for all countries. Using the function creates a localized product system.
+    Function that updates the aluminum consumption activity with the global production data
     Attributes:
         bw_db_name: is the name of the Brightway database to update
             requiremnt: Database needs to be edited according to project.
+        year: is the year to consider
     '''
-    #inputs
     bw_db = bw.Database(bw_db_name)
+    act = bw_db.get('market for consumption of aluminium')
+    if act['location']!='GLO':
+        act['location'] = 'GLO'
+        act.save()
+        utils_bw.update_activity_index(act)
+    fingerprint = (year,)+get_input_checksums(['inputs/aluminium_production_data.csv','inputs/Comtrade Country Code and ISO list.xlsx','inputs/country_correspondence.csv'])
+    apply_scenario_updates(bw_db_name,[('aluminum_global_production',fingerprint,get_aluminum_global_production_updates,{'year':year})])
+    return
+
+def get_localize_updates(bw_db_name,mineral_list=['bauxite','alumina','aluminium'],localized_prod=None):
+    '''
+    Function that calculates the inputs of the markets for consumption of the minerals when the consumption is localized (local production, otherwise GLO) or globalized (GLO production)
+    Attributes:
+        bw_db_name: is the name of the Brightway database to update
+            requiremnt: Database needs to be edited according to project.
+        mineral_list: is the list of minerals which consumption is localized or globalized
+        localized_prod: None to localize the consumption, 'GLO' to globalize the consumption
+    Output:
+        exc_update_list is the list of (activity key, input key, amount) to update (see utils_bw.update_exchanges)
+    '''
     #Get the name of the producing activity of mineral for the consumption mixes by producing region
     prod_act_name_dict = {'bauxite':'bauxite mine operation',
                           'alumina':'alumina production',
                           'aluminium':'aluminium production, primary, ingot'}
-    for mineral in prod_act_name_dict.keys():
+    #Output
+    exc_update_list = []
+    for mineral in mineral_list:
         prod_act_name = prod_act_name_dict[mineral]
         act_name = 'market for consumption of '+mineral
         #Get the list of market for consumption acitivites by consuming region/country
-        act_list = [act for act in bw_db if act_name in act['name'] and 'GLO' not in act['location']]
+        act_list = utils_bw.find_activities(bw_db_name,name_contains=act_name,location_not_contains='GLO')
         for act in act_list:
             #Get the list of mineral producing activities in market for consumption of mineral
             prod_exc_list = [exc for exc in act.technosphere() if prod_act_name == exc.input['name']]
             assert 'GLO' in [exc.input['location'] for exc in prod_exc_list], 'No GLO producing region in '+act['location']
             #If local production exists, update the market with local production activity. Otherwise, consider GLO activity
-            if act['location'] in [exc.input['location'] for exc in prod_exc_list]:
-                localized_prod = act['location']
+            if localized_prod!=None:
+                act_localized_prod = localized_prod
+            elif act['location'] in [exc.input['location'] for exc in prod_exc_list]:
+                act_localized_prod = act['location']
             else:
-                localized_prod = 'GLO'
+                act_localized_prod = 'GLO'
             #Update all exchanges
             for prod_exc in prod_exc_list:
-                if prod_exc.input['location']==localized_prod:
+                if prod_exc.input['location']==act_localized_prod:
                     amount = 1
                 else:
                     amount = 0
-                #Change amount to and save
-                prod_exc['amount'] = amount
-                prod_exc.save()
-            act.save()
+                #Change amount
+                exc_update_list.append((act.key,prod_exc['input'],amount))
+    return exc_update_list
+
+def dbUpdate_localize(bw_db_name):
+    '''
+    Function that updates the localize the consumption of bauxite, alumina and aluminium for all countries. Using the function creates a localized product system.
+    Attributes:
+        bw_db_name: is the name of the Brightway database to update
+            requiremnt: Database needs to be edited according to project.
+    '''
+    apply_scenario_updates(bw_db_name,[get_localize_component(bw_db_name,mineral) for mineral in ['bauxite','alumina','aluminium']])
     return
 
 def dbUpdate_globalize(bw_db_name,stage_to_globalize):
@@ -311,31 +548,7 @@ def dbUpdate_globalize(bw_db_name,stage_to_globalize):
         bw_db_name: is the name of the Brightway database to update
             requiremnt: Database needs to be edited according to project.
     '''
-    #inputs
-    bw_db = bw.Database(bw_db_name)
-    #Get the name of the producing activity of mineral for the consumption mixes by producing region
-    prod_act_name_dict = {'bauxite':'bauxite mine operation',
-                          'alumina':'alumina production',
-                          'aluminium':'aluminium production, primary, ingot'}
-    for mineral in stage_to_globalize:
-        prod_act_name = prod_act_name_dict[mineral]
-        act_name = 'market for consumption of '+mineral
-        #Get the list of market for consumption acitivites by consuming region/country
-        act_list = [act for act in bw_db if act_name in act['name'] and 'GLO' not in act['location']]
-        for act in act_list:
-            #Get the list of mineral producing activities in market for consumption of mineral
-            prod_exc_list = [exc for exc in act.technosphere() if prod_act_name == exc.input['name']]
-            assert 'GLO' in [exc.input['location'] for exc in prod_exc_list], 'No GLO producing region in '+act['location']
-            #Update all exchanges
-            for prod_exc in prod_exc_list:
-                if prod_exc.input['location']=='GLO':
-                    amount = 1
-                else:
-                    amount = 0
-                #Change amount to and save
-                prod_exc['amount'] = amount
-                prod_exc.save()
-            act.save()
+    apply_scenario_updates(bw_db_name,[get_localize_component(bw_db_name,mineral,localized_prod='GLO') for mineral in stage_to_globalize])
     return
 
 def get_embodied_impacts(year,mineral,recipe_method_abb):
@@ -344,7 +557,7 @@ def get_embodied_impacts(year,mineral,recipe_method_abb):
     Requirement: Spatial distributions of the coutry-level impact factors
     '''
     #Inputs
-    country_correspondence = pd.read_csv('inputs/country_correspondence.csv')
+    country_correspondence = utils_mfa.get_reference_table('inputs/country_correspondence.csv')
     list_cty_ein = country_correspondence.loc[:,'ecoinvent_country'].tolist()
     if_spatial = pd.read_csv('outputs/spatial_if_aluminum.csv')
     if_spatial = if_spatial[(if_spatial.Midpoint_abb==recipe_method_abb) & (if_spatial.Year==year) & (if_spatial.Spatial_contribution!='GLO')].reset_index(drop=True)
@@ -371,7 +584,7 @@ def get_embodied_impacts(year,mineral,recipe_method_abb):
     #Create matrix of spatial distribution
     mat_spat_imp_pro = sparse.csc_matrix((if_spatial["Score"],(if_spatial["index_producer"],if_spatial["index_imp"])),shape=(len(list_cty_ein),len(list_cty_ein)))
     #Get apparent consumption matrix
-    mat_cons = utils_mfa.calculate_mat_cons_kastner(mineral=mineral,year=year)
+    mat_cons = utils_mfa.get_mat_cons(mineral=mineral,year=year)
     #Calculate the matrix of spatial distribution for consumption
     mat_spat_imp_cons = mat_cons*mat_spat_imp_pro
     return mat_spat_imp_cons
@@ -382,7 +595,7 @@ def get_glo_if(mineral):
     Requirement: Coutry-level impact factors
     '''
     #Inputs
-    country_correspondence = pd.read_csv('inputs/country_correspondence.csv')
+    country_correspondence = utils_mfa.get_reference_table('inputs/country_correspondence.csv')
     list_cty_ein = country_correspondence.loc[:,'ecoinvent_country'].tolist()
     if_dt = pd.read_csv('outputs/if_alumina_aluminium.csv')
     mineral_act ={'bauxite':'bauxite production','alumina':'alumina production','aluminium':'aluminium production, primary, ingot'}
@@ -406,7 +619,7 @@ def get_glo_if(mineral):
             #Create matrix of spatial distribution
             mat_if_pro = sparse.csc_matrix((tmp_if_dt["Score"],(tmp_if_dt["index_producer"],[0 for l in range(0,len(tmp_if_dt))])),shape=(len(list_cty_ein),1))
             #Get apparent consumption matrix
-            mat_cons = utils_mfa.calculate_mat_cons_kastner(mineral=mineral,year=year)
+            mat_cons = utils_mfa.get_mat_cons(mineral=mineral,year=year)
             #Calculate the matrix of spatial distribution for consumption
             mat_if_cons = mat_cons*mat_if_pro
             tmp_dict = {'Location':'GLO',
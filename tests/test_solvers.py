@@ -0,0 +1,210 @@
+'''
+Tests of the solvers of the Kastner et al. model (utils_mfa) against the dense inverse, and of the exchange updates of the scenarios (utils_brightway) against a mocked exchange table
+Run from the root of the repository: python -m pytest -q
+'''
+import types
+import numpy as np
+import pytest
+from scipy import sparse
+import source.utils_mfa as utils_mfa
+
+NB_COUNTRY = 8
+
+def get_test_system(seed=0):
+    '''
+    Return a random trade matrix and production vector. Country 5 and 6 trade without production (inventory changes), country 7 is inactive.
+    '''
+    rng = np.random.default_rng(seed)
+    mat_trad = rng.uniform(10,50,(NB_COUNTRY,NB_COUNTRY))*(rng.random((NB_COUNTRY,NB_COUNTRY))<0.5)
+    np.fill_diagonal(mat_trad,0)
+    mat_trad[7,:] = 0
+    mat_trad[:,7] = 0
+    vec_prod = rng.uniform(100,200,NB_COUNTRY)
+    vec_prod[5:] = 0
+    return mat_trad,vec_prod
+
+def get_dense_mat_cons(mat_trad,vec_prod):
+    '''
+    Reference R_hat of the Kastner et al. model with the dense inverse of (I-A)
+    '''
+    vec_exp = mat_trad.sum(axis=0)
+    vec_dmi = vec_prod+mat_trad.sum(axis=1)
+    vec_dmi_adj = vec_dmi+np.maximum(vec_exp-vec_dmi,0)
+    vec_dmi_rec = np.divide(1,vec_dmi_adj,out=np.zeros(NB_COUNTRY),where=vec_dmi_adj>0)
+    vec_dmi_adj[vec_dmi_adj==0] = 1
+    vec_cons = (vec_dmi_adj-vec_exp)/vec_dmi_adj
+    mat_dmi_ori = np.linalg.inv(np.eye(NB_COUNTRY)-mat_trad*vec_dmi_rec).dot(np.diag(vec_prod))
+    return vec_cons[:,np.newaxis]*mat_dmi_ori
+
+def set_test_inputs(monkeypatch,system_dict):
+    '''
+    Replace the trade and production data of utils_mfa by the systems {mineral:(mat_trad,vec_prod)}
+    '''
+    monkeypatch.setattr(utils_mfa,"get_mat_trad",lambda mineral="aluminium",**kwargs: sparse.csc_matrix(system_dict[mineral][0]))
+    monkeypatch.setattr(utils_mfa,"get_vec_prod",lambda mineral="aluminium",year_list=[2000]: system_dict[mineral][1][:,np.newaxis].repeat(len(list(year_list)),axis=1))
+    monkeypatch.setattr(utils_mfa,"get_mat_prod",lambda mineral="aluminium",year=2000: sparse.diags(system_dict[mineral][1],format="csc"))
+    monkeypatch.setattr(utils_mfa,"get_mat_cons_cache_key",lambda mineral="aluminium",**kwargs: ("test",mineral))
+    monkeypatch.setattr(utils_mfa,"add_mat_cons_cache",lambda cache_key,mat: None)
+    return
+
+@pytest.mark.parametrize("solver",["lu","inverse","neumann","gmres","bicgstab"])
+def test_solve_mat_dmi_ori(solver):
+    mat_trad,vec_prod = get_test_system()
+    mat_ex_share,vec_dmi_adj,vec_cons = utils_mfa.get_kastner_system(mat_trad=sparse.csc_matrix(mat_trad),mat_prod=sparse.diags(vec_prod,format="csc"))
+    mat_dmi_ori = utils_mfa.solve_mat_dmi_ori(mat_ex_share=mat_ex_share,mat_prod=sparse.diags(vec_prod,format="csc"),solver=solver,tol=1e-12)
+    mat_ref = np.linalg.inv(np.eye(NB_COUNTRY)-mat_ex_share.toarray()).dot(np.diag(vec_prod))
+    np.testing.assert_allclose(sparse.csc_matrix(mat_dmi_ori).toarray(),mat_ref,rtol=1e-8,atol=1e-6)
+
+def test_solve_mat_dmi_ori_unknown_solver():
+    mat_trad,vec_prod = get_test_system()
+    with pytest.raises(ValueError):
+        utils_mfa.solve_mat_dmi_ori(mat_ex_share=sparse.csc_matrix(mat_trad*0),mat_prod=sparse.diags(vec_prod,format="csc"),solver="cholesky")
+
+@pytest.mark.parametrize("solver,compact",[("lu",False),("lu",True),("gmres",True),("neumann",False)])
+def test_calculate_mat_cons_kastner(monkeypatch,solver,compact):
+    mat_trad,vec_prod = get_test_system()
+    set_test_inputs(monkeypatch,{"aluminium":(mat_trad,vec_prod)})
+    R_hat = utils_mfa.calculate_mat_cons_kastner(mineral="aluminium",year=2000,solver=solver,tol=1e-12,compact=compact)
+    np.testing.assert_allclose(R_hat.toarray(),get_dense_mat_cons(mat_trad,vec_prod),rtol=1e-8,atol=1e-6)
+
+def test_update_mat_cons_kastner(monkeypatch):
+    mat_trad,vec_prod = get_test_system()
+    set_test_inputs(monkeypatch,{"aluminium":(mat_trad,vec_prod)})
+    kastner_state = utils_mfa.get_kastner_state(mineral="aluminium",year=2000)
+    np.testing.assert_allclose(kastner_state["R_hat"].toarray(),get_dense_mat_cons(mat_trad,vec_prod),rtol=1e-8,atol=1e-6)
+    #Shock on two trade flows and on the production of two countries (one of them starts producing)
+    delta_trad = np.zeros((NB_COUNTRY,NB_COUNTRY))
+    delta_trad[0,1] = 30
+    delta_trad[2,6] = 5
+    delta_prod = np.zeros(NB_COUNTRY)
+    delta_prod[3] = -50
+    delta_prod[6] = 80
+    R_hat = utils_mfa.update_mat_cons_kastner(kastner_state,delta_trad=sparse.csc_matrix(delta_trad),delta_prod=delta_prod)
+    np.testing.assert_allclose(R_hat.toarray(),get_dense_mat_cons(mat_trad+delta_trad,vec_prod+delta_prod),rtol=1e-8,atol=1e-6)
+    #The state is not modified
+    np.testing.assert_allclose(kastner_state["R_hat"].toarray(),get_dense_mat_cons(mat_trad,vec_prod),rtol=1e-8,atol=1e-6)
+
+def test_calculate_mat_cons_chain(monkeypatch):
+    mineral_list = ["aluminium","alumina","bauxite"]
+    system_dict = {mineral:get_test_system(seed) for seed,mineral in enumerate(mineral_list)}
+    set_test_inputs(monkeypatch,system_dict)
+    R_hat_dict,emb_cons_dict = utils_mfa.calculate_mat_cons_chain(2000,mineral_list=mineral_list)
+    R_ref_dict = {mineral:get_dense_mat_cons(*system_dict[mineral]) for mineral in mineral_list}
+    for mineral in mineral_list:
+        np.testing.assert_allclose(R_hat_dict[mineral].toarray(),R_ref_dict[mineral],rtol=1e-8,atol=1e-6)
+    #Reference of the embodied consumption: diag(R_t) * (I-Z)^-1 with the dense inverse
+    nb_stage = len(mineral_list)
+    mat_z = np.zeros((NB_COUNTRY*nb_stage,NB_COUNTRY*nb_stage))
+    for s,mineral in enumerate(mineral_list):
+        if mineral in utils_mfa.MINERAL_NEXT_STAGE_DICT:
+            t = mineral_list.index(utils_mfa.MINERAL_NEXT_STAGE_DICT[mineral])
+            mat_z[t*NB_COUNTRY:(t+1)*NB_COUNTRY,s*NB_COUNTRY:(s+1)*NB_COUNTRY] = utils_mfa.MINERAL_INPUT_DICT[mineral]*utils_mfa.get_relative_matrix(sparse.csc_matrix(R_ref_dict[mineral]),axis=1).toarray()
+    mat_emb_ref = sparse.block_diag([R_ref_dict[mineral] for mineral in mineral_list]).toarray().dot(np.linalg.inv(np.eye(NB_COUNTRY*nb_stage)-mat_z))
+    assert set(emb_cons_dict.keys())=={("aluminium","aluminium"),("alumina","alumina"),("bauxite","bauxite"),("alumina","aluminium"),("bauxite","alumina"),("bauxite","aluminium")}
+    for (production_of,consumption_of),emb_cons in emb_cons_dict.items():
+        s = mineral_list.index(production_of)
+        t = mineral_list.index(consumption_of)
+        np.testing.assert_allclose(emb_cons.toarray(),mat_emb_ref[t*NB_COUNTRY:(t+1)*NB_COUNTRY,s*NB_COUNTRY:(s+1)*NB_COUNTRY],rtol=1e-8,atol=1e-6)
+
+#Exchanges of the mocked table: (output code, input code, type, amount). Pair (A,A) has a production and a technosphere exchange, pair (A,B) two technosphere exchanges, pair (B,C) a technosphere and a substitution exchange.
+EXCHANGE_LIST = [("A","A","production",1.),
+                 ("A","A","technosphere",0.1),
+                 ("A","B","technosphere",0.2),
+                 ("A","B","technosphere",0.3),
+                 ("B","B","production",1.),
+                 ("B","C","technosphere",0.5),
+                 ("B","C","substitution",0.05),
+                 ("C","C","production",1.)]
+ACTIVITY_DICT = {("test",code):index for index,code in enumerate(["A","B","C"])}
+#Sign of the exchanges in the technosphere matrix (same as bw2calc)
+EXCHANGE_SIGN_DICT = {"production":1,"technosphere":-1,"substitution":1}
+
+@pytest.fixture
+def utils_bw():
+    pytest.importorskip("brightway2")
+    import source.utils_brightway as utils_bw
+    return utils_bw
+
+@pytest.fixture
+def exchange_table(utils_bw,monkeypatch):
+    '''
+    In-memory exchange table (ExchangeDataset) with the exchanges of EXCHANGE_LIST in database "test". The database list of Brightway is replaced by a recorder.
+    '''
+    import peewee
+    db = peewee.SqliteDatabase(":memory:")
+    with db.bind_ctx([utils_bw.ExchangeDataset]):
+        db.create_tables([utils_bw.ExchangeDataset])
+        for output_code,input_code,exc_type,amount in EXCHANGE_LIST:
+            utils_bw.ExchangeDataset.create(output_database="test",output_code=output_code,input_database="test",input_code=input_code,type=exc_type,
+                                            data={"output":("test",output_code),"input":("test",input_code),"type":exc_type,"amount":amount})
+        databases = types.SimpleNamespace(dirty_list=[],clean_count=[0])
+        databases.set_dirty = databases.dirty_list.append
+        databases.clean = lambda: databases.clean_count.__setitem__(0,databases.clean_count[0]+1)
+        monkeypatch.setattr(utils_bw,"sqlite3_lci_db",db)
+        monkeypatch.setattr(utils_bw,"bw",types.SimpleNamespace(databases=databases))
+        yield utils_bw.ExchangeDataset,databases
+
+def get_table_matrix(exchange_dataset):
+    '''
+    Build the technosphere matrix of the mocked table
+    '''
+    mat_techno = np.zeros((len(ACTIVITY_DICT),len(ACTIVITY_DICT)))
+    for exc_row in exchange_dataset.select():
+        mat_techno[ACTIVITY_DICT[("test",exc_row.input_code)],ACTIVITY_DICT[("test",exc_row.output_code)]] += EXCHANGE_SIGN_DICT[exc_row.type]*exc_row.data["amount"]
+    return mat_techno
+
+def get_table_scenario_base(exchange_dataset):
+    '''
+    Build the parts of the scenario base used by get_scenario_patch from the mocked table (see build_scenario_base)
+    '''
+    exchange_dict = {}
+    for exc_row in exchange_dataset.select().where(exchange_dataset.type=="technosphere"):
+        exc_key = (("test",exc_row.output_code),("test",exc_row.input_code))
+        nb_exc,amount = exchange_dict.get(exc_key,(0,0.))
+        exchange_dict[exc_key] = (nb_exc+1,amount+exc_row.data["amount"])
+    return {"technosphere_matrix":sparse.csr_matrix(get_table_matrix(exchange_dataset)),
+            "product_dict":ACTIVITY_DICT,
+            "activity_dict":ACTIVITY_DICT,
+            "exchange_dict":exchange_dict}
+
+EXC_UPDATE_LIST = [(("test","A"),("test","A"),0.15),
+                   (("test","A"),("test","B"),1.),
+                   (("test","B"),("test","C"),0.25),
+                   #The last amount of a pair is kept
+                   (("test","A"),("test","B"),0.4)]
+
+def test_update_exchanges(exchange_table,utils_bw):
+    exchange_dataset,databases = exchange_table
+    nb_exc = utils_bw.update_exchanges("test",EXC_UPDATE_LIST)
+    #One exchange for (A,A) and (B,C), two for (A,B). Production and substitution exchanges are not modified.
+    assert nb_exc==4
+    assert databases.dirty_list==["test"] and databases.clean_count[0]==1
+    amount_dict = {(exc_row.output_code,exc_row.input_code,exc_row.type):exc_row.data["amount"] for exc_row in exchange_dataset.select()}
+    assert amount_dict==pytest.approx({("A","A","production"):1.,("A","A","technosphere"):0.15,("A","B","technosphere"):0.4,
+                                       ("B","B","production"):1.,("B","C","technosphere"):0.25,("B","C","substitution"):0.05,("C","C","production"):1.})
+    #Same amounts: nothing is written
+    assert utils_bw.update_exchanges("test",EXC_UPDATE_LIST)==0
+    assert databases.dirty_list==["test"]
+
+def test_update_exchanges_missing(exchange_table,utils_bw):
+    exchange_dataset,databases = exchange_table
+    mat_techno = get_table_matrix(exchange_dataset)
+    #No technosphere exchange between C and A. The transaction is cancelled.
+    with pytest.raises(KeyError):
+        utils_bw.update_exchanges("test",EXC_UPDATE_LIST+[(("test","C"),("test","A"),1.)])
+    np.testing.assert_array_equal(get_table_matrix(exchange_dataset),mat_techno)
+    assert databases.dirty_list==[]
+    with pytest.raises(ValueError):
+        utils_bw.update_exchanges("test",[(("other","A"),("test","A"),1.)])
+
+def test_get_scenario_patch(exchange_table,utils_bw):
+    exchange_dataset,databases = exchange_table
+    scenario_base = get_table_scenario_base(exchange_dataset)
+    row_array,col_array,value_array = utils_bw.get_scenario_patch(scenario_base,EXC_UPDATE_LIST)
+    mat_patched = utils_bw.patch_technosphere_matrix(scenario_base["technosphere_matrix"],row_array,col_array,value_array)
+    #Same matrix as the database after update_exchanges
+    utils_bw.update_exchanges("test",EXC_UPDATE_LIST)
+    np.testing.assert_allclose(mat_patched.toarray(),get_table_matrix(exchange_dataset),rtol=0,atol=1e-15)
+    #No technosphere exchange between C and A
+    with pytest.raises(KeyError):
+        utils_bw.get_scenario_patch(scenario_base,[(("test","C"),("test","A"),1.)])